@@ -1,5 +1,8 @@
 #include "stdio.h"
 #include "string.h"
+#include "math.h"
+
+#include <vector>
 
 #ifdef _WIN32
 #define EXPORT extern "C" __declspec( dllexport )
@@ -152,3 +155,173 @@ EXPORT bool has_flat_polys(void* in_mesh, int polys_count)
 
   return false;
 }
+
+// Triangle reordering for post-transform vertex cache locality
+// Tom Forsyth - Linear-Speed Vertex Cache Optimisation
+// https://tomforsyth1000.github.io/papers/fast_vert_cache_opt.html
+
+#define FORSYTH_CACHE_SIZE 32
+
+static float forsyth_vertex_score(int cache_position, int active_triangles)
+{
+  if(active_triangles == 0)
+  {
+    return -1.0f;
+  }
+  float score = 0.0f;
+  if(cache_position >= 0)
+  {
+    if(cache_position < 3)
+    {
+      // The last triangle vertices
+      score = 0.75f;
+    }
+    else
+    {
+      const float scaler = 1.0f / (FORSYTH_CACHE_SIZE - 3);
+      score = 1.0f - (cache_position - 3) * scaler;
+      score = powf(score, 1.5f);
+    }
+  }
+  // Bonus points for having a low number of triangles left, so lone vertices are cleared up first
+  score += 2.0f * powf((float)active_triangles, -0.5f);
+  return score;
+}
+
+EXPORT void optimize_vertex_cache(unsigned int* in_indices, int index_count, int vertex_count, unsigned int* out_indices)
+{
+  int triangle_count = index_count / 3;
+  
+  std::vector<int> active_triangles(vertex_count, 0);
+  for(int i = 0; i < index_count; i++)
+  {
+    active_triangles[in_indices[i]]++;
+  }
+
+  std::vector<int> triangles_offset(vertex_count + 1, 0);
+  for(int i = 0; i < vertex_count; i++)
+  {
+    triangles_offset[i+1] = triangles_offset[i] + active_triangles[i];
+  }
+  std::vector<int> vertex_triangles(index_count);
+  std::vector<int> fill_count(vertex_count, 0);
+  for(int i = 0; i < index_count; i++)
+  {
+    int vertex = in_indices[i];
+    vertex_triangles[triangles_offset[vertex] + fill_count[vertex]++] = i / 3;
+  }
+
+  std::vector<int> cache_position(vertex_count, -1);
+  std::vector<float> vertex_score(vertex_count);
+  for(int i = 0; i < vertex_count; i++)
+  {
+    vertex_score[i] = forsyth_vertex_score(-1, active_triangles[i]);
+  }
+
+  std::vector<float> triangle_score(triangle_count);
+  std::vector<bool> triangle_added(triangle_count, false);
+  for(int i = 0; i < triangle_count; i++)
+  {
+    triangle_score[i] = vertex_score[in_indices[i*3+0]] + vertex_score[in_indices[i*3+1]] + vertex_score[in_indices[i*3+2]];
+  }
+
+  int cache[FORSYTH_CACHE_SIZE + 3];
+  int cache_size = 0;
+  int new_cache[FORSYTH_CACHE_SIZE + 3];
+
+  int best_triangle = -1;
+  int scan_position = 0;
+  int out_count = 0;
+
+  while(out_count < triangle_count)
+  {
+    if(best_triangle < 0)
+    {
+      // Nothing in the cache, find the best of the remaining triangles
+      float best_score = -1.0f;
+      for(int i = scan_position; i < triangle_count; i++)
+      {
+        if(triangle_added[i] == false && triangle_score[i] > best_score)
+        {
+          best_score = triangle_score[i];
+          best_triangle = i;
+        }
+      }
+      while(scan_position < triangle_count && triangle_added[scan_position])
+      {
+        scan_position++;
+      }
+    }
+
+    triangle_added[best_triangle] = true;
+    unsigned int* triangle = &in_indices[best_triangle*3];
+    out_indices[out_count*3+0] = triangle[0];
+    out_indices[out_count*3+1] = triangle[1];
+    out_indices[out_count*3+2] = triangle[2];
+    out_count++;
+
+    int new_cache_size = 0;
+    for(int i = 0; i < 3; i++)
+    {
+      int vertex = triangle[i];
+      // Remove the triangle from the vertex active triangles
+      int* begin = &vertex_triangles[triangles_offset[vertex]];
+      int count = active_triangles[vertex];
+      for(int j = 0; j < count; j++)
+      {
+        if(begin[j] == best_triangle)
+        {
+          begin[j] = begin[count-1];
+          break;
+        }
+      }
+      active_triangles[vertex]--;
+      new_cache[new_cache_size++] = vertex;
+    }
+    for(int i = 0; i < cache_size; i++)
+    {
+      int vertex = cache[i];
+      if(vertex != (int)triangle[0] && vertex != (int)triangle[1] && vertex != (int)triangle[2])
+      {
+        new_cache[new_cache_size++] = vertex;
+      }
+    }
+
+    // Update the scores of the vertices in the cache (and the ones pushed out of it)
+    for(int i = 0; i < new_cache_size; i++)
+    {
+      int vertex = new_cache[i];
+      cache_position[vertex] = i < FORSYTH_CACHE_SIZE ? i : -1;
+      float score = forsyth_vertex_score(cache_position[vertex], active_triangles[vertex]);
+      float score_delta = score - vertex_score[vertex];
+      vertex_score[vertex] = score;
+      
+      int* begin = &vertex_triangles[triangles_offset[vertex]];
+      for(int j = 0; j < active_triangles[vertex]; j++)
+      {
+        triangle_score[begin[j]] += score_delta;
+      }
+    }
+
+    // The next triangle is the best one using a vertex in the cache
+    best_triangle = -1;
+    float best_score = -1.0f;
+    for(int i = 0; i < new_cache_size && i < FORSYTH_CACHE_SIZE; i++)
+    {
+      int vertex = new_cache[i];
+      int* begin = &vertex_triangles[triangles_offset[vertex]];
+      for(int j = 0; j < active_triangles[vertex]; j++)
+      {
+        int t = begin[j];
+        if(triangle_score[t] > best_score)
+        {
+          best_score = triangle_score[t];
+          best_triangle = t;
+        }
+      }
+    }
+
+    cache_size = new_cache_size < FORSYTH_CACHE_SIZE ? new_cache_size : FORSYTH_CACHE_SIZE;
+    memcpy(cache, new_cache, cache_size * sizeof(int));
+  }
+}
@@ -31,3 +31,7 @@ pack_tangents.restype = None
 has_flat_polys = CBlenderMalt['has_flat_polys']
 has_flat_polys.argtypes = [ctypes.c_void_p, ctypes.c_int]
 has_flat_polys.restype = ctypes.c_bool
+
+optimize_vertex_cache = CBlenderMalt['optimize_vertex_cache']
+optimize_vertex_cache.argtypes = [ctypes.POINTER(ctypes.c_uint32), ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_uint32)]
+optimize_vertex_cache.restype = None
@@ -188,6 +188,22 @@ def reset_materials():
 import time
 __TIMESTAMP = time.time()
 
+def get_material_priorities(paths):
+    # Materials used by visible objects are compiled first
+    priorities = { path : 1 for path in paths }
+    try:
+        for obj in bpy.context.view_layer.objects:
+            if obj.visible_get() == False:
+                continue
+            for slot in obj.material_slots:
+                if slot.material:
+                    path = slot.material.malt.get_source_path()
+                    if path in priorities:
+                        priorities[path] = 0
+    except:
+        pass
+    return priorities
+
 INITIALIZED = False
 def track_shader_changes(force_update=False, async_compilation=True):
     from BlenderMalt import MaltPipeline
@@ -216,7 +232,9 @@ def track_shader_changes(force_update=False, async_compilation=True):
 
         from . import MaltPipeline
         if len(needs_update) > 0:
-            compiled_materials = MaltPipeline.get_bridge().compile_materials(needs_update, async_compilation=async_compilation)
+            priorities = get_material_priorities(needs_update)
+            compiled_materials = MaltPipeline.get_bridge().compile_materials(needs_update,
+                async_compilation=async_compilation, priorities=priorities)
         else:
             compiled_materials = MaltPipeline.get_bridge().receive_async_compilation_materials()
         
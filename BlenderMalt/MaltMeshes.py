@@ -1,8 +1,13 @@
 import ctypes
 import bpy
+from collections import OrderedDict
 
 MESHES = {}
 
+# Mesh hash : (source loops, indices), see optimize_mesh_data
+OPTIMIZED_MESHES = OrderedDict()
+OPTIMIZED_MESHES_CACHE_SIZE = 512
+
 def get_mesh_name(object):
     name = object.name_full
     if len(object.modifiers) == 0 and object.data:
@@ -12,10 +17,100 @@ def get_mesh_name(object):
 def get_mesh(object):
     key = get_mesh_name(object)
     if key not in MESHES.keys() or MESHES[key] is None:
-        MESHES[key] = load_mesh(object, key)
+        if __LOADER:
+            MESHES[key] = __LOADER.load(object, key)
+        else:
+            MESHES[key] = load_mesh(object, key)
     return MESHES[key]
 
+# Meshes requested between begin_loading and end_loading are extracted on worker threads,
+# and only while the time budget lasts. The rest are loaded in the next scene updates.
+# The budget includes waiting for the extraction and finishing the meshes, so new meshes are only accepted
+# while the estimated time to finish the accepted ones fits in it.
+LOAD_TIME_BUDGET = 0.1
+__LOADER = None
+__EXECUTOR = None
+
+def get_executor():
+    global __EXECUTOR
+    if __EXECUTOR is None:
+        import os
+        from concurrent.futures import ThreadPoolExecutor
+        __EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+    return __EXECUTOR
+
+class MeshLoader():
+
+    # Estimated time per loop to finish the accepted meshes, measured on each finish call
+    seconds_per_loop = 1e-7
+
+    def __init__(self, time_budget):
+        import time
+        self.start = time.perf_counter()
+        self.time_budget = time_budget
+        self.jobs = []
+        self.loop_count = 0
+        self.pending = False
+    
+    def load(self, object, name):
+        import time
+        elapsed = time.perf_counter() - self.start
+        # Evaluated meshes can have more loops than their data, but it's a cheap estimate
+        loop_count = self.loop_count + (len(object.data.loops) if object.type == 'MESH' else 0)
+        # At least one mesh is loaded on each update, no matter its size
+        if elapsed > self.time_budget or (self.jobs and elapsed + loop_count * self.seconds_per_loop > self.time_budget):
+            self.pending = True
+            return None
+        job = prepare_mesh(object, name)
+        if job is None:
+            return None
+        self.jobs.append((job, get_executor().submit(extract_mesh, job)))
+        self.loop_count += job['loop_count']
+        return job['proxys']
+    
+    def finish(self):
+        # The extraction reads Blender memory directly, so it must be finished before returning control to Blender
+        import time
+        start = time.perf_counter()
+        for job, future in self.jobs:
+            try:
+                future.result()
+                finish_mesh(job)
+            except:
+                import traceback
+                traceback.print_exc()
+                MESHES[job['name']] = None
+        if self.loop_count:
+            seconds_per_loop = (time.perf_counter() - start) / self.loop_count
+            MeshLoader.seconds_per_loop = (MeshLoader.seconds_per_loop + seconds_per_loop) / 2
+        self.jobs = []
+        self.loop_count = 0
+
+def begin_loading(time_budget=None):
+    global __LOADER
+    end_loading()
+    __LOADER = MeshLoader(time_budget if time_budget is not None else LOAD_TIME_BUDGET)
+
+def end_loading():
+    # Returns True if there are meshes left to load
+    global __LOADER
+    loader = __LOADER
+    __LOADER = None
+    if loader:
+        loader.finish()
+        return loader.pending
+    return False
+
 def load_mesh(object, name):
+    job = prepare_mesh(object, name)
+    if job is None:
+        return None
+    extract_mesh(job)
+    finish_mesh(job)
+    return job['proxys']
+
+def prepare_mesh(object, name):
+    # Blender API calls, must run on the main thread
     from . import CBlenderMalt
 
     m = object.data
@@ -28,44 +123,39 @@ def load_mesh(object, name):
     m.calc_loop_triangles()
     m.calc_normals_split()
     
-    mesh_ptr = ctypes.c_void_p(m.as_pointer())
-    loop_tris_ptr = ctypes.c_void_p(m.loop_triangles[0].as_pointer())
-    loop_tri_polys_ptr = ctypes.c_int.from_address(m.loop_triangle_polygons[0].as_pointer())
-
     loop_count = len(m.loops)
     loop_tri_count = len(m.loop_triangles)
     material_count = max(1, len(m.materials))
 
+    job = {
+        'name': name,
+        'loop_count': loop_count,
+        'mesh_ptr': ctypes.c_void_p(m.as_pointer()),
+        'loop_tris_ptr': ctypes.c_void_p(m.loop_triangles[0].as_pointer()),
+        'loop_tri_polys_ptr': ctypes.c_int.from_address(m.loop_triangle_polygons[0].as_pointer()),
+        'loop_tri_count': loop_tri_count,
+        # (destination buffer, source address)
+        'copies': [],
+    }
+
     positions = get_load_buffer('positions', ctypes.c_float, (loop_count * 3))
     normals = get_load_buffer('normals', ctypes.c_float, (loop_count * 3))
     indices = []
-    indices_ptrs = (ctypes.c_void_p * material_count)()
     for i in range(material_count):
         indices.append(get_load_buffer('indices'+str(i), ctypes.c_uint32, (loop_tri_count * 3)))
-        indices_ptrs[i] = ctypes.cast(indices[i].buffer(), ctypes.c_void_p)
-    
-    indices_lengths = (ctypes.c_uint32 * material_count)()
-
-    CBlenderMalt.retrieve_mesh_data(mesh_ptr, loop_tris_ptr, loop_tri_polys_ptr, loop_tri_count,
-        positions.buffer(), normals.buffer(), indices_ptrs, indices_lengths)
-    
-    for i in range(material_count):
-        indices[i]._size = indices_lengths[i]
 
     uvs_list = []
     tangents_buffer = None
     for i, uv_layer in enumerate(m.uv_layers):
         if i >= 4: break
-        uvs = (ctypes.c_float * (loop_count * 2)).from_address(uv_layer.data[0].as_pointer())
         uv_buffer = get_load_buffer('uv'+str(i), ctypes.c_float, loop_count * 2)
-        ctypes.memmove(uv_buffer.buffer(), uvs, uv_buffer.size_in_bytes())
+        job['copies'].append((uv_buffer, uv_layer.data[0].as_pointer()))
         uvs_list.append(uv_buffer)
         if i == 0 and object.original.data.malt_parameters.bools['precomputed_tangents'].boolean:
             m.calc_tangents(uvmap=uv_layer.name)
             tangents_ptr = CBlenderMalt.mesh_tangents_ptr(ctypes.c_void_p(m.as_pointer()))
-            tangents = (ctypes.c_float * (loop_count * 4)).from_address(ctypes.addressof(tangents_ptr.contents))
             tangents_buffer = get_load_buffer('tangents'+str(i), ctypes.c_float, (loop_count * 4))
-            ctypes.memmove(tangents_buffer.buffer(), tangents, tangents_buffer.size_in_bytes())
+            job['copies'].append((tangents_buffer, ctypes.addressof(tangents_ptr.contents)))
     
     colors_list = [None]*4
     if object.type == 'MESH':
@@ -82,13 +172,12 @@ def load_mesh(object, name):
                     type = ctypes.c_float
                 else:
                     continue
-                color = (type * (loop_count * 4)).from_address(attribute.data[0].as_pointer())
                 color_buffer = get_load_buffer('colors'+str(i), type, loop_count*4)
-                ctypes.memmove(color_buffer.buffer(), color, color_buffer.size_in_bytes())
+                job['copies'].append((color_buffer, attribute.data[0].as_pointer()))
                 colors_list[i] = color_buffer
 
     #TODO: Optimize. Create load buffers from bytearrays and retrieve them later
-    mesh_data = {
+    job['mesh_data'] = {
         'positions': positions,
         'indices': indices,
         'normals': normals,
@@ -97,11 +186,239 @@ def load_mesh(object, name):
         'colors': colors_list,
     }
 
+    from Bridge.Proxys import MeshProxy
+    job['proxys'] = [MeshProxy(name, i) for i in range(material_count)]
+
+    return job
+
+def extract_mesh(job):
+    # Doesn't call the Blender API, can run on any thread
+    from . import CBlenderMalt
+
+    mesh_data = job['mesh_data']
+    indices = mesh_data['indices']
+    material_count = len(indices)
+    
+    indices_ptrs = (ctypes.c_void_p * material_count)()
+    for i in range(material_count):
+        indices_ptrs[i] = ctypes.cast(indices[i].buffer(), ctypes.c_void_p)
+    
+    indices_lengths = (ctypes.c_uint32 * material_count)()
+
+    CBlenderMalt.retrieve_mesh_data(job['mesh_ptr'], job['loop_tris_ptr'], job['loop_tri_polys_ptr'], job['loop_tri_count'],
+        mesh_data['positions'].buffer(), mesh_data['normals'].buffer(), indices_ptrs, indices_lengths)
+    
+    for i in range(material_count):
+        indices[i]._size = indices_lengths[i]
+    
+    for buffer, address in job['copies']:
+        ctypes.memmove(buffer.buffer(), address, buffer.size_in_bytes())
+
+def finish_mesh(job):
+    # Main thread only
+    mesh_data = job['mesh_data']
+    loop_count = job['loop_count']
+
+    preferences = bpy.context.preferences.addons['BlenderMalt'].preferences
+    if preferences.optimize_meshes:
+        mesh_data, loop_count = optimize_mesh_data(mesh_data, loop_count)
+
+    vertex_format = preferences.mesh_vertex_format
+    if vertex_format != 'FULL':
+        mesh_data = compact_mesh_data(mesh_data, loop_count, vertex_format == 'INTERLEAVED')
+
     from . import MaltPipeline
-    MaltPipeline.get_bridge().load_mesh(name, mesh_data)
+    MaltPipeline.get_bridge().load_mesh(job['name'], mesh_data, hash_mesh_data(mesh_data))
 
-    from Bridge.Proxys import MeshProxy
-    return [MeshProxy(name, i) for i in range(material_count)]
+def hash_mesh_data(mesh_data):
+    # Identical geometry is only uploaded once (See Bridge.Client_API.load_mesh)
+    import xxhash
+    hash = xxhash.xxh3_128()
+    for key, value in mesh_data.items():
+        buffers = value if isinstance(value, list) else [value]
+        if isinstance(value, dict):
+            hash.update('{}:{};'.format(key, sorted(value.items())).encode())
+            continue
+        for i, buffer in enumerate(buffers):
+            if buffer is None:
+                hash.update('{}{}:None;'.format(key, i).encode())
+                continue
+            hash.update('{}{}:{}:{};'.format(key, i, buffer.ctype().__name__, len(buffer)).encode())
+            hash.update((ctypes.c_ubyte * buffer.size_in_bytes()).from_address(ctypes.addressof(buffer.buffer())))
+    return hash.hexdigest()
+
+def optimize_mesh_data(mesh_data, vertex_count):
+    # Blender meshes have one vertex per loop.
+    # Weld the loops with identical attributes, reorder the triangles for vertex cache locality
+    # and the vertices for fetch locality.
+    # Returns the new mesh data and vertex count.
+    import numpy as np
+    from . import MaltPipeline, CBlenderMalt
+    bridge = MaltPipeline.get_bridge()
+
+    def as_array(buffer):
+        return np.ctypeslib.as_array(buffer.buffer()).reshape(vertex_count, -1)
+    
+    attributes = [mesh_data['positions'], mesh_data['normals'], mesh_data['tangents'], *mesh_data['uvs'], *mesh_data['colors']]
+    attributes = [as_array(buffer) for buffer in attributes if buffer]
+
+    hash = hash_mesh_data(mesh_data)
+    cached = OPTIMIZED_MESHES.get(hash)
+    if cached:
+        OPTIMIZED_MESHES.move_to_end(hash)
+    else:
+        loops = np.concatenate([attribute.view(np.uint8) for attribute in attributes], axis=1)
+        loops = np.ascontiguousarray(loops).view(np.dtype((np.void, loops.shape[1]))).reshape(-1)
+        unique_loops, loop_to_vertex = np.unique(loops, return_index=True, return_inverse=True)[1:]
+        loop_to_vertex = loop_to_vertex.reshape(-1)
+        
+        indices = []
+        for buffer in mesh_data['indices']:
+            welded = np.ascontiguousarray(loop_to_vertex[np.ctypeslib.as_array(buffer.buffer())], dtype=np.uint32)
+            optimized = np.empty_like(welded)
+            if len(welded):
+                pointer = ctypes.POINTER(ctypes.c_uint32)
+                CBlenderMalt.optimize_vertex_cache(welded.ctypes.data_as(pointer), len(welded), len(unique_loops),
+                    optimized.ctypes.data_as(pointer))
+            indices.append(optimized)
+        
+        # Sort the vertices by their first use
+        all_indices = np.concatenate(indices) if len(indices) else np.empty(0, np.uint32)
+        used, first_use = np.unique(all_indices, return_index=True)
+        order = used[np.argsort(first_use)]
+        vertex_rank = np.empty(len(unique_loops), np.uint32)
+        vertex_rank[order] = np.arange(len(order), dtype=np.uint32)
+        
+        cached = (unique_loops[order], [vertex_rank[i] for i in indices])
+        OPTIMIZED_MESHES[hash] = cached
+        if len(OPTIMIZED_MESHES) > OPTIMIZED_MESHES_CACHE_SIZE:
+            OPTIMIZED_MESHES.popitem(last=False)
+    
+    source_loops, indices = cached
+    new_vertex_count = len(source_loops)
+
+    def remap(name, buffer):
+        if buffer is None:
+            return None
+        array = as_array(buffer)[source_loops]
+        result = get_load_buffer(name, buffer.ctype(), array.size)
+        np.ctypeslib.as_array(result.buffer())[:] = array.reshape(-1)
+        bridge.release_shared_buffer(buffer)
+        return result
+    
+    def load_indices(i, array):
+        result = get_load_buffer('indices'+str(i), ctypes.c_uint32, len(array))
+        np.ctypeslib.as_array(result.buffer())[:] = array
+        bridge.release_shared_buffer(mesh_data['indices'][i])
+        return result
+
+    result = {
+        'positions': remap('positions', mesh_data['positions']),
+        'indices': [load_indices(i, array) for i, array in enumerate(indices)],
+        'normals': remap('normals', mesh_data['normals']),
+        'uvs': [remap('uv'+str(i), uv) for i, uv in enumerate(mesh_data['uvs'])],
+        'tangents': remap('tangents', mesh_data['tangents']),
+        'colors': [remap('colors'+str(i), color) for i, color in enumerate(mesh_data['colors'])],
+    }
+    return result, new_vertex_count
+
+def compact_mesh_data(mesh_data, vertex_count, interleaved):
+    # Snorm16 normals and tangents, half float UVs, sRGB unorm8 colors and uint16 indices when possible
+    # (See Malt.Pipeline.load_mesh)
+    import numpy as np
+    from . import MaltPipeline
+    bridge = MaltPipeline.get_bridge()
+
+    def as_array(buffer, components):
+        return np.ctypeslib.as_array(buffer.buffer()).reshape(-1, components)
+    def to_snorm16(array):
+        return np.round(np.clip(array, -1.0, 1.0) * 32767.0).astype(np.int16)
+    def to_srgb8(array):
+        rgb = np.clip(array[:,:3], 0.0, 1.0)
+        rgb = np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * np.power(rgb, 1.0/2.4) - 0.055)
+        result = np.empty(array.shape, np.uint8)
+        result[:,:3] = np.round(rgb * 255.0)
+        result[:,3] = np.round(np.clip(array[:,3], 0.0, 1.0) * 255.0)
+        return result
+
+    # (name, array, format, components)
+    attributes = [('position', as_array(mesh_data['positions'], 3), 'FLOAT', 3)]
+    # Normals are padded to 4 components to keep them 4 bytes aligned
+    normals = np.zeros((vertex_count, 4), np.int16)
+    normals[:,:3] = to_snorm16(as_array(mesh_data['normals'], 3))
+    attributes.append(('normal', normals, 'SNORM16', 3))
+    if mesh_data['tangents']:
+        attributes.append(('tangent', to_snorm16(as_array(mesh_data['tangents'], 4)), 'SNORM16', 4))
+    for i, uv in enumerate(mesh_data['uvs']):
+        attributes.append(('uv'+str(i), as_array(uv, 2).astype(np.float16), 'HALF_FLOAT', 2))
+    for i, color in enumerate(mesh_data['colors']):
+        if color:
+            color = as_array(color, 4)
+            if color.dtype != np.uint8:
+                color = to_srgb8(color)
+            attributes.append(('color'+str(i), color, 'UNORM8', 4))
+    
+    ctypes_map = {
+        np.dtype(np.float32) : ctypes.c_float,
+        np.dtype(np.int16) : ctypes.c_int16,
+        np.dtype(np.float16) : ctypes.c_uint16,
+        np.dtype(np.uint16) : ctypes.c_uint16,
+        np.dtype(np.uint8) : ctypes.c_uint8,
+    }
+    def load_array(name, array):
+        buffer = get_load_buffer(name, ctypes_map[array.dtype], array.size)
+        # Copy the raw bytes, half floats are stored as c_uint16
+        np.ctypeslib.as_array(buffer.buffer()).view(np.uint8)[:] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+        return buffer
+
+    result = {
+        'positions': None,
+        'indices': mesh_data['indices'],
+        'normals': None,
+        'uvs': [None] * len(mesh_data['uvs']),
+        'tangents': None,
+        'colors': [None] * len(mesh_data['colors']),
+        'layout': {},
+        'vertices': None,
+    }
+    
+    if interleaved:
+        stride = sum(array.itemsize * array.shape[1] for name, array, format, components in attributes)
+        vertices = get_load_buffer('vertices', ctypes.c_uint8, vertex_count * stride)
+        vertices_array = np.ctypeslib.as_array(vertices.buffer()).reshape(vertex_count, stride)
+        offset = 0
+        for name, array, format, components in attributes:
+            size = array.itemsize * array.shape[1]
+            vertices_array[:, offset:offset+size] = array.view(np.uint8).reshape(vertex_count, size)
+            result['layout'][name] = (format, components, stride, offset)
+            offset += size
+        result['vertices'] = vertices
+    else:
+        keys = { 'position' : 'positions', 'normal' : 'normals', 'tangent' : 'tangents' }
+        for name, array, format, components in attributes:
+            result['layout'][name] = (format, components, array.itemsize * array.shape[1], 0)
+            if name == 'position':
+                buffer = mesh_data['positions']
+            else:
+                buffer = load_array(name, array)
+            if name in keys:
+                result[keys[name]] = buffer
+            else:
+                list_name, index = ('uvs', int(name[2:])) if name.startswith('uv') else ('colors', int(name[5:]))
+                result[list_name][index] = buffer
+    
+    if vertex_count <= 65536:
+        result['indices'] = [load_array('indices'+str(i), as_array(indices, 1).astype(np.uint16))
+            for i, indices in enumerate(mesh_data['indices'])]
+    
+    # Release the full precision buffers that are no longer used
+    from Bridge.Mesh import get_mesh_buffers
+    used_buffers = set(id(buffer) for buffer in get_mesh_buffers(result))
+    for buffer in get_mesh_buffers(mesh_data):
+        if id(buffer) not in used_buffers:
+            bridge.release_shared_buffer(buffer)
+
+    return result
 
 def get_load_buffer(name, ctype, size):
     from . import MaltPipeline
@@ -76,7 +76,8 @@ class MaltPipeline(bpy.types.PropertyGroup):
         
         path = bpy.path.abspath(pipeline, library=self.id_data.library)
         import Bridge
-        bridge = Bridge.Client_API.Bridge(path, int(self.viewport_bit_depth), debug_mode, renderdoc_path, plugin_dirs, docs_path)
+        bridge = Bridge.Client_API.Bridge(path, int(self.viewport_bit_depth), debug_mode, renderdoc_path, plugin_dirs, docs_path,
+            preferences.render_server_processes)
         from Malt.Utils import LOG
         LOG.info('Blender {} {} {}'.format(bpy.app.version_string, bpy.app.build_branch, bpy.app.build_hash))
         params = bridge.get_parameters()
@@ -115,6 +116,14 @@ class MaltPipeline(bpy.types.PropertyGroup):
     viewport_bit_depth : bpy.props.EnumProperty(items=[('8', '8', ''),('16', '16', ''),('32', '32', '')], 
         name="Bit Depth (Viewport)", update=update_pipeline_settings,
         options={'LIBRARY_EDITABLE'}, override={'LIBRARY_OVERRIDABLE'})
+    use_final_render_tiles : bpy.props.BoolProperty(name="Tiled Final Render", default=False,
+        description="Render the final render in tiles, to bound the GPU memory used for very large resolutions",
+        options={'LIBRARY_EDITABLE'}, override={'LIBRARY_OVERRIDABLE'})
+    final_render_tile_size : bpy.props.IntProperty(name="Tile Size", default=2048, min=64, subtype='PIXEL',
+        options={'LIBRARY_EDITABLE'}, override={'LIBRARY_OVERRIDABLE'})
+    final_render_tile_guard : bpy.props.IntProperty(name="Tile Guard Band", default=64, min=0, subtype='PIXEL',
+        description="Extra pixels rendered around each tile, so screen space filters (lines, blur, AO...) don't show seams",
+        options={'LIBRARY_EDITABLE'}, override={'LIBRARY_OVERRIDABLE'})
     graph_types : bpy.props.CollectionProperty(type=bpy.types.PropertyGroup,
         options={'LIBRARY_EDITABLE'},
         override={'LIBRARY_OVERRIDABLE', 'USE_INSERTION'})
@@ -132,6 +141,11 @@ class MaltPipeline(bpy.types.PropertyGroup):
         row.operator('wm.malt_reload_pipeline', text='', icon='FILE_REFRESH')
         layout.prop(self, 'plugins_dir')
         layout.prop(self, 'viewport_bit_depth')
+        layout.prop(self, 'use_final_render_tiles')
+        col = layout.column()
+        col.enabled = self.use_final_render_tiles
+        col.prop(self, 'final_render_tile_size')
+        col.prop(self, 'final_render_tile_guard')
 
 
 class OT_MaltReloadPipeline(bpy.types.Operator):
@@ -24,6 +24,49 @@ def high_res_sleep(seconds):
     else:
         time.sleep(seconds)
 
+MESH_TYPES = ('MESH','CURVE','SURFACE','META', 'FONT')
+
+def flatten_matrix(matrix):
+    return [e for v in matrix.transposed() for e in v]
+
+def visible_display(obj):
+    return obj.display_type in ('TEXTURED','SOLID') or obj.type == 'LIGHT'
+
+def get_material_names(obj):
+    return tuple(slot.material.name_full if slot.material else None for slot in obj.material_slots)
+
+def get_light(obj, matrix, overrides, proxys):
+    if obj.data.type == 'AREA':
+        return None #Not supported
+
+    malt_light = obj.data.malt
+
+    light = Scene.Light()
+    light.color = tuple(obj.data.color * malt_light.strength)
+    light.position = tuple(matrix.translation)
+    light.direction = tuple(matrix.to_quaternion() @ Vector((0.0,0.0,-1.0)))
+    if malt_light.override_global_settings:
+        light.sun_max_distance = malt_light.max_distance
+    light.radius = malt_light.radius
+    light.spot_angle = malt_light.spot_angle
+    light.spot_blend = malt_light.spot_blend_angle
+    light.parameters = obj.data.malt_parameters.get_parameters(overrides, proxys)
+
+    types = {
+        'SUN' : 1,
+        'POINT' : 2,
+        'SPOT' : 3,
+    }
+    light.type = types[obj.data.type]
+
+    if light.type == types['SUN']:
+        light.matrix = flatten_matrix(matrix.to_quaternion().to_matrix().to_4x4().inverted())
+    else:
+        #Scaling too ????
+        light.matrix = flatten_matrix(matrix.inverted())
+    
+    return light
+
 
 class MaltRenderEngine(bpy.types.RenderEngine):
     bl_idname = "MALT"
@@ -38,9 +81,19 @@ class MaltRenderEngine(bpy.types.RenderEngine):
         self.view_matrix = None
         self.request_new_frame = True
         self.request_scene_update = True
+        self.pending_meshes = False
+        self.loaded_textures = 0
+        self.overrides = []
+        # Changes sent to the server without a full scene update, see view_update
+        self.scene_delta = {}
+        self.tracked_objects = {}
+        self.tracked_lights = {}
+        self.untracked_objects = set()
+        self.visible_objects = set()
         self.bridge = MaltPipeline.get_bridge()
         self.bridge_id = self.bridge.get_viewport_id() if self.bridge else None
         self.last_frame_time = 0
+        self.recorder = None
 
     def __del__(self):
         try:
@@ -55,6 +108,7 @@ class MaltRenderEngine(bpy.types.RenderEngine):
             scene = Scene.Scene()
             self.scene = scene
         scene = self.scene
+        self.overrides = overrides
         
         if hasattr(scene, 'proxys') == False:
             scene.proxys = {}
@@ -71,9 +125,6 @@ class MaltRenderEngine(bpy.types.RenderEngine):
         remap = r.frame_map_new / r.frame_map_old
         scene.time = (scene.frame / fps) * remap
         
-        def flatten_matrix(matrix):
-            return [e for v in matrix.transposed() for e in v]
-        
         #Camera
         if depsgraph.mode == 'VIEWPORT':
             view_3d = context.region_data 
@@ -97,10 +148,21 @@ class MaltRenderEngine(bpy.types.RenderEngine):
             return scene
         
         meshes = {}
+        objects_parameters = {}
+        objects_tags = {}
+
+        from Bridge.PackedScene import PackedObjects
+        scene.packed_objects = PackedObjects()
+
+        self.scene_delta = {}
+        self.tracked_objects = {}
+        self.tracked_lights = {}
+        self.untracked_objects = set()
+        self.visible_objects = set()
 
         #Objects
-        def add_object(obj, matrix, id):
-            if obj.type in ('MESH','CURVE','SURFACE','META', 'FONT'):
+        def add_object(obj, matrix, id, track=False):
+            if obj.type in MESH_TYPES:
                 name = MaltMeshes.get_mesh_name(obj)
                 if depsgraph.mode == 'RENDER':
                     name = '___F12___' + name
@@ -130,11 +192,17 @@ class MaltRenderEngine(bpy.types.RenderEngine):
                 mirror_scale = scale[0]*scale[1]*scale[2] < 0.0
                 matrix = flatten_matrix(matrix)
 
-                obj_parameters = obj.malt_parameters.get_parameters(overrides, scene.proxys)
-                obj_parameters['ID'] = id
-
-                tags = set(collection.name for collection in obj.original.users_collection)
+                # Instances of the same object share their parameters and tags
+                obj_parameters = objects_parameters.get(obj.name_full)
+                if obj_parameters is None:
+                    obj_parameters = obj.malt_parameters.get_parameters(overrides, scene.proxys)
+                    objects_parameters[obj.name_full] = obj_parameters
+                tags = objects_tags.get(obj.name_full)
+                if tags is None:
+                    tags = set(collection.name for collection in obj.original.users_collection)
+                    objects_tags[obj.name_full] = tags
                 
+                first_index = scene.packed_objects.count
                 if len(obj.material_slots) > 0:
                     for i, slot in enumerate(obj.material_slots):
                         material = default_material
@@ -149,67 +217,155 @@ class MaltRenderEngine(bpy.types.RenderEngine):
                                 scene.proxys[material_key]  = MaterialProxy(path, shader_parameters, material_parameters)
                             material = scene.proxys[material_key]
                         if override_material: material = override_material
-                        result = Scene.Object(matrix, mesh[i], material, obj_parameters, mirror_scale, tags)
-                        scene.objects.append(result)
+                        scene.packed_objects.add(matrix, id, mesh[i], material, obj_parameters, mirror_scale, tags)
                 else:
                     material = default_material
                     if override_material: material = override_material
-                    result = Scene.Object(matrix, mesh[0], material, obj_parameters, mirror_scale, tags)
-                    scene.objects.append(result)
+                    scene.packed_objects.add(matrix, id, mesh[0], material, obj_parameters, mirror_scale, tags)
+                
+                if track:
+                    self.tracked_objects[obj.name_full] = {
+                        'indices': range(first_index, scene.packed_objects.count),
+                        'mesh': name,
+                        'materials': get_material_names(obj),
+                        'parameters': scene.packed_objects.get_handle('parameters', obj_parameters),
+                        'mirror_scale': mirror_scale,
+                    }
            
             elif obj.type == 'LIGHT':
-                if obj.data.type == 'AREA':
-                    return #Not supported
-
-                malt_light = obj.data.malt
-
-                light = Scene.Light()
-                light.color = tuple(obj.data.color * malt_light.strength)
-                light.position = tuple(matrix.translation)
-                light.direction = tuple(matrix.to_quaternion() @ Vector((0.0,0.0,-1.0)))
-                if malt_light.override_global_settings:
-                    light.sun_max_distance = malt_light.max_distance
-                light.radius = malt_light.radius
-                light.spot_angle = malt_light.spot_angle
-                light.spot_blend = malt_light.spot_blend_angle
-                light.parameters = obj.data.malt_parameters.get_parameters(overrides, scene.proxys)
-
-                types = {
-                    'SUN' : 1,
-                    'POINT' : 2,
-                    'SPOT' : 3,
-                }
-                light.type = types[obj.data.type]
-
-                if light.type == types['SUN']:
-                    light.matrix = flatten_matrix(matrix.to_quaternion().to_matrix().to_4x4().inverted())
-                else:
-                    #Scaling too ????
-                    light.matrix = flatten_matrix(matrix.inverted())
-                
-                scene.lights.append(light)
+                light = get_light(obj, matrix, overrides, scene.proxys)
+                if track:
+                    self.tracked_lights[obj.name_full] = len(scene.lights) if light else None
+                if light:
+                    scene.lights.append(light)
 
         is_f12 = depsgraph.mode == 'RENDER'
 
-        def visible_display(obj):
-            return obj.display_type in ('TEXTURED','SOLID') or obj.type == 'LIGHT'
+        # Viewport meshes are loaded progressively, see MaltMeshes.begin_loading
+        if is_f12 == False:
+            MaltMeshes.begin_loading()
 
         for obj in depsgraph.objects:
             if is_f12 or (visible_display(obj) and obj.visible_in_viewport_get(context.space_data)):
                 id = xxhash.xxh3_64_intdigest(obj.name_full.encode()) % (2**16)
-                add_object(obj, obj.matrix_world, id)
+                add_object(obj, obj.matrix_world, id, is_f12 == False)
+                self.visible_objects.add(obj.name_full)
 
         for instance in depsgraph.object_instances:
             if instance.instance_object:
                 obj = instance.instance_object
                 parent = instance.parent
+                # Instances and instancers always trigger full scene updates
+                self.untracked_objects.add(obj.name_full)
+                self.untracked_objects.add(parent.name_full)
                 if is_f12 or (visible_display(obj) and visible_display(parent) and
                 parent.visible_in_viewport_get(context.space_data)):
                     id = abs(instance.random_id) % (2**16)
                     add_object(instance.instance_object, instance.matrix_world, id)
         
+        if is_f12 == False:
+            self.pending_meshes = MaltMeshes.end_loading()
+        
         return scene
     
+    def get_visible_objects(self, context, depsgraph):
+        return set(obj.name_full for obj in depsgraph.objects
+            if visible_display(obj) and obj.visible_in_viewport_get(context.space_data))
+    
+    def add_scene_delta(self, context, depsgraph, update):
+        # Records transform and parameter changes into self.scene_delta.
+        # Returns False if the update requires a full scene update.
+        delta = self.scene_delta
+        proxys = delta.setdefault('proxys', {})
+        overrides = self.overrides
+        
+        if isinstance(update.id, bpy.types.Object):
+            if update.is_updated_geometry:
+                return False
+            obj = update.id.evaluated_get(depsgraph)
+            name = obj.name_full
+            if name in self.untracked_objects:
+                return False
+            
+            is_visible = visible_display(obj) and obj.visible_in_viewport_get(context.space_data)
+            if is_visible != (name in self.visible_objects):
+                return False
+            
+            if obj.type == 'LIGHT':
+                if name not in self.tracked_lights:
+                    return is_visible == False
+                index = self.tracked_lights[name]
+                if index is not None:
+                    light = get_light(obj, obj.matrix_world, overrides, proxys)
+                    if light is None:
+                        return False
+                    self.scene.lights[index] = light
+                    delta.setdefault('lights', {})[index] = light
+                return True
+            
+            tracked = self.tracked_objects.get(name)
+            if tracked is None:
+                # Objects without a rendered mesh don't affect the scene
+                return obj.type not in MESH_TYPES or is_visible == False
+            
+            if MaltMeshes.get_mesh_name(obj) != tracked['mesh']:
+                return False
+            
+            if update.is_updated_transform:
+                matrix = obj.matrix_world
+                scale = matrix.to_scale()
+                if (scale[0]*scale[1]*scale[2] < 0.0) != tracked['mirror_scale']:
+                    return False
+                matrix = flatten_matrix(matrix)
+                matrices = delta.setdefault('matrices', {})
+                for index in tracked['indices']:
+                    matrices[index] = matrix
+            else:
+                if get_material_names(obj) != tracked['materials']:
+                    return False
+                parameters = obj.malt_parameters.get_parameters(overrides, proxys)
+                delta.setdefault('parameters', {})[tracked['parameters']] = (parameters, tracked['indices'])
+            return True
+        
+        if isinstance(update.id, bpy.types.Light):
+            for obj in depsgraph.objects:
+                if obj.type == 'LIGHT' and obj.data.original == update.id.original:
+                    if obj.name_full in self.untracked_objects:
+                        return False
+                    index = self.tracked_lights.get(obj.name_full)
+                    if index is not None:
+                        light = get_light(obj, obj.matrix_world, overrides, proxys)
+                        if light is None:
+                            return False
+                        self.scene.lights[index] = light
+                        delta.setdefault('lights', {})[index] = light
+            return True
+        
+        if isinstance(update.id, bpy.types.Material):
+            material = update.id.original
+            key = ('material', material.name_full)
+            proxy = self.scene.proxys.get(key)
+            if proxy is None:
+                # Not used by the scene
+                return True
+            path = material.malt.get_source_path()
+            if path != proxy.path:
+                return False
+            shader_parameters = material.malt.parameters.get_parameters(overrides, proxys)
+            material_parameters = material.malt_parameters.get_parameters(overrides, proxys)
+            delta.setdefault('materials', {})[key] = (path, shader_parameters, material_parameters)
+            return True
+        
+        if isinstance(update.id, bpy.types.Scene):
+            # Visibility changes are only notified to the Scene
+            if self.get_visible_objects(context, depsgraph) != self.visible_objects:
+                return False
+            scene_eval = depsgraph.scene_eval
+            delta['scene_parameters'] = scene_eval.malt_parameters.get_parameters(overrides, proxys)
+            return True
+        
+        return False
+    
     def get_AOVs(self, scene):
         #TODO: Hardcoded for now
         result = {}
@@ -255,16 +411,22 @@ class MaltRenderEngine(bpy.types.RenderEngine):
 
         AOVs = self.get_AOVs(scene)
         scene = self.get_scene(None, depsgraph, True, overrides)
-        self.bridge.render(0, resolution, scene, True, AOVs=AOVs)
+        if self.bridge.scene_writer:
+            # Exporting the scene (See OT_MaltExportScene)
+            self.bridge.scene_writer.add_frame(scene.frame, resolution, scene, AOVs)
+            return
+        world = depsgraph.scene.world
+        tile_size = world.malt.final_render_tile_size if world.malt.use_final_render_tiles else 0
+        self.bridge.render(0, resolution, scene, True, AOVs=AOVs,
+            tile_size=tile_size, tile_guard=world.malt.final_render_tile_guard)
 
         buffers = None
         finished = False
 
-        import time
         while not finished:
             buffers, finished, read_resolution = self.bridge.render_result(0)
-            time.sleep(0.1)
             if finished: break
+            self.bridge.wait_render_result(0, timeout=0.1)
         
         size = self.size_x * self.size_y
 
@@ -290,12 +452,22 @@ class MaltRenderEngine(bpy.types.RenderEngine):
 
     def view_update(self, context, depsgraph):
         self.request_new_frame = True
-        self.request_scene_update = True
 
         for update in depsgraph.updates:
             if update.is_updated_geometry:
                 if isinstance(update.id, bpy.types.Object):
                     MaltMeshes.unload_mesh(update.id)
+            if self.request_scene_update == False:
+                try:
+                    if self.add_scene_delta(context, depsgraph, update) == False:
+                        self.request_scene_update = True
+                except:
+                    import traceback
+                    traceback.print_exc()
+                    self.request_scene_update = True
+        
+        if self.request_scene_update:
+            self.scene_delta = {}
 
     def view_draw(self, context, depsgraph):
         if self.bridge is not MaltPipeline.get_bridge():
@@ -305,6 +477,12 @@ class MaltRenderEngine(bpy.types.RenderEngine):
             self.request_new_frame = True
             self.request_scene_update = True
         
+        if self.bridge.recorder is not self.recorder:
+            # Send the whole scene to the new recording (See OT_MaltRecordSession)
+            self.recorder = self.bridge.recorder
+            self.request_new_frame = True
+            self.request_scene_update = True
+        
         global CAPTURE
         if CAPTURE:
             self.request_new_frame = True
@@ -325,11 +503,30 @@ class MaltRenderEngine(bpy.types.RenderEngine):
             smooth_interpolation = scene.world_parameters['Viewport.Smooth Interpolation']
             mag_filter = GL.GL_LINEAR if smooth_interpolation else GL.GL_NEAREST
 
+        loaded_textures = self.bridge.get_loaded_textures()
+        if loaded_textures != self.loaded_textures:
+            # Restart the render with the textures loaded asynchronously by the server
+            self.loaded_textures = loaded_textures
+            self.request_new_frame = True
+        if self.bridge.has_pending_textures():
+            self.tag_redraw()
+
         if self.request_new_frame:
-            self.bridge.render(self.bridge_id, resolution, scene, self.request_scene_update, CAPTURE)
+            scene_delta = None
+            if self.request_scene_update == False and self.scene_delta:
+                scene_delta = self.scene_delta
+            self.bridge.render(self.bridge_id, resolution, scene, self.request_scene_update, CAPTURE, scene_delta=scene_delta)
             CAPTURE = False
             self.request_new_frame = False
             self.request_scene_update = False
+            self.scene_delta = {}
+        
+        if self.pending_meshes:
+            # Send the rest of the meshes in the next frames
+            self.pending_meshes = False
+            self.request_new_frame = True
+            self.request_scene_update = True
+            self.tag_redraw()
         
         target_fps = context.preferences.addons['BlenderMalt'].preferences.render_fps_cap
         if target_fps > 0:
@@ -420,6 +617,84 @@ class OT_MaltRenderDocCapture(bpy.types.Operator):
         CAPTURE = True
         context.area.tag_redraw()
         return {'FINISHED'}
+
+class OT_MaltRecordSession(bpy.types.Operator):
+    bl_idname = "wm.malt_record_session"
+    bl_label = "Record Session"
+    bl_description = "Record the messages sent to the render server, to replay them without Blender (See Bridge.Replay)"
+
+    filepath : bpy.props.StringProperty(subtype='FILE_PATH')
+    filter_glob : bpy.props.StringProperty(default='*.maltrec', options={'HIDDEN'})
+
+    def invoke(self, context, event):
+        if MaltPipeline.get_bridge().recorder:
+            return self.execute(context)
+        if self.filepath == '':
+            self.filepath = bpy.path.abspath('//') + time.strftime("malt %Y-%m-%d(%H-%M).maltrec")
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        from . import MaltTextures
+        bridge = MaltPipeline.get_bridge()
+        if bridge.recorder:
+            bridge.stop_recording()
+            self.report({'INFO'}, 'Recording saved')
+        else:
+            bridge.start_recording(bpy.path.ensure_ext(bpy.path.abspath(self.filepath), '.maltrec'))
+            # Load everything again, so it's recorded
+            MaltMeshes.reset_meshes()
+            MaltTextures.reset_textures()
+            MaltMaterial.reset_materials()
+        for screen in bpy.data.screens:
+            for area in screen.areas:
+                area.tag_redraw()
+        return {'FINISHED'}
+
+class OT_MaltExportScene(bpy.types.Operator):
+    bl_idname = "wm.malt_export_scene"
+    bl_label = "Malt Scene (.malt)"
+    bl_description = "Export the scene frame range for rendering without Blender (See Bridge.BatchRender)"
+
+    filepath : bpy.props.StringProperty(subtype='FILE_PATH')
+    filter_glob : bpy.props.StringProperty(default='*.malt', options={'HIDDEN'})
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.render.engine == 'MALT'
+
+    def invoke(self, context, event):
+        if self.filepath == '':
+            self.filepath = bpy.path.ensure_ext(bpy.path.abspath('//') + context.scene.name, '.malt')
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        from Bridge.SceneFile import SceneWriter
+        from . import MaltTextures
+        scene = context.scene
+        bridge = MaltPipeline.get_bridge(scene.world, True)
+        writer = SceneWriter(bridge.pipeline_path, bridge.plugins_paths)
+        # Reload every resource, so the writer records them
+        MaltMeshes.reset_meshes()
+        MaltTextures.reset_textures()
+        bridge.scene_writer = writer
+        current_frame = scene.frame_current
+        try:
+            # The scene is recorded by MaltRenderEngine.render instead of rendered
+            for frame in range(scene.frame_start, scene.frame_end + 1, scene.frame_step):
+                scene.frame_set(frame)
+                bpy.ops.render.render()
+        finally:
+            bridge.scene_writer = None
+            scene.frame_set(current_frame)
+        writer.write(bpy.path.ensure_ext(bpy.path.abspath(self.filepath), '.malt'))
+        self.report({'INFO'}, 'Exported {} frames'.format(len(writer.frames)))
+        return {'FINISHED'}
+
+def export_menu_func(self, context):
+    if context.scene.render.engine == 'MALT':
+        self.layout.operator(OT_MaltExportScene.bl_idname)
     
 class VIEW3D_PT_Malt_Stats(bpy.types.Panel):
     bl_space_type = 'VIEW_3D'
@@ -434,13 +709,20 @@ class VIEW3D_PT_Malt_Stats(bpy.types.Panel):
     def draw(self, context):
         from . import MaltPipeline
         self.layout.operator("wm.malt_renderdoc_capture")
-        stats = MaltPipeline.get_bridge().get_stats()
+        bridge = MaltPipeline.get_bridge()
+        if bridge.recorder:
+            self.layout.operator("wm.malt_record_session", text='Stop Recording', icon='REC', depress=True)
+        else:
+            self.layout.operator("wm.malt_record_session", icon='REC')
+        stats = bridge.get_stats()
         for line in stats.splitlines():
             self.layout.label(text=line)
 
 classes = [
     MaltRenderEngine,
     OT_MaltRenderDocCapture,
+    OT_MaltRecordSession,
+    OT_MaltExportScene,
     VIEW3D_PT_Malt_Stats,
 ]
 
@@ -462,11 +744,15 @@ def get_panels():
 def register():
     for cls in classes:
         bpy.utils.register_class(cls)
+    
+    bpy.types.TOPBAR_MT_file_export.append(export_menu_func)
 
     for panel in get_panels():
         panel.COMPAT_ENGINES.add('MALT')
 
 def unregister():
+    bpy.types.TOPBAR_MT_file_export.remove(export_menu_func)
+
     for cls in classes:
         bpy.utils.unregister_class(cls)
 
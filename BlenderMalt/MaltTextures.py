@@ -10,6 +10,47 @@ def get_texture(texture):
     return __TEXTURES[name]
 
 
+# Float images are only loaded by the server when Blender wouldn't convert their pixels
+FILE_FLOAT_FORMATS = ('OPEN_EXR', 'HDR')
+FILE_FLOAT_COLORSPACES = ('Linear Rec.709', 'Non-Color')
+
+__FILE_DECODING = None
+
+def file_decoding_available():
+    global __FILE_DECODING
+    if __FILE_DECODING is None:
+        try:
+            import OpenImageIO
+            __FILE_DECODING = True
+        except:
+            __FILE_DECODING = False
+    return __FILE_DECODING
+
+def get_texture_file(texture):
+    # Returns the image file path if the render server can decode it, otherwise the pixels are sent from Blender
+    import bpy, os
+    if bpy.context.preferences.addons['BlenderMalt'].preferences.load_texture_files == False:
+        return None
+    if file_decoding_available() == False:
+        return None
+    if texture.source != 'FILE' or texture.packed_file or texture.is_dirty or texture.alpha_mode == 'NONE':
+        return None
+    if texture.is_float:
+        if texture.file_format not in FILE_FLOAT_FORMATS:
+            return None
+        if texture.colorspace_settings.name not in FILE_FLOAT_COLORSPACES:
+            return None
+    path = bpy.path.abspath(texture.filepath, library=texture.library)
+    if os.path.isfile(path) == False:
+        return None
+    return os.path.normpath(path)
+
+def hash_texture_file(path, sRGB):
+    # Use the file stats instead of its content, so it doesn't have to be read from Blender
+    import os, xxhash
+    stat = os.stat(path)
+    return xxhash.xxh3_64_hexdigest(repr((path, stat.st_size, stat.st_mtime_ns, sRGB)))
+
 def __load_texture(texture):
     w,h = texture.size
     channels = int(texture.channels)
@@ -17,9 +58,33 @@ def __load_texture(texture):
     sRGB = texture.colorspace_settings.name == 'sRGB' and texture.is_float == False
     if size == 0:
         return False
+    
+    path = get_texture_file(texture)
+    if path:
+        MaltPipeline.get_bridge().load_texture_file(texture.name_full, path, sRGB, hash_texture_file(path, sRGB))
+        from Bridge.Proxys import TextureProxy
+        return TextureProxy(texture.name_full)
 
-    buffer = MaltPipeline.get_bridge().get_shared_buffer(ctypes.c_float, size)
-    texture.pixels.foreach_get(buffer.as_np_array())
+    # Send the pixels with the image precision (8 bit, half float or float), see Bridge.Texture
+    bits_per_channel = texture.depth // channels
+    bridge = MaltPipeline.get_bridge()
+    if texture.is_float == False or bits_per_channel <= 16:
+        import numpy as np
+        pixels = np.empty(size, np.float32)
+        texture.pixels.foreach_get(pixels)
+        if texture.is_float == False:
+            buffer = bridge.get_shared_buffer(ctypes.c_uint8, size)
+            result = np.ctypeslib.as_array(buffer.buffer())
+            np.multiply(pixels, 255.0, out=pixels)
+            np.rint(pixels, out=pixels)
+            np.copyto(result, pixels, casting='unsafe')
+        else:
+            buffer = bridge.get_shared_buffer(ctypes.c_uint16, size)
+            result = np.ctypeslib.as_array(buffer.buffer()).view(np.float16)
+            np.copyto(result, pixels, casting='same_kind')
+    else:
+        buffer = bridge.get_shared_buffer(ctypes.c_float, size)
+        texture.pixels.foreach_get(buffer.as_np_array())
     
     MaltPipeline.get_bridge().load_texture(texture.name_full, buffer, (w,h), channels, sRGB)
     
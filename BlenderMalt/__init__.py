@@ -47,6 +47,39 @@ class Preferences(bpy.types.AddonPreferences):
         set=malt_path_setter('docs_path'), get=malt_path_getter('docs_path'))
     
     render_fps_cap : bpy.props.IntProperty(name="Max Viewport Render Framerate", default=30)
+
+    def update_mesh_vertex_format(self, context):
+        from . import MaltMeshes
+        MaltMeshes.reset_meshes()
+
+    optimize_meshes : bpy.props.BoolProperty(name="Optimize Meshes", default=False, update=update_mesh_vertex_format,
+        description="Weld duplicated vertices and reorder the mesh triangles and vertices for better GPU cache usage")
+
+    mesh_vertex_format : bpy.props.EnumProperty(name="Mesh Vertex Format", default='FULL', update=update_mesh_vertex_format,
+        items=[
+            ('FULL', 'Full Precision', 'Float vertex attributes and 32 bit indices'),
+            ('COMPACT', 'Compact', 'Snorm16 normals and tangents, half float UVs, 8 bit colors and 16 bit indices when possible'),
+            ('INTERLEAVED', 'Compact Interleaved', 'Compact formats, interleaved in a single vertex buffer'),
+        ],
+        description="Vertex format used to send meshes to the render server")
+    
+    def update_load_texture_files(self, context):
+        from . import MaltTextures
+        MaltTextures.reset_textures()
+
+    load_texture_files : bpy.props.BoolProperty(name="Decode Texture Files in the Render Server", default=True,
+        update=update_load_texture_files,
+        description="Image files are decoded by the render server in parallel, instead of sending the pixels from Blender.\n"
+        "Packed, generated and edited images are always sent from Blender")
+    
+    def update_render_server_processes(self, context):
+        if context.scene.render.engine == 'MALT':
+            context.scene.world.malt.update_pipeline(context)
+
+    render_server_processes : bpy.props.IntProperty(name="Render Server Processes", default=1, min=1, max=16,
+        update=update_render_server_processes,
+        description="Each viewport is rendered by one of the processes, in parallel with the others.\n"
+        "Every process loads its own copy of the scene resources")
     
     def update_debug_mode(self, context):
         if context.scene.render.engine == 'MALT':
@@ -76,6 +109,10 @@ class Preferences(bpy.types.AddonPreferences):
 
         layout.prop(self, "plugins_dir")
         layout.prop(self, "render_fps_cap")
+        layout.prop(self, "optimize_meshes")
+        layout.prop(self, "mesh_vertex_format")
+        layout.prop(self, "load_texture_files")
+        layout.prop(self, "render_server_processes")
         layout.prop(self, "setup_vs_code")
         layout.prop(self, "renderdoc_path")
         layout.label(text='Developer Settings :')
@@ -0,0 +1,209 @@
+import os, sys, time, ctypes, argparse
+
+# Renders Malt scene files (See Bridge.SceneFile) without Blender, using the render server Viewport.
+# Run from the Malt root folder, with the Malt dependencies in the import path:
+#   python -m Bridge.BatchRender scene.malt --frames 1-10 --output render/frame_####.exr
+# Each render output and AOV is written as a separate image, COLOR to the output path,
+# and the rest with their name as suffix (render/frame_0001_DEPTH.exr).
+# Images are written with OpenImageIO, or as .npy arrays if it's not available.
+# With --processes, frames are split between multiple render processes.
+
+def parse_frames(frames, available):
+    # "1-10,12,20-30:2" -> [1,...,10,12,20,22,...,30]
+    if frames is None:
+        return sorted(available)
+    result = []
+    for part in frames.split(','):
+        step = 1
+        if ':' in part:
+            part, step = part.split(':')
+            step = int(step)
+        if '-' in part[1:]:
+            start, end = part[0] + part[1:].split('-')[0], part[1:].split('-', 1)[1]
+            result.extend(range(int(start), int(end) + 1, step))
+        else:
+            result.append(int(part))
+    return result
+
+def get_output_path(template, frame, output_name):
+    root, extension = os.path.splitext(template)
+    padding = root.count('#')
+    if padding:
+        root = root.replace('#'*padding, str(frame).zfill(padding), 1)
+    else:
+        root += '_' + str(frame).zfill(4)
+    if output_name != 'COLOR':
+        root += '_' + output_name
+    return root + (extension or '.exr')
+
+def write_image(path, buffer, resolution, channels=4):
+    import numpy as np
+    w, h = resolution
+    pixels = np.ctypeslib.as_array(buffer.buffer()).reshape(h, w, channels)
+    # OpenGL images are stored bottom to top
+    # (astype also converts the ctypes based dtype, that OIIO doesn't accept)
+    pixels = pixels[::-1].astype(np.float32)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    try:
+        import OpenImageIO as oiio
+    except ImportError:
+        path = os.path.splitext(path)[0] + '.npy'
+        np.save(path, pixels)
+        return path
+    output = oiio.ImageOutput.create(path)
+    if output is None:
+        raise Exception('Failed to write {} : {}'.format(path, oiio.geterror()))
+    output.open(path, oiio.ImageSpec(w, h, channels, oiio.FLOAT))
+    success = output.write_image(pixels)
+    output.close()
+    if success == False:
+        raise Exception('Failed to write {} : {}'.format(path, output.geterror()))
+    return path
+
+def get_output_channels(output_name):
+    # The server converts every output to RGBA, except DEPTH (See Server.Viewport.ensure_correct_format)
+    return 1 if output_name == 'DEPTH' else 4
+
+def render_frame(viewport, frame_data, output_names, tile_size=0, tile_guard=0):
+    # Returns the rendered { output name : MemoryBuffer }
+    from Bridge.SceneFile import MemoryBuffer
+    w, h = frame_data['resolution']
+    buffers = {}
+    for name in output_names:
+        buffers[name] = MemoryBuffer(ctypes.c_float, w*h*get_output_channels(name))
+    viewport.set_tiling(tile_size, tile_guard)
+    viewport.setup(buffers, frame_data['resolution'], frame_data['scene'], True, False)
+    while viewport.render() == False:
+        continue
+    return buffers
+
+def write_frame(template, frame, buffers, resolution):
+    # Returns the written { output name : path }
+    paths = {}
+    for name, buffer in buffers.items():
+        paths[name] = write_image(get_output_path(template, frame, name), buffer, resolution, get_output_channels(name))
+    return paths
+
+def load_resources(pipeline, scene_file):
+    import Bridge.Mesh, Bridge.Texture, Bridge.Upload
+    for msg in scene_file['messages']:
+        msg_type = msg['msg_type']
+        if msg_type == 'MESH':
+            Bridge.Mesh.load_mesh(pipeline, msg)
+        elif msg_type == 'TEXTURE':
+            Bridge.Texture.load_texture(msg)
+        elif msg_type == 'TEXTURE FILE':
+            Bridge.Texture.load_texture_file(msg)
+        elif msg_type == 'GRADIENT':
+            Bridge.Texture.load_gradient(msg['name'], msg['pixels'], msg['nearest'])
+    Bridge.Texture.update_texture_files(wait=True)
+    Bridge.Upload.update(wait=True)
+
+def compile_materials(pipeline, scene_file):
+    # Materials are compiled from the sources stored in the scene file,
+    # but keep their original path, since that's how the scene references them
+    import tempfile
+    from Bridge.Material import Material
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for i, (path, source) in enumerate(sorted(scene_file['materials'].items())):
+            # Keep the file name, the material type is taken from its extension
+            source_path = os.path.join(temp_dir, str(i), os.path.basename(path))
+            os.makedirs(os.path.dirname(source_path))
+            with open(source_path, 'w', encoding='utf-8') as f:
+                f.write(source)
+            # Relative includes are still resolved from the original folder
+            compiled_material = pipeline.compile_material(source_path, [os.path.dirname(path)])
+            material = Material(path, pipeline, compiled_material=compiled_material)
+            if material.compiler_error:
+                LOG.error('MATERIAL COMPILATION ERROR ({}) :\n{}'.format(path, material.compiler_error))
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='Bridge.BatchRender', description='Render Malt scene files without Blender')
+    parser.add_argument('scene', help='Malt scene file path')
+    parser.add_argument('--output', default='//render/####.exr',
+        help="Output path template, '#' is replaced with the frame number and '//' with the scene file folder")
+    parser.add_argument('--frames', default=None, help='Frames to render (1-10,12,20-30:2), all the exported frames by default')
+    parser.add_argument('--samples-grid-size', type=int, default=None,
+        help="Overrides the 'Samples.Grid Size' world parameter, if the pipeline has it")
+    parser.add_argument('--pipeline', default=None, help='Overrides the pipeline path stored in the scene file')
+    parser.add_argument('--backend', default=None, choices=['GLFW', 'EGL', 'OSMESA'],
+        help='OpenGL context backend, selected automatically by default')
+    parser.add_argument('--processes', type=int, default=1, help='Number of render processes')
+    parser.add_argument('--tile-size', type=int, default=0, help='Render in tiles of this size, to bound the GPU memory usage')
+    parser.add_argument('--tile-guard', type=int, default=64, help='Extra pixels rendered around each tile')
+    args = parser.parse_args(args)
+
+    if args.processes > 1:
+        import multiprocessing
+        mp = multiprocessing.get_context('spawn')
+        processes = []
+        for i in range(args.processes):
+            process = mp.Process(target=render, args=(args, i, args.processes))
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+        if any(process.exitcode != 0 for process in processes):
+            sys.exit(1)
+    else:
+        render(args)
+
+def render(args, process_index=0, process_count=1):
+    # Renders every process_count frame, starting at process_index
+    import logging
+    log_prefix = 'Malt' if process_count == 1 else 'Malt {}'.format(process_index)
+    logging.basicConfig(level=logging.INFO, format=log_prefix + ' > %(message)s')
+
+    # Must be selected before importing OpenGL
+    from Bridge import Context
+    if args.backend:
+        os.environ['MALT_GL_BACKEND'] = args.backend
+    context = Context.create_context(Context.select_backend())
+
+    global LOG
+    from Malt.Utils import LOG
+    from Malt.PipelinePlugin import load_plugins_from_dir
+    from Bridge import SceneFile, Server
+
+    scene_path = os.path.abspath(args.scene)
+    scene_file = SceneFile.load(scene_path)
+    output = args.output
+    if output.startswith('//'):
+        output = os.path.join(os.path.dirname(scene_path), output[2:])
+
+    pipeline_path = args.pipeline or scene_file['pipeline_path']
+    LOG.info('INIT PIPELINE: ' + pipeline_path)
+    pipeline_class = Server.load_pipeline_class(pipeline_path)
+    plugins = []
+    for dir in scene_file['plugins_paths']:
+        plugins += load_plugins_from_dir(dir)
+    pipeline = pipeline_class(plugins)
+    render_outputs = pipeline.get_render_outputs()
+
+    start_time = time.perf_counter()
+    load_resources(pipeline, scene_file)
+    compile_materials(pipeline, scene_file)
+    LOG.info('SCENE LOADED : {:.2f} s'.format(time.perf_counter() - start_time))
+
+    viewport = Server.Viewport(pipeline, True, 32)
+    frames = parse_frames(args.frames, scene_file['frames'].keys())[process_index::process_count]
+    for frame in frames:
+        if frame not in scene_file['frames']:
+            LOG.warning('FRAME {} WAS NOT EXPORTED'.format(frame))
+            continue
+        frame_start = time.perf_counter()
+        frame_data = scene_file['frames'][frame]
+        scene = frame_data['scene']
+        if args.samples_grid_size and 'Samples.Grid Size' in scene.world_parameters:
+            scene.world_parameters['Samples.Grid Size'] = args.samples_grid_size
+
+        output_names = list(render_outputs.keys()) + list(frame_data['AOVs'].keys())
+        buffers = render_frame(viewport, frame_data, output_names, args.tile_size, args.tile_guard)
+        for path in write_frame(output, frame, buffers, frame_data['resolution']).values():
+            LOG.info('SAVED : {}'.format(path))
+        LOG.info('FRAME {} : {:.2f} s'.format(frame, time.perf_counter() - frame_start))
+
+    context.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import ctypes, time
+from collections import deque
+
+from Bridge.ipc import SharedBuffer
+
+# Shared buffers are allocated in power of two size classes and recycled through per class free lists.
+# A leased buffer goes back to its free list after release() is called and the server has released its copies.
+
+MIN_SIZE_CLASS = 64*1024
+# Seconds a free buffer is kept before closing it
+TRIM_TIME = 30.0
+TRIM_INTERVAL = 1.0
+# Seconds used to compute the allocation rate
+RATE_WINDOW = 10.0
+
+def get_size_class(size_in_bytes):
+    return max(MIN_SIZE_CLASS, 1 << (size_in_bytes - 1).bit_length())
+
+def is_released_by_server(buffer):
+    return buffer.is_released()
+
+class SharedBufferPool():
+
+    def __init__(self, trim_time=None):
+        self.trim_time = trim_time if trim_time is not None else TRIM_TIME
+        self.free = {} # size class : [(buffer, release time)]
+        self.leased = {} # buffer id : buffer
+        self.pending = [] # Released, but still in use by the server
+        self.last_trim = time.perf_counter()
+        self.allocations = deque() # (time, size)
+
+        self.bytes_leased = 0
+        self.bytes_pending = 0
+        self.bytes_cached = 0
+        self.allocated_count = 0
+        self.allocated_bytes = 0
+
+    def lease(self, ctype, size):
+        self.update()
+        size_class = get_size_class(ctypes.sizeof(ctype) * size)
+        buffer = None
+        free = self.free.get(size_class)
+        if free:
+            buffer, release_time = free.pop()
+            self.bytes_cached -= size_class
+        else:
+            buffer = SharedBuffer(ctypes.c_byte, size_class)
+            self.allocated_count += 1
+            self.allocated_bytes += size_class
+            self.allocations.append((time.perf_counter(), size_class))
+        buffer._ctype = ctype
+        buffer._size = size
+        self.leased[buffer.id] = buffer
+        self.bytes_leased += size_class
+        return buffer
+
+    def release(self, buffer):
+        if buffer is None or self.leased.pop(buffer.id, None) is None:
+            return
+        self.bytes_leased -= buffer._buffer.size
+        self.pending.append(buffer)
+        self.bytes_pending += buffer._buffer.size
+        self.update()
+
+    def update(self):
+        now = time.perf_counter()
+        if len(self.pending):
+            pending = []
+            for buffer in self.pending:
+                if is_released_by_server(buffer):
+                    self.bytes_pending -= buffer._buffer.size
+                    self.bytes_cached += buffer._buffer.size
+                    self.free.setdefault(buffer._buffer.size, []).append((buffer, now))
+                else:
+                    pending.append(buffer)
+            self.pending = pending
+        if now - self.last_trim > TRIM_INTERVAL:
+            self.trim(self.trim_time)
+
+    def trim(self, max_idle_time=0):
+        now = time.perf_counter()
+        self.last_trim = now
+        for size_class, free in self.free.items():
+            keep = []
+            for buffer, release_time in free:
+                if now - release_time < max_idle_time:
+                    keep.append((buffer, release_time))
+                else:
+                    self.bytes_cached -= size_class
+            free[:] = keep
+        SharedBuffer.GC()
+
+    def get_allocation_rate(self):
+        # Bytes per second
+        now = time.perf_counter()
+        while len(self.allocations) and now - self.allocations[0][0] > RATE_WINDOW:
+            self.allocations.popleft()
+        return sum(size for t, size in self.allocations) / RATE_WINDOW
+
+    def get_print_stats(self):
+        MB = 1024*1024
+        return '\n'.join((
+            'Leased : {:.1f} MB'.format(self.bytes_leased / MB),
+            'In use by server : {:.1f} MB'.format(self.bytes_pending / MB),
+            'Cached : {:.1f} MB'.format(self.bytes_cached / MB),
+            'Allocation rate : {:.1f} MB/s'.format(self.get_allocation_rate() / MB),
+            'Total allocated : {:.1f} MB ({} buffers)'.format(self.allocated_bytes / MB, self.allocated_count),
+        ))
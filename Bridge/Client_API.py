@@ -26,9 +26,27 @@ class IOCapture(io.StringIO):
         LOG.log(self.log_level, s)
         return super().write(s)
 
+class ServerProcess():
+    # A render server process, with its own connections and status
+
+    def __init__(self, index):
+        from .Status import Status
+        self.index = index
+        self.process = None
+        self.connections = {}
+        self.status = Status()
+
+    def send(self, msg, connection='MAIN'):
+        # Shared buffers must know which server they are sent to (See ipc.SharedBuffer)
+        SharedBuffer.server_index = self.index
+        self.connections[connection].send(msg)
+
 class Bridge():
+    # With more than one server process, viewports are pinned to a server (See get_server)
+    # while resources and materials are sent to all of them.
+    # The first server also handles final renders and shader reflection.
 
-    def __init__(self, pipeline_path, viewport_bit_depth=8, debug_mode=False, renderdoc_path=None, plugins_paths=[], docs_path=None):
+    def __init__(self, pipeline_path, viewport_bit_depth=8, debug_mode=False, renderdoc_path=None, plugins_paths=[], docs_path=None, processes=1):
         super().__init__()
 
         import sys
@@ -45,9 +63,17 @@ class Bridge():
         mp = multiprocessing.get_context('spawn')
 
         self.viewport_bit_depth = viewport_bit_depth
+        self.pipeline_path = pipeline_path
+        self.plugins_paths = plugins_paths
+        # Records the loaded resources while exporting a scene (See Bridge.SceneFile)
+        self.scene_writer = None
+        # Records every message sent to the server (See Bridge.Recording)
+        self.recorder = None
 
-        self.manager = mp.Manager()
-        self.shared_dict = self.manager.dict()
+        from .ipc import MAX_SERVERS
+        processes = max(1, min(processes, MAX_SERVERS))
+        self.servers = [ServerProcess(i) for i in range(processes)]
+        self.status = self.servers[0].status
         self.lock = None
         #SharedBuffer.setup_class(self.manager)
         self.connections = {}
@@ -57,57 +83,114 @@ class Bridge():
         self.graphs = {}
         self.render_outputs = {}
         self.render_buffers = {}
-        self.shared_buffers = []
+        from .BufferPool import SharedBufferPool
+        self.buffer_pool = SharedBufferPool()
+        self.scene_buffers = {}
+        # Mirrors the server mesh store (See Bridge.Mesh)
+        self.mesh_hashes = {}
+        self.mesh_references = {}
+        self.textures = 0 # Texture loads sent to each server
+        self.async_materials = {}
         self.id = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
 
         self.viewport_ids = []
+        self.read_results = {}
 
-        listeners = {}
-        bridge_to_malt = {}
-        malt_to_bridge = {}
-        
         import multiprocessing.connection as connection
-        def add_connection(name):
-            address = ('localhost', 0)
-            listener = connection.Listener(address)
-            address = listener.address
-            listeners[name] = listener
-            malt_to_bridge[name] = address
+        from . import start_server
 
-        for name in ['MAIN','REFLECTION']: add_connection(name)
+        listeners = {}
+        for server in self.servers:
+            listeners[server.index] = {}
+            malt_to_bridge = {}
+            for name in ['MAIN','REFLECTION','NOTIFY']:
+                listener = connection.Listener(('localhost', 0))
+                listeners[server.index][name] = listener
+                malt_to_bridge[name] = listener.address
 
-        from . import start_server
-        self.process = mp.Process(target=start_server, kwargs={
-            'pipeline_path': pipeline_path, 
-            'viewport_bit_depth': viewport_bit_depth, 
-            'connection_addresses': malt_to_bridge, 
-            'shared_dic': self.shared_dict,
-            'lock': self.lock,
-            'log_path': sys.stdout.log_path,
-            'debug_mode': debug_mode,
-            'renderdoc_path': renderdoc_path,
-            'plugins_paths': plugins_paths,
-            'docs_path': docs_path,
-        })
-        self.process.daemon = True
-        self.process.start()
+            SharedBuffer.server_index = server.index
+            server.process = mp.Process(target=start_server, kwargs={
+                'pipeline_path': pipeline_path, 
+                'viewport_bit_depth': viewport_bit_depth, 
+                'connection_addresses': malt_to_bridge, 
+                'status': server.status,
+                'lock': self.lock,
+                'log_path': sys.stdout.log_path,
+                'debug_mode': debug_mode,
+                'renderdoc_path': renderdoc_path,
+                'plugins_paths': plugins_paths,
+                # Only needs to be built once
+                'docs_path': docs_path if server.index == 0 else None,
+                'server_index': server.index,
+            })
+            server.process.daemon = True
+            server.process.start()
 
-        for name, listener in listeners.items():
-            bridge_to_malt[name] = listener.accept()
+        for server in self.servers:
+            for name, listener in listeners[server.index].items():
+                server.connections[name] = listener.accept()
+            server.status.connection = server.connections['NOTIFY']
         
-        self.connections = bridge_to_malt
+        self.connections = self.servers[0].connections
+        self.process = self.servers[0].process
 
-        params = self.connections['MAIN'].recv()
-        assert(params['msg_type'] == 'PARAMS')
-        self.parameters = params['params']
-        self.graphs = params['graphs']
-        self.render_outputs = params['outputs']
+        for server in self.servers:
+            params = server.connections['MAIN'].recv()
+            assert(params['msg_type'] == 'PARAMS')
+            if server.index == 0:
+                self.parameters = params['params']
+                self.graphs = params['graphs']
+                self.render_outputs = params['outputs']
         self.lost_connection = False
 
+    def get_server(self, viewport_id):
+        return self.servers[viewport_id % len(self.servers)]
+    
+    def send(self, msg, server=None):
+        # Sends to every server by default
+        # Meshes are recorded by load_mesh (See Recording.Recorder.add_mesh)
+        if self.recorder and msg['msg_type'] != 'MESH':
+            self.recorder.add(msg)
+        servers = self.servers if server is None else [server]
+        for server in servers:
+            server.send(msg)
     
+    def receive_material(self, block=True):
+        # Materials are compiled by every server, only the results from the first one are returned
+        from multiprocessing.connection import wait
+        main = self.connections['MAIN']
+        while True:
+            connections = [server.connections['MAIN'] for server in self.servers]
+            ready = wait(connections, None if block else 0)
+            if len(ready) == 0:
+                return None
+            for connection in ready:
+                msg = connection.recv()
+                assert(msg['msg_type'] == 'MATERIAL')
+                if connection is main:
+                    return msg
+    
+    @bridge_method
+    def start_recording(self, path):
+        # Resources loaded before the recording starts are not recorded, they must be loaded again
+        # Render buffers are sent again on the next render
+        from .Recording import Recorder
+        self.stop_recording()
+        self.recorder = Recorder(path, self.pipeline_path, self.plugins_paths, self.viewport_bit_depth)
+        for buffers in self.render_buffers.values():
+            buffers['__resolution'] = None
+    
+    @bridge_method
+    def stop_recording(self):
+        if self.recorder:
+            self.recorder.close()
+            LOG.info('RECORDING : {} messages saved to {}'.format(self.recorder.count, self.recorder.path))
+            self.recorder = None
+
     def __del__(self):
-        if self.process:
-            self.process.terminate()
+        for server in getattr(self, 'servers', []):
+            if server.process:
+                server.process.terminate()
         
     
     def get_parameters(self):
@@ -115,29 +198,37 @@ class Bridge():
     
     @bridge_method
     def get_stats(self):
-        if 'STATS' in self.shared_dict and self.shared_dict['STATS']:
-            return self.shared_dict['STATS']
+        if len(self.servers) == 1:
+            stats = self.status.get_stats()
         else:
-            return ''
+            stats = ''.join('Server {}:\n{}'.format(server.index, server.status.get_stats()) for server in self.servers)
+        return stats + 'Shared Memory:\n{}\n\n'.format(self.buffer_pool.get_print_stats())
 
     @bridge_method
     def compile_material(self, path, search_paths=[], custom_passes=[]):
-        self.connections['MAIN'].send({
+        self.send({
             'msg_type': 'MATERIAL',
             'path': path,
             'search_paths': search_paths,
             'custom_passes': custom_passes,
         })
-        return self.connections['MAIN'].recv()
+        while True:
+            msg = self.receive_material()
+            material = msg['material']
+            if material.path == path:
+                return msg
+            self.async_materials[material.path] = material
 
     @bridge_method
-    def compile_materials(self, paths, search_paths=[], async_compilation=False):
+    def compile_materials(self, paths, search_paths=[], async_compilation=False, priorities={}):
+        # Materials are compiled in priority order (lower first), unspecified priorities are 0
         for path in paths:
-            self.connections['MAIN'].send({
+            self.send({
                 'msg_type': 'MATERIAL',
                 'path': path,
                 'search_paths': search_paths,
                 'custom_passes': [],
+                'priority': priorities.get(path, 0),
             })
         results = {}
         received = []
@@ -150,8 +241,7 @@ class Bridge():
                         break
                 if completed:
                     break
-                msg = self.connections['MAIN'].recv()
-                assert(msg['msg_type'] == 'MATERIAL')
+                msg = self.receive_material()
                 material = msg['material']
                 results[material.path] = material
                 received.append(material.path)
@@ -159,10 +249,13 @@ class Bridge():
     
     @bridge_method
     def receive_async_compilation_materials(self):
-        results = {}
-        while self.connections['MAIN'].poll():
-            msg = self.connections['MAIN'].recv()
-            assert(msg['msg_type'] == 'MATERIAL')
+        # Materials are sent back by the server as soon as each one is compiled
+        results = self.async_materials
+        self.async_materials = {}
+        while True:
+            msg = self.receive_material(block=False)
+            if msg is None:
+                break
             material = msg['material']
             results[material.path] = material
         return results
@@ -177,64 +270,100 @@ class Bridge():
     
     @bridge_method
     def reload_graphs(self, graph_types):
-        self.connections['REFLECTION'].send({
-            'msg_type': 'GRAPH RELOAD',
-            'graph_types': graph_types
-        })
-        self.graphs.update(self.connections['REFLECTION'].recv())
+        for server in self.servers:
+            server.send({
+                'msg_type': 'GRAPH RELOAD',
+                'graph_types': graph_types
+            }, 'REFLECTION')
+        for server in self.servers:
+            graphs = server.connections['REFLECTION'].recv()
+            if server.index == 0:
+                self.graphs.update(graphs)
     
     @bridge_method
     def get_shared_buffer(self, ctype, size):
-        from . import ipc
-        #return ipc.SharedBuffer(ctype, size)
-        requested_size = ctypes.sizeof(ctype) * size
-        reuse_buffer = None
-        for buffer in self.shared_buffers:
-            release_flag = ctypes.c_bool.from_address(buffer._release_flag.data)
-            min_ref_count = 3 # shared_buffers + local buffer var + getrefcount ref
-            if release_flag.value == True and sys.getrefcount(buffer) == min_ref_count:
-                if buffer._buffer.size >= requested_size:
-                    if reuse_buffer is None or buffer._buffer.size < reuse_buffer._buffer.size:
-                        reuse_buffer = buffer
-        
-        if reuse_buffer is None:
-            min_size = 1024*1024
-            new_size = max(requested_size * 2, min_size)
-            reuse_buffer = ipc.SharedBuffer(ctypes.c_byte, new_size)
-            self.shared_buffers.append(reuse_buffer)
-        
-        ctypes.c_bool.from_address(reuse_buffer._release_flag.data).value = True
-        reuse_buffer._ctype = ctype
-        reuse_buffer._size = size
-        return reuse_buffer
+        # The buffer must be returned with release_shared_buffer.
+        # Buffers sent through load_mesh and load_texture are released automatically.
+        return self.buffer_pool.lease(ctype, size)
+    
+    @bridge_method
+    def release_shared_buffer(self, buffer):
+        # It will be reused once the server releases it too
+        self.buffer_pool.release(buffer)
 
     @bridge_method
-    def load_mesh(self, name, mesh_data):
-        self.connections['MAIN'].send({
-            'msg_type': 'MESH',
-            'name': name,
-            'data': mesh_data
-        })
+    def load_mesh(self, name, mesh_data, hash=None):
+        # Meshes with a content hash are only sent if the server doesn't have them already
+        from .Mesh import bind_mesh, get_mesh_buffers
+        if self.scene_writer:
+            self.scene_writer.add_mesh(name, mesh_data, hash)
+        if self.recorder:
+            self.recorder.add_mesh(name, mesh_data, hash)
+        if hash is None or self.mesh_hashes.get(name) != hash:
+            send_data = hash is None or self.mesh_references.get(hash, 0) == 0
+            self.send({
+                'msg_type': 'MESH',
+                'name': name,
+                'hash': hash,
+                'data': mesh_data if send_data else None,
+            })
+            bind_mesh(self.mesh_hashes, self.mesh_references, name, hash)
+        for buffer in get_mesh_buffers(mesh_data):
+            self.buffer_pool.release(buffer)
     
     @bridge_method
     def load_texture(self, name, buffer, resolution, channels, sRGB):
-        self.connections['MAIN'].send({
+        msg = {
             'msg_type': 'TEXTURE',
             'buffer': buffer,
             'name': name,
             'resolution': resolution,
             'channels': channels,
             'sRGB' : sRGB,
-        })
+        }
+        if self.scene_writer:
+            self.scene_writer.add_message(msg)
+        self.send(msg)
+        self.textures += 1
+        self.buffer_pool.release(buffer)
+
+    @bridge_method
+    def load_texture_file(self, name, path, sRGB, hash):
+        # The server decodes the file by itself (See Bridge.Texture.load_texture_file)
+        msg = {
+            'msg_type': 'TEXTURE FILE',
+            'name': name,
+            'path': path,
+            'sRGB' : sRGB,
+            'hash': hash,
+        }
+        if self.scene_writer:
+            self.scene_writer.add_message(msg)
+        self.send(msg)
+        self.textures += 1
+    
+    @bridge_method
+    def get_loaded_textures(self):
+        return sum(server.status.get_textures() for server in self.servers)
+    
+    @bridge_method
+    def has_pending_textures(self):
+        for server in self.servers:
+            if server.status.get_textures() != self.textures & 0xFFFFFFFF:
+                return True
+        return False
 
     @bridge_method
     def load_gradient(self, name, pixels, nearest):
-        self.connections['MAIN'].send({
+        msg = {
             'msg_type': 'GRADIENT',
             'name': name,
             'pixels': pixels,
             'nearest' : nearest,
-        })
+        }
+        if self.scene_writer:
+            self.scene_writer.add_message(msg)
+        self.send(msg)
 
     @bridge_method
     def get_viewport_id(self):
@@ -250,12 +379,19 @@ class Bridge():
         self.viewport_ids.remove(viewport_id)
 
     @bridge_method
-    def render(self, viewport_id, resolution, scene, scene_update, renderdoc_capture=False, AOVs={}):
+    def render(self, viewport_id, resolution, scene, scene_update, renderdoc_capture=False, AOVs={}, scene_delta=None,
+        tile_size=0, tile_guard=0):
+        # Final renders can be rendered in tile_size tiles, with tile_guard extra pixels around each one
         assert(viewport_id in self.viewport_ids or viewport_id == 0)
+        self.buffer_pool.update()
 
         new_buffers = None
         buffers = self.render_buffers.get(viewport_id)
         if buffers is None or buffers['__resolution'] != resolution or buffers['__AOVs'] != AOVs:
+            if buffers:
+                for key, buffer in buffers.items():
+                    if key.startswith('__') == False:
+                        self.buffer_pool.release(buffer)
             self.render_buffers[viewport_id] = {
                 '__resolution' : resolution,
                 '__AOVs' : AOVs
@@ -275,42 +411,76 @@ class Bridge():
                     break
             new_buffers = self.render_buffers[viewport_id]
 
-        if (viewport_id, 'SETUP') in self.shared_dict:
-            import time
-            start = time.perf_counter()
-            while self.shared_dict[(viewport_id, 'SETUP')] == False:
-                # Don't stack multiple render workloads for the same viewport
-                if time.perf_counter() - start > 1:
-                    #But don't stall Blender forever
-                    if new_buffers is None and scene_update == False:
-                        #Never skip new_buffers setup or scene update
-                        return
-                    else:
-                        break
+        server = self.get_server(viewport_id)
+        status = server.status
+        # Don't stack multiple render workloads for the same viewport
+        # But don't stall Blender forever
+        if status.wait(viewport_id, lambda: status.is_setup(viewport_id), timeout=1) == False:
+            if new_buffers is None and scene_update == False and scene_delta is None:
+                #Never skip new_buffers setup or scene updates
+                return
                 
-        self.shared_dict[(viewport_id, 'FINISHED')] = None
-        self.connections['MAIN'].send({
+        from copy import copy
+        if scene_update:
+            # Send the objects as contiguous arrays in shared memory, see Bridge.PackedScene
+            packed_objects = getattr(scene, 'packed_objects', None)
+            if packed_objects is None:
+                from .PackedScene import PackedObjects
+                packed_objects = PackedObjects()
+                packed_objects.add_objects(scene.objects)
+            if packed_objects.buffer is None:
+                packed_objects.pack(self.get_shared_buffer)
+            # Keep the buffer leased until the viewport receives a new scene
+            previous_buffer = self.scene_buffers.get(viewport_id)
+            if previous_buffer is not packed_objects.buffer:
+                self.buffer_pool.release(previous_buffer)
+                self.scene_buffers[viewport_id] = packed_objects.buffer
+            scene = copy(scene)
+            scene.objects = []
+            scene.packed_objects = packed_objects
+        else:
+            # The server only updates the camera, time and frame,
+            # plus the changes in scene_delta (See MaltRenderEngine.add_scene_delta)
+            scene = copy(scene)
+            scene.objects = []
+            scene.lights = []
+            scene.packed_objects = None
+            scene.proxys = {}
+
+        sequence = status.request_render(viewport_id)
+        self.send({
             'msg_type': 'RENDER',
             'viewport_id': viewport_id,
+            'sequence': sequence,
             'resolution': resolution,
             'scene': scene,
             'scene_update': scene_update,
+            'scene_delta': scene_delta,
             'new_buffers': new_buffers,
             'renderdoc_capture' : renderdoc_capture,
-        })
-        self.shared_dict[(viewport_id, 'SETUP')] = False
+            'tile_size': tile_size,
+            'tile_guard': tile_guard,
+        }, server)
 
     @bridge_method
     def render_result(self, viewport_id):
-        finished = False
-        if (viewport_id, 'FINISHED') in self.shared_dict:
-            finished = self.shared_dict[(viewport_id, 'FINISHED')] == True
-        
-        read_resolution = None
-        if (viewport_id, 'READ_RESOLUTION') in self.shared_dict:
-            read_resolution = self.shared_dict[viewport_id, 'READ_RESOLUTION']
+        status = self.get_server(viewport_id).status
+        finished = status.is_finished(viewport_id)
+        read_resolution = status.get_read_resolution(viewport_id)
+        self.read_results[viewport_id] = status.get_results(viewport_id)
         
         if viewport_id in self.render_buffers.keys():
             return self.render_buffers[viewport_id], finished, read_resolution
         else:
             return None, finished, read_resolution
+
+    @bridge_method
+    def wait_render_result(self, viewport_id, timeout=None):
+        # Wait until the render has finished or there's a new result since the last render_result call
+        # Returns False on timeout
+        status = self.get_server(viewport_id).status
+        def condition():
+            if status.is_finished(viewport_id):
+                return True
+            return status.get_results(viewport_id) != self.read_results.get(viewport_id)
+        return status.wait(viewport_id, condition, timeout)
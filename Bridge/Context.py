@@ -0,0 +1,221 @@
+import os, sys, time, ctypes
+
+# OpenGL context backends for the render server.
+# The backend can be forced with the MALT_GL_BACKEND environment variable (GLFW, EGL or OSMESA),
+# otherwise GLFW is used when there's a display, EGL when there isn't, and OSMesa as the last resort.
+# PyOpenGL loads the EGL and OSMesa entry points based on PYOPENGL_PLATFORM,
+# so select_backend must be called before OpenGL is imported (See Bridge.start_server).
+
+BACKENDS = ('GLFW', 'EGL', 'OSMESA')
+
+GL_VERSION = (4, 5)
+
+def has_display():
+    if sys.platform in ('win32', 'darwin'):
+        return True
+    return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+
+def has_library(name):
+    import ctypes.util
+    return ctypes.util.find_library(name) is not None
+
+def select_backend():
+    backend = os.environ.get('MALT_GL_BACKEND', '').upper()
+    if backend not in BACKENDS:
+        if has_display():
+            backend = 'GLFW'
+        elif has_library('EGL'):
+            backend = 'EGL'
+        elif has_library('OSMesa'):
+            backend = 'OSMESA'
+        else:
+            backend = 'GLFW'
+    if backend == 'EGL':
+        os.environ['PYOPENGL_PLATFORM'] = 'egl'
+        if has_display() == False:
+            # Mesa only, ignored by other drivers
+            os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+    elif backend == 'OSMESA':
+        os.environ['PYOPENGL_PLATFORM'] = 'osmesa'
+    return backend
+
+def create_context(backend):
+    return {
+        'GLFW' : GLFWContext,
+        'EGL' : EGLContext,
+        'OSMESA' : OSMesaContext,
+    }[backend]()
+
+
+class Context():
+    # Common interface, headless contexts don't have a default framebuffer to present,
+    # swap_buffers only throttles the render loop while it's idle
+
+    def __init__(self):
+        self.swap_interval = 0
+
+    def create_shared(self):
+        # Returns a new context that shares objects with this one, to be used from other threads
+        return None
+
+    def make_current(self):
+        pass
+
+    def set_swap_interval(self, interval):
+        self.swap_interval = interval
+
+    def swap_buffers(self):
+        from Malt.GL.GL import glFlush
+        glFlush()
+        if self.swap_interval > 0:
+            time.sleep(self.swap_interval / 60)
+
+    def poll_events(self):
+        pass
+
+    def should_close(self):
+        return False
+
+    def terminate(self):
+        pass
+
+
+class GLFWContext(Context):
+
+    def __init__(self, shared=None):
+        super().__init__()
+        self.swap_interval = None
+        import glfw
+        self.glfw = glfw
+        if shared is None:
+            glfw.ERROR_REPORTING = True
+            glfw.init()
+        glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, GL_VERSION[0])
+        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, GL_VERSION[1])
+        glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+        if shared:
+            glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+            self.window = glfw.create_window(1, 1, 'Malt Upload', None, shared.window)
+        else:
+            self.window = glfw.create_window(256, 256, 'Malt', None, None)
+        glfw.default_window_hints()
+        if not self.window:
+            raise Exception('Failed to create the GLFW window')
+        if shared is None:
+            glfw.make_context_current(self.window)
+            # Don't hide for better OS/Drivers schedule priority
+            #glfw.hide_window(window)
+            # Minimize instead:
+            glfw.iconify_window(self.window)
+
+    def create_shared(self):
+        return GLFWContext(self)
+
+    def make_current(self):
+        self.glfw.make_context_current(self.window)
+
+    def set_swap_interval(self, interval):
+        if interval != self.swap_interval:
+            self.swap_interval = interval
+            self.glfw.swap_interval(interval)
+
+    def swap_buffers(self):
+        self.glfw.swap_buffers(self.window)
+
+    def poll_events(self):
+        self.glfw.poll_events()
+
+    def should_close(self):
+        return self.glfw.window_should_close(self.window)
+
+    def terminate(self):
+        self.glfw.terminate()
+
+
+class EGLContext(Context):
+    # Surfaceless context when EGL_KHR_surfaceless_context is supported, 1x1 pbuffer otherwise
+
+    def __init__(self, shared=None):
+        super().__init__()
+        from OpenGL import EGL
+        self.EGL = EGL
+        if shared:
+            self.display = shared.display
+            self.config = shared.config
+        else:
+            self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+            major, minor = EGL.EGLint(), EGL.EGLint()
+            if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+                raise Exception('Failed to initialize EGL')
+            config_attributes = (EGL.EGLint * 5)(
+                EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                EGL.EGL_NONE
+            )
+            self.config = EGL.EGLConfig()
+            config_count = EGL.EGLint()
+            EGL.eglChooseConfig(self.display, config_attributes, ctypes.pointer(self.config), 1, ctypes.pointer(config_count))
+            if config_count.value == 0:
+                raise Exception('No EGL config with OpenGL support')
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        context_attributes = (EGL.EGLint * 7)(
+            EGL.EGL_CONTEXT_MAJOR_VERSION, GL_VERSION[0],
+            EGL.EGL_CONTEXT_MINOR_VERSION, GL_VERSION[1],
+            EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+            EGL.EGL_NONE
+        )
+        shared_context = shared.context if shared else EGL.EGL_NO_CONTEXT
+        self.context = EGL.eglCreateContext(self.display, self.config, shared_context, context_attributes)
+        if self.context == EGL.EGL_NO_CONTEXT:
+            raise Exception('Failed to create the EGL context')
+        self.surface = EGL.EGL_NO_SURFACE
+        extensions = EGL.eglQueryString(self.display, EGL.EGL_EXTENSIONS) or b''
+        if b'EGL_KHR_surfaceless_context' not in extensions.split():
+            surface_attributes = (EGL.EGLint * 5)(EGL.EGL_WIDTH, 1, EGL.EGL_HEIGHT, 1, EGL.EGL_NONE)
+            self.surface = EGL.eglCreatePbufferSurface(self.display, self.config, surface_attributes)
+        if shared is None:
+            self.make_current()
+
+    def create_shared(self):
+        return EGLContext(self)
+
+    def make_current(self):
+        if not self.EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context):
+            raise Exception('Failed to make the EGL context current')
+
+    def terminate(self):
+        self.EGL.eglTerminate(self.display)
+
+
+class OSMesaContext(Context):
+    # Software rendering, mostly useful for testing
+
+    def __init__(self, shared=None):
+        super().__init__()
+        from OpenGL import osmesa, arrays
+        from OpenGL.GL import GL_UNSIGNED_BYTE
+        self.osmesa = osmesa
+        attributes = (ctypes.c_int * 9)(
+            osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+            osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+            osmesa.OSMESA_CONTEXT_MAJOR_VERSION, GL_VERSION[0],
+            osmesa.OSMESA_CONTEXT_MINOR_VERSION, GL_VERSION[1],
+            0
+        )
+        self.context = osmesa.OSMesaCreateContextAttribs(attributes, shared.context if shared else None)
+        if not self.context:
+            raise Exception('Failed to create the OSMesa context')
+        self.buffer = arrays.GLubyteArray.zeros((1, 1, 4))
+        self.buffer_type = GL_UNSIGNED_BYTE
+        if shared is None:
+            self.make_current()
+
+    def create_shared(self):
+        return OSMesaContext(self)
+
+    def make_current(self):
+        if not self.osmesa.OSMesaMakeCurrent(self.context, self.buffer, self.buffer_type, 1, 1):
+            raise Exception('Failed to make the OSMesa context current')
+
+    def terminate(self):
+        self.osmesa.OSMesaDestroyContext(self.context)
@@ -1,15 +1,17 @@
 from Malt.PipelineParameters import Parameter
+from Malt.Utils import LOG
 
 MATERIAL_SHADERS = {}
 
 class Material():
 
-    def __init__(self, path, pipeline, search_paths=[], custom_passes={}):
+    def __init__(self, path, pipeline, search_paths=[], custom_passes={}, compiled_material=None):
         self.path = path
         self.parameters = {}
         self.compiler_error = ''
         
-        compiled_material = pipeline.compile_material(path, search_paths)#, custom_passes)
+        if compiled_material is None:
+            compiled_material = pipeline.compile_material(path, search_paths)#, custom_passes)
         
         if isinstance(compiled_material, str):
             self.compiler_error = compiled_material
@@ -50,3 +52,152 @@ def get_shader(path, parameters):
                 pass_shader_copy.uniforms[name].set_value(parameter)
     
     return new_shader
+
+
+# Number of preprocessing worker processes, None uses the CPU count
+COMPILE_PROCESSES = None
+# Max time spent linking programs on each Server loop iteration
+LINK_TIME_BUDGET = 1.0 / 30.0
+
+
+def _get_worker_count():
+    import os
+    return COMPILE_PROCESSES or max(1, (os.cpu_count() or 2) - 1)
+
+def _init_preprocess_worker(preprocessor_settings):
+    from Malt.GL import Shader, ShaderCache
+    Shader.PREPROCESSOR_BACKEND = preprocessor_settings['backend']
+    ShaderCache.PREPROCESSOR_CACHE_ENABLED = preprocessor_settings['cache_enabled']
+    ShaderCache.PREPROCESSOR_CACHE_PATH = preprocessor_settings['cache_path']
+    ShaderCache.PREPROCESSOR_CACHE_MAX_SIZE = preprocessor_settings['cache_max_size']
+
+def _preprocess_material(params):
+    from Malt.GL.Shader import preprocess_source
+    try:
+        return [preprocess_source(*p) for p in params]
+    except Exception as e:
+        import traceback
+        LOG.error(traceback.format_exc())
+        return str(e)
+
+
+class CompileJob():
+
+    def __init__(self, path, search_paths, custom_passes, priority, order):
+        self.path = path
+        self.search_paths = search_paths
+        self.custom_passes = custom_passes
+        self.priority = priority
+        self.order = order
+        self.material_type = None
+        self.future = None
+        self.preprocessed = None
+
+
+class CompileScheduler():
+    # Preprocesses materials on a process pool and links them on the OpenGL thread,
+    # in priority order (lower first) and within a time budget, so the Server can keep rendering between compiles.
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.executor = None
+        self.jobs = {}
+        self.order = 0
+    
+    def get_executor(self):
+        if self.executor is None:
+            from Malt.GL import Shader, ShaderCache
+            preprocessor_settings = {
+                'backend': Shader.PREPROCESSOR_BACKEND,
+                'cache_enabled': ShaderCache.PREPROCESSOR_CACHE_ENABLED,
+                'cache_path': ShaderCache.PREPROCESSOR_CACHE_PATH,
+                'cache_max_size': ShaderCache.PREPROCESSOR_CACHE_MAX_SIZE,
+            }
+            processes = _get_worker_count()
+            import multiprocessing
+            # Daemonic processes (like the render server) can't have children.
+            # ProcessPoolExecutor doesn't fail until the first submit, so check it beforehand.
+            if multiprocessing.current_process().daemon == False:
+                try:
+                    from concurrent.futures import ProcessPoolExecutor
+                    self.executor = ProcessPoolExecutor(processes, multiprocessing.get_context('spawn'),
+                        _init_preprocess_worker, (preprocessor_settings,))
+                except:
+                    import traceback
+                    LOG.warning(traceback.format_exc())
+            if self.executor is None:
+                # The preprocessor still runs in parallel with the MCPP backend, since it's a subprocess
+                LOG.info('Material preprocessing runs on threads')
+                from concurrent.futures import ThreadPoolExecutor
+                self.executor = ThreadPoolExecutor(processes)
+        return self.executor
+    
+    def add(self, path, search_paths=[], custom_passes=[], priority=0):
+        # A newer request for the same path replaces the previous one
+        job = CompileJob(path, search_paths, custom_passes, priority, self.order)
+        self.order += 1
+        self.jobs[path] = job
+        try:
+            job.material_type, params = self.pipeline.get_material_preprocess_params(path, search_paths)
+            job.future = self.submit(params)
+        except Exception as e:
+            import traceback
+            LOG.error(traceback.format_exc())
+            job.preprocessed = str(e)
+    
+    def submit(self, params):
+        from concurrent.futures import ThreadPoolExecutor
+        executor = self.get_executor()
+        try:
+            return executor.submit(_preprocess_material, params)
+        except:
+            if isinstance(executor, ThreadPoolExecutor):
+                raise
+            # The process pool can't start workers, fall back to threads
+            import traceback
+            LOG.warning(traceback.format_exc())
+            LOG.warning('Material preprocessing falls back to threads')
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = ThreadPoolExecutor(_get_worker_count())
+            return self.executor.submit(_preprocess_material, params)
+    
+    def is_empty(self):
+        return len(self.jobs) == 0
+    
+    def poll(self, time_budget=None):
+        # Returns the materials linked in this call
+        import time
+        if time_budget is None:
+            time_budget = LINK_TIME_BUDGET
+        start_time = time.perf_counter()
+        ready = []
+        for job in self.jobs.values():
+            if job.future and job.future.done():
+                try:
+                    job.preprocessed = job.future.result()
+                except Exception as e:
+                    # The worker process died
+                    import traceback
+                    LOG.error(traceback.format_exc())
+                    job.preprocessed = str(e)
+                job.future = None
+            if job.preprocessed is not None:
+                ready.append(job)
+        ready.sort(key=lambda job: (job.priority, job.order))
+        
+        materials = []
+        for job in ready:
+            if materials and time.perf_counter() - start_time > time_budget:
+                break
+            self.jobs.pop(job.path)
+            if isinstance(job.preprocessed, str):
+                compiled_material = job.preprocessed
+            else:
+                compiled_material = self.pipeline.compile_material_from_preprocessed(job.material_type, job.preprocessed)
+            materials.append(Material(job.path, self.pipeline, job.search_paths, job.custom_passes, compiled_material))
+        return materials
+    
+    def shutdown(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -1,14 +1,76 @@
 MESHES = {}
 
+# Meshes are stored by their content hash, so objects with the same geometry share the same GPU buffers.
+# Bridge.Client_API.Bridge mirrors these tables to skip sending meshes the server already has.
+MESH_STORE = {}
+MESH_HASHES = {}
+MESH_REFERENCES = {}
+
+# Also used by the Bridge, so both sides agree on which meshes the server holds
+def bind_mesh(hashes, references, name, hash):
+    # Returns the hash that is no longer referenced, if any
+    previous = hashes.pop(name, None)
+    if hash is not None:
+        hashes[name] = hash
+        references[hash] = references.get(hash, 0) + 1
+    if previous is not None:
+        references[previous] -= 1
+        if references[previous] == 0:
+            del references[previous]
+            return previous
+    return None
+
+def get_mesh_buffers(mesh_data):
+    from Malt.Utils import IBuffer
+    for value in mesh_data.values():
+        values = value if isinstance(value, list) else [value]
+        for buffer in values:
+            if isinstance(buffer, IBuffer):
+                yield buffer
+
+# Meshes are uploaded asynchronously (See Bridge.Upload), MESHES is only updated once they're ready
+__MESH_VERSIONS = {} # name : version of the last message received
+
 def load_mesh(pipeline, msg):
+    from Bridge import Upload
     name = msg['name']
+    hash = msg.get('hash')
     data = msg['data']
 
-    MESHES[name] = pipeline.load_mesh(
-        position = data['positions'],
-        indices = data['indices'],
-        normal = data['normals'],
-        tangent = data['tangents'],
-        uvs = data['uvs'],
-        colors = data['colors']
-    )
+    unreferenced = bind_mesh(MESH_HASHES, MESH_REFERENCES, name, hash)
+    if unreferenced:
+        MESH_STORE.pop(unreferenced, None)
+    version = __MESH_VERSIONS.get(name, 0) + 1
+    __MESH_VERSIONS[name] = version
+
+    if data is None:
+        # If it's still uploading, MESHES is updated on publish
+        if hash in MESH_STORE:
+            MESHES[name] = MESH_STORE[hash]
+        return
+
+    def upload():
+        return pipeline.load_mesh(
+            position = data['positions'],
+            indices = data['indices'],
+            normal = data['normals'],
+            tangent = data['tangents'],
+            uvs = data['uvs'],
+            colors = data['colors'],
+            layout = data.get('layout', {}),
+            vertices = data.get('vertices'),
+        )
+    
+    def publish(meshes):
+        if meshes is None:
+            return
+        if hash is None:
+            if __MESH_VERSIONS.get(name) == version:
+                MESHES[name] = meshes
+        elif hash in MESH_REFERENCES:
+            MESH_STORE[hash] = meshes
+            for mesh_name, mesh_hash in MESH_HASHES.items():
+                if mesh_hash == hash:
+                    MESHES[mesh_name] = meshes
+    
+    Upload.submit('MESH', upload, publish)
@@ -0,0 +1,116 @@
+import ctypes, array
+
+from Malt.Scene import Object
+
+class PackedObjects():
+    # Scene objects packed into contiguous arrays inside a single SharedBuffer.
+    # Meshes, materials, parameters and tags are stored in tables (deduplicated by identity),
+    # so only the tables are pickled when the scene is sent to the server.
+
+    LAYOUT = [
+        # name, array typecode, ctype, elements per object
+        ('matrices', 'f', ctypes.c_float, 16),
+        ('ids', 'I', ctypes.c_uint, 1),
+        ('meshes', 'I', ctypes.c_uint, 1),
+        ('materials', 'I', ctypes.c_uint, 1),
+        ('parameters', 'I', ctypes.c_uint, 1),
+        ('tags', 'I', ctypes.c_uint, 1),
+        ('mirror_scales', 'B', ctypes.c_ubyte, 1),
+    ]
+
+    def __init__(self):
+        self.count = 0
+        self.buffer = None
+        self.offsets = {}
+        self.tables = {
+            'meshes': [],
+            'materials': [],
+            'parameters': [],
+            'tags': [],
+        }
+        self._arrays = { name : array.array(typecode) for name, typecode, ctype, size in self.LAYOUT }
+        self._handles = {}
+
+    def get_handle(self, table_name, value):
+        key = (table_name, id(value))
+        handle = self._handles.get(key)
+        if handle is None:
+            table = self.tables[table_name]
+            handle = len(table)
+            table.append(value)
+            self._handles[key] = handle
+        return handle
+
+    def add(self, matrix, id, mesh, material, parameters, mirror_scale, tags):
+        # matrix is a flat sequence of 16 floats
+        arrays = self._arrays
+        arrays['matrices'].extend(matrix)
+        arrays['ids'].append(id)
+        arrays['meshes'].append(self.get_handle('meshes', mesh))
+        arrays['materials'].append(self.get_handle('materials', material))
+        arrays['parameters'].append(self.get_handle('parameters', parameters))
+        arrays['tags'].append(self.get_handle('tags', tags))
+        arrays['mirror_scales'].append(1 if mirror_scale else 0)
+        self.count += 1
+
+    def add_objects(self, objects):
+        for obj in objects:
+            parameters = obj.parameters
+            id = parameters.get('ID', 0)
+            if 'ID' in parameters:
+                parameters = { k:v for k,v in parameters.items() if k != 'ID' }
+            self.add(obj.matrix, id, obj.mesh, obj.material, parameters, obj.mirror_scale, obj.tags)
+
+    def pack(self, get_shared_buffer):
+        size = 0
+        for name, typecode, ctype, element_size in self.LAYOUT:
+            # Keep every array 16 bytes aligned
+            size = (size + 15) // 16 * 16
+            self.offsets[name] = size
+            size += ctypes.sizeof(ctype) * element_size * self.count
+        self.buffer = get_shared_buffer(ctypes.c_byte, max(size, 1))
+        address = ctypes.addressof(self.buffer.buffer())
+        for name, data in self._arrays.items():
+            if len(data):
+                address_info = data.buffer_info()
+                ctypes.memmove(address + self.offsets[name], address_info[0], address_info[1] * data.itemsize)
+        self._arrays = None
+        self._handles = None
+
+    def get_array(self, name):
+        for _name, typecode, ctype, element_size in self.LAYOUT:
+            if _name == name:
+                address = ctypes.addressof(self.buffer.buffer()) + self.offsets[name]
+                if element_size > 1:
+                    ctype = ctype * element_size
+                return (ctype * self.count).from_address(address)
+
+    def __getstate__(self):
+        assert(self.buffer is not None) # pack() must be called first
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        state['_handles'] = None
+        return state
+
+    def unpack(self):
+        # The returned object matrices point to the SharedBuffer memory
+        matrices = self.get_array('matrices')
+        ids = self.get_array('ids')
+        meshes = self.get_array('meshes')
+        materials = self.get_array('materials')
+        parameters = self.get_array('parameters')
+        tags = self.get_array('tags')
+        mirror_scales = self.get_array('mirror_scales')
+
+        mesh_table = self.tables['meshes']
+        material_table = self.tables['materials']
+        parameters_table = self.tables['parameters']
+        tags_table = self.tables['tags']
+
+        objects = []
+        for i in range(self.count):
+            obj_parameters = dict(parameters_table[parameters[i]])
+            obj_parameters['ID'] = ids[i]
+            objects.append(Object(matrices[i], mesh_table[meshes[i]], material_table[materials[i]],
+                obj_parameters, mirror_scales[i] == 1, tags_table[tags[i]]))
+        return objects
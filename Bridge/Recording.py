@@ -0,0 +1,83 @@
+import gzip, pickle, time
+
+from Bridge.SceneFile import MemoryBuffer, copy_buffers, copy_scene
+
+# Recordings of the messages sent to the render server, to reproduce and benchmark sessions without Blender
+# (See Bridge.Replay and Bridge.Client_API.Bridge.start_recording).
+# The file is a gzip stream of pickled records, the header first and then a (time, msg) tuple per message,
+# with the time in seconds since the recording started.
+# SharedBuffers are copied into MemoryBuffers, except the render target buffers, since their content
+# is written by the server.
+
+VERSION = 1
+
+# Faster compression, recordings are written while the user works in Blender
+COMPRESS_LEVEL = 1
+
+def copy_message(msg):
+    msg = dict(msg)
+    if msg['msg_type'] == 'RENDER':
+        new_buffers = msg['new_buffers']
+        if new_buffers:
+            msg['new_buffers'] = { k : MemoryBuffer(v.ctype(), len(v)) if k.startswith('__') == False else v
+                for k, v in new_buffers.items() }
+        msg['scene'] = copy_scene(msg['scene'])
+        return msg
+    return copy_buffers(msg)
+
+class Recorder():
+
+    def __init__(self, path, pipeline_path, plugins_paths, viewport_bit_depth):
+        self.path = path
+        self.file = gzip.open(path, 'wb', compresslevel=COMPRESS_LEVEL)
+        self.start_time = time.perf_counter()
+        self.count = 0
+        # Mirrors the mesh store of the replay server, which starts empty (See Bridge.Mesh)
+        self.mesh_hashes = {}
+        self.mesh_references = {}
+        pickle.dump({
+            'version': VERSION,
+            'pipeline_path': pipeline_path,
+            'plugins_paths': list(plugins_paths),
+            'viewport_bit_depth': viewport_bit_depth,
+        }, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def add(self, msg):
+        # Must be called before the message is sent, buffers can be reused after that
+        record = (time.perf_counter() - self.start_time, copy_message(msg))
+        pickle.dump(record, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def add_mesh(self, name, mesh_data, hash=None):
+        # Meshes are recorded even if the live server already has them
+        from .Mesh import bind_mesh
+        if hash is None or self.mesh_hashes.get(name) != hash:
+            send_data = hash is None or self.mesh_references.get(hash, 0) == 0
+            self.add({
+                'msg_type': 'MESH',
+                'name': name,
+                'hash': hash,
+                'data': mesh_data if send_data else None,
+            })
+            bind_mesh(self.mesh_hashes, self.mesh_references, name, hash)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def read(path):
+    # Returns the recording header and a generator of (time, msg) records
+    file = gzip.open(path, 'rb')
+    header = pickle.load(file)
+    if header.get('version') != VERSION:
+        file.close()
+        raise Exception('Unsupported Malt recording version : {}'.format(header.get('version')))
+    def records():
+        with file:
+            while True:
+                try:
+                    yield pickle.load(file)
+                except EOFError:
+                    return
+    return header, records()
@@ -0,0 +1,191 @@
+import os, time, json, argparse
+
+# Replays a render server recording (See Bridge.Recording) without Blender and reports the timings.
+# Run from the Malt root folder, with the Malt dependencies in the import path:
+#   python -m Bridge.Replay session.maltrec [--realtime] [--json timings.json]
+# By default messages are replayed as fast as possible, waiting for every frame to finish before the next message,
+# so frame timings are comparable between runs. With --realtime, messages are replayed with their original timing
+# and the viewports render progressively in between, like in the live server.
+
+class Timings():
+
+    def __init__(self):
+        self.messages = {} # msg_type : [seconds]
+        self.frames = {} # viewport_id : [(seconds, samples)]
+        self.pending_frames = {} # viewport_id : [start time, samples]
+        self.skipped = 0
+
+    def add_message(self, msg_type, seconds):
+        self.messages.setdefault(msg_type, []).append(seconds)
+
+    def start_frame(self, viewport_id):
+        self.pending_frames[viewport_id] = [time.perf_counter(), 0]
+
+    def add_frame(self, viewport_id, seconds, samples):
+        self.frames.setdefault(viewport_id, []).append((seconds, samples))
+
+    def update_frames(self, finished):
+        for viewport_id, frame in list(self.pending_frames.items()):
+            frame[1] += 1
+            if viewport_id in finished:
+                self.add_frame(viewport_id, time.perf_counter() - frame[0], frame[1])
+                del self.pending_frames[viewport_id]
+
+    def get_report(self):
+        def stats(values):
+            values = sorted(values)
+            return {
+                'count': len(values),
+                'total_ms': sum(values) * 1000,
+                'mean_ms': sum(values) / len(values) * 1000,
+                'median_ms': values[len(values) // 2] * 1000,
+                'max_ms': values[-1] * 1000,
+            }
+        report = {
+            'messages': { k : stats(v) for k, v in self.messages.items() },
+            'frames': {},
+            'skipped': self.skipped,
+        }
+        for viewport_id, frames in self.frames.items():
+            report['frames'][viewport_id] = stats([seconds for seconds, samples in frames])
+            report['frames'][viewport_id]['samples'] = sum(samples for seconds, samples in frames)
+        return report
+
+def format_report(report):
+    lines = []
+    row = '{:<16}{:>8}{:>12}{:>12}{:>12}{:>12}'
+    header = row.format('', 'COUNT', 'TOTAL ms', 'MEAN ms', 'MEDIAN ms', 'MAX ms')
+    def format_stats(name, stats):
+        return row.format(name, stats['count'], *('{:.2f}'.format(stats[key])
+            for key in ('total_ms', 'mean_ms', 'median_ms', 'max_ms')))
+    lines += ['MESSAGES', header]
+    for msg_type, stats in sorted(report['messages'].items()):
+        lines.append(format_stats(msg_type, stats))
+    lines += ['', 'FRAMES', header]
+    for viewport_id, stats in sorted(report['frames'].items()):
+        name = 'Final Render' if viewport_id == 0 else 'Viewport {}'.format(viewport_id)
+        lines.append(format_stats(name, stats))
+    if report['skipped']:
+        lines += ['', 'SKIPPED : {} renders for viewports created before the recording started'.format(report['skipped'])]
+    return '\n'.join(lines)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='Bridge.Replay', description='Replay a Malt render server recording')
+    parser.add_argument('recording', help='Recording file path (.maltrec)')
+    parser.add_argument('--realtime', action='store_true', help='Replay the messages with their original timing')
+    parser.add_argument('--json', default=None, help='Save the timings report as json')
+    parser.add_argument('--pipeline', default=None, help='Overrides the pipeline path stored in the recording')
+    parser.add_argument('--backend', default=None, choices=['GLFW', 'EGL', 'OSMESA'],
+        help='OpenGL context backend, selected automatically by default')
+    args = parser.parse_args(args)
+
+    import logging
+    logging.basicConfig(level=logging.INFO, format='Malt > %(message)s')
+
+    # Must be selected before importing OpenGL
+    from Bridge import Context
+    if args.backend:
+        os.environ['MALT_GL_BACKEND'] = args.backend
+    context = Context.create_context(Context.select_backend())
+
+    from Malt.Utils import LOG
+    from Malt.PipelinePlugin import load_plugins_from_dir
+    import Bridge.Material, Bridge.Upload
+    from Bridge import Recording, Server
+    from Bridge.Status import Status
+
+    # Same setup as Server.main
+    upload_context = None
+    try:
+        upload_context = context.create_shared()
+    except:
+        import traceback
+        LOG.error(traceback.format_exc())
+    if upload_context:
+        Bridge.Upload.init(upload_context)
+    context.set_swap_interval(0)
+
+    header, records = Recording.read(args.recording)
+
+    pipeline_path = args.pipeline or header['pipeline_path']
+    LOG.info('INIT PIPELINE: ' + pipeline_path)
+    pipeline_class = Server.load_pipeline_class(pipeline_path)
+    plugins = []
+    for dir in header['plugins_paths']:
+        plugins += load_plugins_from_dir(dir)
+    pipeline = pipeline_class(plugins)
+    new_pipeline = lambda: pipeline_class(plugins)
+    viewport_bit_depth = header['viewport_bit_depth']
+
+    viewports = {}
+    compile_scheduler = Bridge.Material.CompileScheduler(pipeline)
+    status = Status()
+    timings = Timings()
+
+    def update():
+        # A Server.main loop iteration, returns True if every viewport has finished
+        Server.update_uploads(viewports, status)
+        if compile_scheduler.is_empty() == False:
+            compile_scheduler.poll()
+        finished, active = Server.render_viewports(viewports, status)
+        timings.update_frames(finished)
+        context.swap_buffers()
+        return len(finished) == len(viewports)
+
+    def compile_materials():
+        if compile_scheduler.is_empty():
+            return
+        start = time.perf_counter()
+        while compile_scheduler.is_empty() == False:
+            compile_scheduler.poll()
+        timings.add_message('COMPILE', time.perf_counter() - start)
+
+    replay_start = time.perf_counter()
+    for record_time, msg in records:
+        msg_type = msg['msg_type']
+        if args.realtime:
+            while time.perf_counter() - replay_start < record_time:
+                if update():
+                    time.sleep(0.001)
+        elif msg_type == 'RENDER':
+            # Don't measure frames rendered with the materials still compiling
+            compile_materials()
+
+        if msg_type == 'RENDER' and msg['viewport_id'] not in viewports and msg['new_buffers'] is None:
+            timings.skipped += 1
+            continue
+
+        start = time.perf_counter()
+        Server.handle_message(msg, pipeline, new_pipeline, viewport_bit_depth, viewports, compile_scheduler, status)
+        seconds = time.perf_counter() - start
+        timings.add_message(msg_type, seconds)
+
+        if msg_type == 'RENDER':
+            if msg['viewport_id'] == 0:
+                # Final renders are rendered by handle_message
+                timings.add_frame(0, seconds, 1)
+            else:
+                timings.start_frame(msg['viewport_id'])
+
+        if args.realtime == False:
+            while update() == False:
+                continue
+
+    compile_materials()
+    while update() == False:
+        continue
+
+    report = timings.get_report()
+    report['recording'] = os.path.abspath(args.recording)
+    report['realtime'] = args.realtime
+    report['total_ms'] = (time.perf_counter() - replay_start) * 1000
+    LOG.info('REPLAY : {}\n\n{}\n\nTOTAL : {:.2f} ms'.format(args.recording, format_report(report), report['total_ms']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    compile_scheduler.shutdown()
+    context.terminate()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import ctypes, pickle
+
+from Malt.Utils import IBuffer
+
+# Malt scene files store everything the render server needs to render a scene without Blender
+# (See Bridge.BatchRender).
+# Resources are stored as the Bridge messages the server would receive (MESH, TEXTURE, TEXTURE FILE and GRADIENT),
+# with their SharedBuffers copied into MemoryBuffers. Frames store the same Scene sent to the server for F12 renders.
+# Material sources are stored too, since node tree materials are generated in the system temp folder for unsaved files.
+# Texture files and the files included by materials (pipeline and node tree libraries) are stored by path,
+# so they must be reachable from the machine that renders the scene.
+
+VERSION = 2
+
+class MemoryBuffer(IBuffer):
+    # IBuffer stored in process memory, pickled by value
+
+    def __init__(self, ctype, size, data=None):
+        self._ctype = ctype
+        self._size = size
+        if data is None:
+            self._data = bytearray(ctypes.sizeof(ctype) * size)
+        else:
+            self._data = bytearray(data)
+
+    @classmethod
+    def copy(cls, buffer):
+        return cls(buffer.ctype(), len(buffer), buffer.buffer())
+
+    def ctype(self):
+        return self._ctype
+
+    def __len__(self):
+        return self._size
+
+    def buffer(self):
+        return (self._ctype*self._size).from_buffer(self._data)
+
+def copy_buffers(value):
+    if isinstance(value, IBuffer):
+        return MemoryBuffer.copy(value)
+    if isinstance(value, dict):
+        return { k : copy_buffers(v) for k, v in value.items() }
+    if isinstance(value, (list, tuple)):
+        return type(value)(copy_buffers(v) for v in value)
+    return value
+
+def copy_scene(scene):
+    # Shallow copy, with the packed objects stored in a MemoryBuffer
+    from copy import copy
+    scene = copy(scene)
+    packed_objects = getattr(scene, 'packed_objects', None)
+    if packed_objects:
+        if packed_objects.buffer is None:
+            packed_objects.pack(MemoryBuffer)
+        elif isinstance(packed_objects.buffer, MemoryBuffer) == False:
+            packed_objects = copy(packed_objects)
+            packed_objects.buffer = MemoryBuffer.copy(packed_objects.buffer)
+            scene.packed_objects = packed_objects
+    return scene
+
+class SceneWriter():
+    # Set as Bridge.scene_writer to record the Bridge messages
+
+    def __init__(self, pipeline_path, plugins_paths=[]):
+        self.pipeline_path = pipeline_path
+        self.plugins_paths = list(plugins_paths)
+        self.messages = []
+        self.mesh_hashes = set()
+        self.frames = {} # frame : { resolution, scene, AOVs }
+        self.materials = {} # path : source
+
+    def add_message(self, msg):
+        self.messages.append(copy_buffers(msg))
+
+    def add_mesh(self, name, mesh_data, hash=None):
+        # Meshes with the same hash are only stored once
+        data = None
+        if hash is None or hash not in self.mesh_hashes:
+            data = copy_buffers(mesh_data)
+        if hash is not None:
+            self.mesh_hashes.add(hash)
+        self.messages.append({
+            'msg_type': 'MESH',
+            'name': name,
+            'hash': hash,
+            'data': data,
+        })
+
+    def add_frame(self, frame, resolution, scene, AOVs={}):
+        from Bridge.Proxys import MaterialProxy
+        for proxy in scene.proxys.values():
+            if isinstance(proxy, MaterialProxy) and proxy.path and proxy.path not in self.materials:
+                with open(proxy.path, 'r', encoding='utf-8') as f:
+                    self.materials[proxy.path] = f.read()
+        self.frames[frame] = {
+            'resolution': resolution,
+            'scene': copy_scene(scene),
+            'AOVs': dict(AOVs),
+        }
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({
+                'version': VERSION,
+                'pipeline_path': self.pipeline_path,
+                'plugins_paths': self.plugins_paths,
+                'messages': self.messages,
+                'frames': self.frames,
+                'materials': self.materials,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load(path):
+    with open(path, 'rb') as f:
+        scene_file = pickle.load(f)
+    if scene_file.get('version') != VERSION:
+        raise Exception('Unsupported Malt scene file version : {}'.format(scene_file.get('version')))
+    return scene_file
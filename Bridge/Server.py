@@ -3,15 +3,13 @@ import os, sys, time, ctypes, os, copy
 import cProfile, pstats, io
 import multiprocessing.connection as connection
 
-import glfw
-
 from Malt.GL import GL
 from Malt.GL.GL import *
 from Malt.GL.RenderTarget import RenderTarget
 from Malt.GL.Texture import Texture
 from Malt.PipelinePlugin import load_plugins_from_dir
 
-import Bridge.Mesh, Bridge.Material, Bridge.Texture
+import Bridge.Mesh, Bridge.Material, Bridge.Texture, Bridge.Upload
 from . import ipc as ipc
 
 from Malt.Utils import LOG
@@ -118,6 +116,41 @@ class PBO():
         return False
 
 
+def read_tile(texture, rect, buffer, offset, row_length):
+    # Reads the texture rect (x, y, w, h) into the buffer image (row_length pixels wide), at the pixel offset
+    x, y, w, h = rect
+    ox, oy = offset
+    pixel_size = texture.channel_count * texture.channel_size
+    assert(buffer.size_in_bytes() >= ((oy + h - 1) * row_length + ox + w) * pixel_size)
+    address = ctypes.addressof(buffer.buffer()) + (oy * row_length + ox) * pixel_size
+    render_target = RenderTarget([texture])
+    render_target.bind()
+    GL.glReadBuffer(GL.GL_COLOR_ATTACHMENT0)
+    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+    glPixelStorei(GL_PACK_ROW_LENGTH, row_length)
+    GL.glReadPixels(x, y, w, h, texture.format, texture.data_format, ctypes.c_void_p(address))
+    glPixelStorei(GL_PACK_ROW_LENGTH, 0)
+    glPixelStorei(GL_PACK_ALIGNMENT, 4)
+
+def get_tile_camera(camera, resolution, window, window_resolution):
+    # Camera that renders the window (in pixels, bottom to top) of the full frame
+    W, H = resolution
+    x, y = window
+    w, h = window_resolution
+    scale_x, scale_y = W / w, H / h
+    center_x, center_y = (2*x + w) / W - 1, (2*y + h) / H - 1
+    projection = list(camera.projection_matrix)
+    # Scale and offset the clip space, the matrix is column major
+    for column in range(4):
+        w_row = camera.projection_matrix[column*4 + 3]
+        projection[column*4 + 0] = scale_x * (camera.projection_matrix[column*4 + 0] - center_x * w_row)
+        projection[column*4 + 1] = scale_y * (camera.projection_matrix[column*4 + 1] - center_y * w_row)
+    tile_camera = copy.copy(camera)
+    tile_camera.projection_matrix = (ctypes.c_float * 16)(*projection)
+    tile_camera.frame_projection_matrix = camera.projection_matrix
+    return tile_camera
+
+
 class Viewport():
 
     def __init__(self, pipeline, is_final_render, bit_depth):
@@ -126,6 +159,8 @@ class Viewport():
         self.resolution = None
         self.read_resolution = None
         self.scene = None
+        self.scene_instances = None
+        self.delta_proxys = []
         self.bit_depth = bit_depth
         self.target_format = None
         self.final_texture = None
@@ -136,6 +171,14 @@ class Viewport():
         self.needs_more_samples = True
         self.is_final_render = is_final_render
         self.renderdoc_capture = False
+        self.sequence = 0
+        self.results = 0
+        # Final renders can be split in tiles, to bound the size of the render targets (See render_tiles)
+        self.tile_size = 0
+        self.tile_guard = 0
+        self.render_resolution = None
+        self.tiles = []
+        self.tile_index = 0
 
         self.stat_max_frame_latency = 0
         self.stat_cpu_frame_time = 0
@@ -143,31 +186,61 @@ class Viewport():
         self.stat_render_time = 0
     
     def get_print_stats(self):
-        return '\n'.join((
+        stats = []
+        if self.tiles:
+            stats.append('Tile : {} / {}'.format(self.tile_index, len(self.tiles)))
+        return '\n'.join(stats + [
             'Resolution : {}'.format(self.resolution),
             'Sample : {} / {}'.format(self.pipeline.sample_count, len(self.pipeline.get_samples())),
             'Sample Time : {:.3f} ms'.format((self.stat_render_time * 1000) / self.pipeline.sample_count),
             'Total Time : {:.3f} s'.format(self.stat_render_time),
             'Latency : {} frames'.format(len(self.pbos_active)),
             'Max Latency : {} frames'.format(self.stat_max_frame_latency),
-        ))
+        ])
+    
+    def set_tiling(self, tile_size, tile_guard):
+        # tile_guard is the extra pixels rendered around each tile, for screen space filters
+        self.tile_size = tile_size if self.is_final_render else 0
+        self.tile_guard = tile_guard
+    
+    def get_render_resolution(self, resolution):
+        if self.tile_size > 0:
+            w, h = resolution
+            size = self.tile_size + self.tile_guard*2
+            return (min(w, size), min(h, size))
+        return resolution
     
-    def setup(self, new_buffers, resolution, scene, scene_update, renderdoc_capture):
-        if self.resolution != resolution:
+    def get_tiles(self):
+        # (x, y, w, h, window), windows are render_resolution sized and don't go past the frame borders
+        W, H = self.resolution
+        window_w, window_h = self.render_resolution
+        tiles = []
+        for y in range(0, H, self.tile_size):
+            for x in range(0, W, self.tile_size):
+                w, h = min(self.tile_size, W - x), min(self.tile_size, H - y)
+                window_x = min(max(x - self.tile_guard, 0), W - window_w)
+                window_y = min(max(y - self.tile_guard, 0), H - window_h)
+                tiles.append((x, y, w, h, (window_x, window_y)))
+        return tiles
+    
+    def setup(self, new_buffers, resolution, scene, scene_update, renderdoc_capture, scene_delta=None):
+        render_resolution = self.get_render_resolution(resolution)
+        if self.resolution != resolution or self.render_resolution != render_resolution:
+            assert(new_buffers is not None or self.resolution == resolution)
             self.resolution = resolution
+            self.render_resolution = render_resolution
             self.pbos_inactive.extend(self.pbos_active)
             self.pbos_active = []
-            assert(new_buffers is not None)
             if self.bit_depth == 8:
                 self.target_format = GL_UNSIGNED_BYTE
                 if glGetInternalformativ(GL_TEXTURE_2D, GL_RGBA8, GL_READ_PIXELS, 1) != GL_ZERO:
                     self.target_format = glGetInternalformativ(GL_TEXTURE_2D, GL_RGBA8, GL_TEXTURE_IMAGE_TYPE, 1)
                 try:
-                    self.final_texture = Texture(resolution, GL_RGBA8, self.target_format, pixel_format=GL_RGBA)
+                    self.final_texture = Texture(render_resolution, GL_RGBA8, self.target_format, pixel_format=GL_RGBA)
                 except:
                     # Fallback to unsigned byte, just in case
                     self.target_format = GL_UNSIGNED_BYTE
-                    self.final_texture = Texture(resolution, GL_RGBA8, self.target_format)
+                    self.final_texture = Texture(render_resolution, GL_RGBA8, self.target_format)
                 self.final_texture.channel_size = 1
                 self.final_target = RenderTarget([self.final_texture])
             else:
@@ -175,12 +248,17 @@ class Viewport():
                     self.target_format = GL_RGBA16F
                 elif self.bit_depth == 32:
                     self.target_format = GL_RGBA32F
-                self.final_texture = Texture(resolution, self.target_format)
+                self.final_texture = Texture(render_resolution, self.target_format)
                 self.final_target = RenderTarget([self.final_texture])
         
         if new_buffers:
             self.buffers = new_buffers
 
+        self.tiles = []
+        if self.render_resolution != self.resolution:
+            self.tiles = self.get_tiles()
+        self.tile_index = 0
+
         self.sample_index = 0
         self.is_new_frame = True
         self.needs_more_samples = True
@@ -192,16 +270,81 @@ class Viewport():
         if scene_update or self.scene is None:
             for key, proxy in scene.proxys.items():
                 proxy.resolve()
+            self.delta_proxys = []
             
-            for obj in scene.objects:
-                obj.matrix = (ctypes.c_float * 16)(*obj.matrix)
+            packed_objects = getattr(scene, 'packed_objects', None)
+            if packed_objects:
+                scene.objects = packed_objects.unpack()
+            else:
+                for obj in scene.objects:
+                    obj.matrix = (ctypes.c_float * 16)(*obj.matrix)
             
-            scene.batches = self.pipeline.build_scene_batches(scene.objects)
+            if self.scene_instances is None:
+                from Malt.Pipeline import SceneInstances
+                self.scene_instances = SceneInstances()
+            scene.batches = self.pipeline.build_scene_batches(scene.objects, self.scene_instances)
             self.scene = scene
         else:
             self.scene.camera = scene.camera
             self.scene.time = scene.time
             self.scene.frame = scene.frame
+            if scene_delta:
+                self.apply_scene_delta(scene_delta)
+    
+    def apply_scene_delta(self, scene_delta):
+        # Patch the current scene in place, so the cost is proportional to the changed objects.
+        # Lists and dicts are modified in place since nodes (like SceneFilter) can hold shallow copies of the scene.
+        scene = self.scene
+        for proxy in scene_delta.get('proxys', {}).values():
+            proxy.resolve()
+            self.delta_proxys.append(proxy)
+        
+        packed_objects = getattr(scene, 'packed_objects', None)
+        if packed_objects:
+            matrices = scene_delta.get('matrices')
+            if matrices:
+                # Object matrices are views of the packed matrices
+                packed_matrices = packed_objects.get_array('matrices')
+                updated_objects = []
+                for index, matrix in matrices.items():
+                    packed_matrices[index][:] = matrix
+                    updated_objects.append(scene.objects[index])
+                self.pipeline.update_scene_batches(updated_objects)
+            
+            for handle, (parameters, indices) in scene_delta.get('parameters', {}).items():
+                packed_objects.tables['parameters'][handle] = parameters
+                for index in indices:
+                    obj = scene.objects[index]
+                    obj_parameters = dict(parameters)
+                    obj_parameters['ID'] = obj.parameters['ID']
+                    obj.parameters = obj_parameters
+        
+        for key, (path, shader_parameters, parameters) in scene_delta.get('materials', {}).items():
+            material = scene.proxys.get(key)
+            if material:
+                material.path = path
+                material.shader_parameters = shader_parameters
+                material.parameters = parameters
+                material.resolve()
+        if 'materials' in scene_delta:
+            # Transparency and light groups depend on the material parameters
+            scene.draw_lists.clear()
+        
+        for index, light in scene_delta.get('lights', {}).items():
+            scene.lights[index] = light
+        
+        if 'scene_parameters' in scene_delta:
+            scene.parameters.clear()
+            scene.parameters.update(scene_delta['scene_parameters'])
+    
+    def reload_textures(self, names):
+        # Texture proxys keep a copy of the texture they resolved to
+        if self.scene is None:
+            return
+        from .Proxys import TextureProxy
+        for proxy in list(self.scene.proxys.values()) + self.delta_proxys:
+            if isinstance(proxy, TextureProxy) and proxy.name in names:
+                proxy.resolve()
     
     TO_SRGB_SHADER = None
     def to_srgb(self, texture, target):
@@ -213,23 +356,53 @@ class Viewport():
         self.pipeline.draw_screen_pass(Viewport.TO_SRGB_SHADER, target)   
     def ensure_correct_format(self, key, texture):
         format = GL_R32F if key == 'DEPTH' else self.target_format
-        if texture.format == format and texture.resolution == self.resolution:
+        if texture.format == format and texture.resolution == self.render_resolution:
             return texture
         target = self.final_target
         if key != 'COLOR': #Create on the fly, since final render targets can be large
-            target = RenderTarget([Texture(self.resolution, format)])
+            target = RenderTarget([Texture(self.render_resolution, format)])
         if self.bit_depth == 8 and key != 'DEPTH':
             self.to_srgb(texture, target)
         else:
             self.pipeline.copy_textures(target, [texture])
         return target.targets[0]
     
+    def render_tiles(self):
+        # Renders every sample of the current tile, then copies it (without the guard band) into the result buffers
+        x, y, w, h, window = self.tiles[self.tile_index]
+        camera = self.scene.camera
+        self.scene.camera = get_tile_camera(camera, self.resolution, window, self.render_resolution)
+        try:
+            result = self.pipeline.render(self.render_resolution, self.scene, True, self.is_new_frame)
+        finally:
+            self.scene.camera = camera
+        self.is_new_frame = False
+        self.stat_render_time = time.perf_counter() - self.stat_time_start
+        if self.pipeline.needs_more_samples():
+            return
+        
+        window_x, window_y = window
+        for key, texture in result.items():
+            if texture and key in self.buffers.keys():
+                texture = self.ensure_correct_format(key, texture)
+                read_tile(texture, (x - window_x, y - window_y, w, h), self.buffers[key], (x, y), self.resolution[0])
+        
+        self.tile_index += 1
+        self.is_new_frame = True
+        if self.tile_index == len(self.tiles):
+            self.needs_more_samples = False
+            self.read_resolution = self.resolution
+            self.results += 1
+    
     def render(self):
         from . import renderdoc
         if self.renderdoc_capture:
             renderdoc.capture_start()
 
-        if self.needs_more_samples:
+        if self.tiles:
+            if self.needs_more_samples:
+                self.render_tiles()
+        elif self.needs_more_samples:
             result = self.pipeline.render(self.resolution, self.scene, self.is_final_render, self.is_new_frame)
             self.is_new_frame = False
             self.needs_more_samples = self.pipeline.needs_more_samples()
@@ -259,6 +432,7 @@ class Viewport():
                         self.pbos_inactive.extend(self.pbos_active[:i+1])
                         self.pbos_active = self.pbos_active[i+1:]
                         self.read_resolution = self.resolution
+                    self.results += 1
                     break
             
             self.stat_render_time = time.perf_counter() - self.stat_time_start
@@ -271,10 +445,126 @@ class Viewport():
         return self.needs_more_samples == False and len(self.pbos_active) == 0
 
 
+def update_uploads(viewports, status, wait=False, kinds=None):
+    if kinds is None or 'TEXTURE' in kinds:
+        Bridge.Texture.update_texture_files(wait)
+    Bridge.Upload.update(wait, kinds)
+    loaded = Bridge.Texture.get_loaded_textures()
+    if len(loaded) == 0:
+        return
+    for viewport in viewports.values():
+        viewport.reload_textures(set(loaded))
+    status.add_textures(len(loaded))
+
+
+def handle_message(msg, pipeline, new_pipeline, viewport_bit_depth, viewports, compile_scheduler, status):
+    # Handles a MAIN connection message, new_pipeline() creates the pipeline for new viewports
+    if msg['msg_type'] == 'MATERIAL':
+        LOG.debug('COMPILE MATERIAL : {}'.format(msg))
+        path = msg['path']
+        search_paths = msg['search_paths']
+        custom_passes = msg['custom_passes']
+        priority = msg.get('priority', 0)
+        compile_scheduler.add(path, search_paths, custom_passes, priority)
+    
+    if msg['msg_type'] == 'MESH':
+        msg_log = copy.copy(msg)
+        msg_log['data'] = None
+        LOG.debug('LOAD MESH : {}'.format(msg_log))
+        Bridge.Mesh.load_mesh(pipeline, msg)
+    
+    if msg['msg_type'] == 'TEXTURE':
+        LOG.debug('LOAD TEXTURE : {}'.format(msg))
+        Bridge.Texture.load_texture(msg)
+    
+    if msg['msg_type'] == 'TEXTURE FILE':
+        LOG.debug('LOAD TEXTURE FILE : {}'.format(msg))
+        Bridge.Texture.load_texture_file(msg)
+    
+    if msg['msg_type'] == 'GRADIENT':
+        msg_log = copy.copy(msg)
+        msg_log['pixels'] = None
+        LOG.debug('LOAD GRADIENT : {}'.format(msg_log))
+        name = msg['name']
+        pixels = msg['pixels']
+        nearest = msg['nearest']
+        Bridge.Texture.load_gradient(name, pixels, nearest)
+    
+    if msg['msg_type'] == 'RENDER':
+        LOG.debug('SETUP RENDER : {}'.format(msg))
+        viewport_id = msg['viewport_id']
+        resolution = msg['resolution']
+        scene = msg['scene']
+        scene_update = msg['scene_update']
+        scene_delta = msg.get('scene_delta')
+        new_buffers = msg['new_buffers']
+        renderdoc_capture = msg['renderdoc_capture']
+
+        if viewport_id == 0:
+            # Final renders can't wait for the textures to be loaded progressively
+            update_uploads(viewports, status, wait=True)
+        elif scene_update or (scene_delta and scene_delta.get('proxys')):
+            # Mesh proxys can't be resolved until their upload is ready
+            update_uploads(viewports, status, wait=True, kinds=('MESH',))
+
+        if viewport_id not in viewports:
+            bit_depth = viewport_bit_depth if viewport_id != 0 else 32
+            viewports[viewport_id] = Viewport(new_pipeline(), viewport_id == 0, bit_depth)
+        viewports[viewport_id].set_tiling(msg.get('tile_size', 0), msg.get('tile_guard', 0))
+
+        viewports[viewport_id].setup(new_buffers, resolution, scene, scene_update, renderdoc_capture, scene_delta)
+        viewports[viewport_id].sequence = msg['sequence']
+        status.set_setup(viewport_id, msg['sequence'])
+        status.notify(viewport_id)
+
+        if viewport_id == 0: # Final Render
+            # Render all samples at once to ensure render is done with the correct state
+            while viewports[0].render() == False:
+                continue
+
+
+def render_viewports(viewports, status):
+    # Renders the next sample of every viewport, returns the finished and active viewport ids
+    finished = set()
+    active = set()
+    for v_id, v in viewports.items():
+        if v.needs_more_samples:
+            active.add(v_id)
+        has_finished = v.render()
+        if has_finished:
+            finished.add(v_id)
+        status.set_read_resolution(v_id, v.read_resolution)
+        status.set_results(v_id, v.results)
+        if has_finished:
+            status.set_finished(v_id, v.sequence)
+        status.notify(v_id)
+    
+    if len(active) > 0:
+        stats = ''
+        for v_id in active:
+            stats += "Viewport ({}):\n{}\n\n".format(v_id, viewports[v_id].get_print_stats())
+        status.set_stats(stats)
+        LOG.debug('STATS: {} '.format(stats))
+    
+    return finished, active
+
+
+def load_pipeline_class(pipeline_path):
+    pipeline_dir, pipeline_name = os.path.split(pipeline_path)
+    if pipeline_dir not in sys.path:
+        sys.path.append(pipeline_dir)
+    module_name = pipeline_name.split('.')[0]
+    module = __import__(module_name)
+
+    pipeline_class = module.PIPELINE
+    pipeline_class.SHADER_INCLUDE_PATHS.append(pipeline_dir)
+    return pipeline_class
+
+
 PROFILE = False
 
 def main(pipeline_path, viewport_bit_depth, connection_addresses,
-    shared_dic, lock, log_path, debug_mode, plugins_paths, docs_path):
+    status, lock, log_path, debug_mode, plugins_paths, docs_path, gl_backend='GLFW'):
     LOG.info('DEBUG MODE: {}'.format(debug_mode))
 
     LOG.info('CONNECTIONS:')
@@ -282,36 +572,33 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
     for name, address in connection_addresses.items():
         LOG.info('Name: {} Adress: {}'.format(name, address))
         connections[name] = connection.Client(address)
+    status.connection = connections['NOTIFY']
     
-    glfw.ERROR_REPORTING = True
-    glfw.init()
+    LOG.info('OPENGL BACKEND: {}'.format(gl_backend))
+    from .Context import create_context
+    context = create_context(gl_backend)
 
-    glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 4)
-    glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 5)
-    glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
-    
-    window = glfw.create_window(256, 256, 'Malt', None, None)
-    glfw.make_context_current(window)
-    # Don't hide for better OS/Drivers schedule priority
-    #glfw.hide_window(window)
-    # Minimize instead:
-    glfw.iconify_window(window)
+    # Shares objects with the main context, for the upload thread (See Bridge.Upload)
+    upload_context = None
+    try:
+        upload_context = context.create_shared()
+    except:
+        import traceback
+        LOG.error(traceback.format_exc())
+    if upload_context:
+        Bridge.Upload.init(upload_context)
+    else:
+        LOG.warning('Failed to create the upload context, GPU uploads will run in the main thread')
 
-    glfw.swap_interval(0)
+    context.set_swap_interval(0)
 
     log_system_info()
     
     LOG.info('INIT PIPELINE: ' + pipeline_path)
 
+    pipeline = None
     try:
-        pipeline_dir, pipeline_name = os.path.split(pipeline_path)
-        if pipeline_dir not in sys.path:
-            sys.path.append(pipeline_dir)
-        module_name = pipeline_name.split('.')[0]
-        module = __import__(module_name)
-
-        pipeline_class = module.PIPELINE
-        pipeline_class.SHADER_INCLUDE_PATHS.append(pipeline_dir)
+        pipeline_class = load_pipeline_class(pipeline_path)
         
         if docs_path: #build docs before loading plugins
             from . import Docs
@@ -350,8 +637,11 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
         })
 
     viewports = {}
+    compile_scheduler = Bridge.Material.CompileScheduler(pipeline)
+    from Malt.GL.ShaderCache import get_program_cache
+    program_cache = get_program_cache()
 
-    while glfw.window_should_close(window) == False:
+    while context.should_close() == False:
         
         try:
             profiler = cProfile.Profile()
@@ -362,7 +652,7 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
             
             start_time = time.perf_counter()
 
-            glfw.poll_events()
+            context.poll_events()
 
             while connections['REFLECTION'].poll():
                 msg = connections['REFLECTION'].recv()
@@ -401,83 +691,29 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
 
             while connections['MAIN'].poll():
                 msg = connections['MAIN'].recv()
-                
-                if msg['msg_type'] == 'MATERIAL':
-                    LOG.debug('COMPILE MATERIAL : {}'.format(msg))
-                    path = msg['path']
-                    search_paths = msg['search_paths']
-                    custom_passes = msg['custom_passes']
-                    material = Bridge.Material.Material(path, pipeline, search_paths, custom_passes)
+                handle_message(msg, pipeline, lambda: pipeline_class(plugins), viewport_bit_depth,
+                    viewports, compile_scheduler, status)
+            
+            update_uploads(viewports, status)
+            
+            if compile_scheduler.is_empty() == False:
+                for material in compile_scheduler.poll():
                     connections['MAIN'].send({
                         'msg_type': 'MATERIAL',
                         'material' : material
                     })
-                
-                if msg['msg_type'] == 'MESH':
-                    msg_log = copy.copy(msg)
-                    msg_log['data'] = None
-                    LOG.debug('LOAD MESH : {}'.format(msg_log))
-                    Bridge.Mesh.load_mesh(pipeline, msg)
-                
-                if msg['msg_type'] == 'TEXTURE':
-                    LOG.debug('LOAD TEXTURE : {}'.format(msg))
-                    Bridge.Texture.load_texture(msg)
-                
-                if msg['msg_type'] == 'GRADIENT':
-                    msg_log = copy.copy(msg)
-                    msg_log['pixels'] = None
-                    LOG.debug('LOAD GRADIENT : {}'.format(msg_log))
-                    name = msg['name']
-                    pixels = msg['pixels']
-                    nearest = msg['nearest']
-                    Bridge.Texture.load_gradient(name, pixels, nearest)
-                
-                if msg['msg_type'] == 'RENDER':
-                    LOG.debug('SETUP RENDER : {}'.format(msg))
-                    viewport_id = msg['viewport_id']
-                    resolution = msg['resolution']
-                    scene = msg['scene']
-                    scene_update = msg['scene_update']
-                    new_buffers = msg['new_buffers']
-                    renderdoc_capture = msg['renderdoc_capture']
-
-                    if viewport_id not in viewports:
-                        bit_depth = viewport_bit_depth if viewport_id != 0 else 32
-                        viewports[viewport_id] = Viewport(pipeline_class(plugins), viewport_id == 0, bit_depth)
-
-                    viewports[viewport_id].setup(new_buffers, resolution, scene, scene_update, renderdoc_capture)
-                    shared_dic[(viewport_id, 'FINISHED')] = False
-                    shared_dic[(viewport_id, 'SETUP')] = True
-
-                    if viewport_id == 0: # Final Render
-                        # Render all samples at once to ensure render is done with the correct state
-                        while viewports[0].render() == False:
-                            continue
             
-            active_viewports = {}
-            render_finished = True
-            for v_id, v in viewports.items():
-                if v.needs_more_samples:
-                    active_viewports[v_id] = v
-                has_finished = v.render()
-                if has_finished == False:
-                    render_finished = False
-                shared_dic[(v_id, 'READ_RESOLUTION')] = v.read_resolution
-                if has_finished and shared_dic[(v_id, 'FINISHED')] == False:
-                    shared_dic[(v_id, 'FINISHED')] = True
+            if program_cache:
+                program_cache.update()
+            
+            finished, active_viewports = render_viewports(viewports, status)
+            render_finished = len(finished) == len(viewports)
             
             if render_finished:
-                glfw.swap_interval(1)
+                context.set_swap_interval(1)
             else:
-                glfw.swap_interval(0)
-            glfw.swap_buffers(window)
-
-            if len(active_viewports) > 0:
-                stats = ''
-                for v_id, v in active_viewports.items():
-                    stats += "Viewport ({}):\n{}\n\n".format(v_id, v.get_print_stats())
-                shared_dic['STATS'] = stats
-                LOG.debug('STATS: {} '.format(stats))
+                context.set_swap_interval(0)
+            context.swap_buffers()
             
             if PROFILE:
                 profiler.disable()
@@ -494,4 +730,8 @@ def main(pipeline_path, viewport_bit_depth, connection_addresses,
             import traceback
             LOG.error(traceback.format_exc())
 
-    glfw.terminate()
+    compile_scheduler.shutdown()
+    if program_cache:
+        program_cache.flush()
+        LOG.info('PROGRAM CACHE: {}'.format(program_cache.get_stats()))
+    context.terminate()
@@ -0,0 +1,152 @@
+import ctypes, time
+
+from Bridge.ipc import SharedBuffer
+
+# Fixed layout render status shared between Blender and the render server.
+# Reads and writes are plain memory accesses, there's no manager process in between.
+# When a connection is set, the server wakes up Blender through it whenever the status of a
+# viewport it's waiting for changes (See Status.wait and Status.notify).
+# Wake ups can still be missed in rare cases (the waiting flag isn't a memory barrier),
+# so waits should always use a timeout.
+
+MAX_VIEWPORTS = 64
+MAX_STATS_LENGTH = 16*1024
+
+# Viewport flags
+FLAG_READ_RESOLUTION = 1 << 0
+
+class C_ViewportStatus(ctypes.Structure):
+    _fields_ = [
+        ('requested', ctypes.c_uint32), # Last render request sent by Blender
+        ('setup', ctypes.c_uint32), # Last render request setup by the server
+        ('finished', ctypes.c_uint32), # Last render request completed by the server
+        ('flags', ctypes.c_uint32),
+        ('read_resolution', ctypes.c_int32*2),
+        ('results', ctypes.c_uint32), # Number of results copied into the render buffers
+        ('waiting', ctypes.c_uint32), # Set by Blender while it waits for a notification
+    ]
+
+class C_Status(ctypes.Structure):
+    _fields_ = [
+        ('viewports', C_ViewportStatus*MAX_VIEWPORTS),
+        ('stats_sequence', ctypes.c_uint32), # Odd while the server is writing the stats
+        ('stats_length', ctypes.c_uint32),
+        ('stats', ctypes.c_char*MAX_STATS_LENGTH),
+        ('textures', ctypes.c_uint32), # Number of texture loads processed by the server
+    ]
+
+class Status():
+
+    def __init__(self):
+        self.buffer = SharedBuffer(C_Status, 1)
+        self.data = self.buffer.buffer()[0]
+        ctypes.memset(ctypes.addressof(self.data), 0, ctypes.sizeof(C_Status))
+        self.connection = None
+
+    def __getstate__(self):
+        return { 'buffer' : self.buffer }
+
+    def __setstate__(self, state):
+        self.buffer = state['buffer']
+        self.data = self.buffer.buffer()[0]
+        self.connection = None
+
+    def viewport(self, viewport_id):
+        assert(viewport_id < MAX_VIEWPORTS)
+        return self.data.viewports[viewport_id]
+
+    def wait(self, viewport_id, condition, timeout=None, interval=0.0005):
+        viewport = self.viewport(viewport_id)
+        start = time.perf_counter()
+        while True:
+            if self.connection:
+                # Discard notifications from previous waits
+                while self.connection.poll():
+                    self.connection.recv_bytes()
+                viewport.waiting = 1
+            if condition():
+                viewport.waiting = 0
+                return True
+            remaining = None
+            if timeout is not None:
+                remaining = timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    viewport.waiting = 0
+                    return False
+            if self.connection:
+                self.connection.poll(remaining)
+            else:
+                time.sleep(interval)
+
+    # Blender side
+
+    def request_render(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        # 0 is reserved for "no request"
+        viewport.requested = ((viewport.requested + 1) & 0xFFFFFFFF) or 1
+        return viewport.requested
+
+    def is_setup(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        return viewport.setup == viewport.requested
+
+    def is_finished(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        return viewport.requested != 0 and viewport.finished == viewport.requested
+
+    def get_results(self, viewport_id):
+        return self.viewport(viewport_id).results
+
+    def get_read_resolution(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        if viewport.flags & FLAG_READ_RESOLUTION:
+            return tuple(viewport.read_resolution)
+        return None
+
+    def get_stats(self):
+        for i in range(100):
+            sequence = self.data.stats_sequence
+            if sequence % 2 == 0:
+                stats = self.data.stats[:self.data.stats_length]
+                if self.data.stats_sequence == sequence:
+                    return stats.decode('utf-8', errors='ignore')
+            time.sleep(0)
+        return ''
+    
+    def get_textures(self):
+        return self.data.textures
+
+    # Server side
+
+    def set_setup(self, viewport_id, sequence):
+        self.viewport(viewport_id).setup = sequence
+
+    def set_finished(self, viewport_id, sequence):
+        self.viewport(viewport_id).finished = sequence
+
+    def set_results(self, viewport_id, results):
+        self.viewport(viewport_id).results = results & 0xFFFFFFFF
+
+    def set_read_resolution(self, viewport_id, read_resolution):
+        viewport = self.viewport(viewport_id)
+        if read_resolution is None:
+            viewport.flags &= ~FLAG_READ_RESOLUTION
+        else:
+            viewport.read_resolution = tuple(read_resolution)
+            viewport.flags |= FLAG_READ_RESOLUTION
+
+    def notify(self, viewport_id):
+        viewport = self.viewport(viewport_id)
+        if self.connection and viewport.waiting:
+            viewport.waiting = 0
+            self.connection.send_bytes(bytes([viewport_id]))
+
+    def set_stats(self, stats):
+        stats = stats.encode('utf-8')[:MAX_STATS_LENGTH]
+        self.data.stats_sequence += 1
+        self.data.stats = stats
+        self.data.stats_length = len(stats)
+        self.data.stats_sequence += 1
+    
+    def add_textures(self, count):
+        self.data.textures = (self.data.textures + count) & 0xFFFFFFFF
@@ -1,21 +1,75 @@
+import ctypes, weakref
+
 from Malt.GL import Texture
 from Malt.GL.GL import *
 
 TEXTURES = {}
 
+# Textures are uploaded asynchronously (See Bridge.Upload),
+# in the meantime the previous texture (or a placeholder) is used.
+__TEXTURE_VERSIONS = {} # name : version of the last message received
+__LOADED = [] # Names of the textures loaded since the last get_loaded_textures call, one per message
+
+def new_version(name):
+    cancel_texture_file(name)
+    version = __TEXTURE_VERSIONS.get(name, 0) + 1
+    __TEXTURE_VERSIONS[name] = version
+    if name not in TEXTURES:
+        TEXTURES[name] = get_placeholder()
+    return version
+
+def upload_texture(name, version, upload, hash=None):
+    from Bridge import Upload
+    def publish(texture):
+        if texture:
+            if hash:
+                FILE_TEXTURES[hash] = texture
+            if __TEXTURE_VERSIONS.get(name) == version:
+                TEXTURES[name] = texture
+        __LOADED.append(name)
+    Upload.submit('TEXTURE', upload, publish)
+
+def get_loaded_textures():
+    loaded = __LOADED[:]
+    __LOADED.clear()
+    return loaded
+
 def load_texture(msg):
     name = msg['name']
-    data = msg['buffer'].buffer()
+    buffer = msg['buffer']
     resolution = msg['resolution']
     channels = msg['channels']
     sRGB = msg['sRGB']
+    version = new_version(name)
+    upload_texture(name, version, lambda: create_texture(buffer.buffer(), buffer.ctype(), resolution, channels, sRGB))
 
-    internal_formats = [
-        GL_R32F,
-        GL_RG32F,
-        GL_RGB32F,
-        GL_RGBA32F,
-    ]
+def create_texture(data, ctype, resolution, channels, sRGB):
+    # The buffer type matches the image precision, half floats are sent as c_uint16
+    # (See BlenderMalt.MaltTextures)
+    if ctype == ctypes.c_uint8:
+        data_format = GL_UNSIGNED_BYTE
+        internal_formats = [
+            GL_R8,
+            GL_RG8,
+            GL_RGB8,
+            GL_RGBA8,
+        ]
+    elif ctype == ctypes.c_uint16:
+        data_format = GL_HALF_FLOAT
+        internal_formats = [
+            GL_R16F,
+            GL_RG16F,
+            GL_RGB16F,
+            GL_RGBA16F,
+        ]
+    else:
+        data_format = GL_FLOAT
+        internal_formats = [
+            GL_R32F,
+            GL_RG32F,
+            GL_RGB32F,
+            GL_RGBA32F,
+        ]
     pixel_formats = [
         GL_RED,
         GL_RG,
@@ -26,14 +80,118 @@ def load_texture(msg):
     pixel_format = pixel_formats[channels-1]
     
     if sRGB:
-        if channels == 4:
+        if data_format == GL_UNSIGNED_BYTE:
+            internal_format = GL_SRGB8_ALPHA8 if channels == 4 else GL_SRGB8
+        elif channels == 4:
             internal_format = GL_SRGB_ALPHA
         else:
             internal_format = GL_SRGB
 
-    #Nearest + Anisotropy seems to yield the best results with temporal super sampling
-    TEXTURES[name] = Texture.Texture(resolution, internal_format, GL_FLOAT, data, pixel_format=pixel_format, 
-        wrap=GL_REPEAT, min_filter=GL_NEAREST_MIPMAP_NEAREST, build_mipmaps=True, anisotropy=True)
+    # Rows of 8 and 16 bit textures are not always 4 bytes aligned
+    # (Restored even on failure, the upload context is shared by every upload)
+    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    try:
+        #Nearest + Anisotropy seems to yield the best results with temporal super sampling
+        return Texture.Texture(resolution, internal_format, data_format, data, pixel_format=pixel_format, 
+            wrap=GL_REPEAT, min_filter=GL_NEAREST_MIPMAP_NEAREST, build_mipmaps=True, anisotropy=True)
+    finally:
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 4)
+
+# Image files are decoded by the server in worker threads (See load_texture_file).
+DECODE_THREADS = 4
+
+FILE_TEXTURES = weakref.WeakValueDictionary() # hash : Texture
+__PENDING_FILES = {} # name : (version, hash, sRGB, future)
+__EXECUTOR = None
+__PLACEHOLDER = None
+
+def get_executor():
+    global __EXECUTOR
+    if __EXECUTOR is None:
+        from concurrent.futures import ThreadPoolExecutor
+        __EXECUTOR = ThreadPoolExecutor(max_workers=DECODE_THREADS)
+    return __EXECUTOR
+
+def get_placeholder():
+    global __PLACEHOLDER
+    if __PLACEHOLDER is None:
+        data = (ctypes.c_uint8*4)(0, 0, 0, 255)
+        __PLACEHOLDER = create_texture(data, ctypes.c_uint8, (1,1), 4, False)
+    return __PLACEHOLDER
+
+def decode_texture_file(path):
+    import numpy as np
+    import OpenImageIO as oiio
+    # Blender keeps the alpha of byte images (PNG, TGA, TIFF...) unassociated,
+    # while OIIO premultiplies it into the colors by default
+    config = oiio.ImageSpec()
+    config.attribute('oiio:UnassociatedAlpha', 1)
+    input = oiio.ImageInput.open(path, config)
+    if input is None:
+        raise Exception('Failed to open {} : {}'.format(path, oiio.geterror()))
+    try:
+        spec = input.spec()
+        if spec.format == oiio.UINT8:
+            format, ctype = oiio.UINT8, ctypes.c_uint8
+        elif spec.format == oiio.HALF:
+            format, ctype = oiio.HALF, ctypes.c_uint16
+        else:
+            format, ctype = oiio.FLOAT, ctypes.c_float
+        pixels = input.read_image(0, 0, 0, spec.nchannels, format)
+        if pixels is None:
+            raise Exception('Failed to read {} : {}'.format(path, input.geterror()))
+    finally:
+        input.close()
+    pixels = pixels.reshape(spec.height, spec.width, spec.nchannels)
+    # Match Blender, grayscale images are expanded to RGB
+    if spec.nchannels == 1:
+        pixels = np.repeat(pixels, 3, axis=2)
+    elif spec.nchannels == 2:
+        pixels = pixels[:,:,[0,0,0,1]]
+    elif spec.nchannels > 4:
+        pixels = pixels[:,:,:4]
+    # Blender images are stored bottom to top
+    pixels = np.ascontiguousarray(pixels[::-1])
+    if ctype == ctypes.c_uint16:
+        pixels = pixels.view(np.uint16)
+    return pixels, ctype
+
+def cancel_texture_file(name):
+    if name in __PENDING_FILES:
+        version, hash, sRGB, future = __PENDING_FILES.pop(name)
+        future.cancel()
+        __LOADED.append(name)
+
+def load_texture_file(msg):
+    name = msg['name']
+    hash = msg['hash']
+    version = new_version(name)
+    if hash in FILE_TEXTURES:
+        TEXTURES[name] = FILE_TEXTURES[hash]
+        __LOADED.append(name)
+        return
+    future = get_executor().submit(decode_texture_file, msg['path'])
+    __PENDING_FILES[name] = (version, hash, msg['sRGB'], future)
+
+def update_texture_files(wait=False):
+    # Submit the decoded files for upload
+    for name, (version, hash, sRGB, future) in list(__PENDING_FILES.items()):
+        if wait == False and future.done() == False:
+            continue
+        del __PENDING_FILES[name]
+        try:
+            pixels, ctype = future.result()
+        except:
+            import traceback
+            from Malt.Utils import LOG
+            LOG.error(traceback.format_exc())
+            __LOADED.append(name)
+            continue
+        def upload(pixels=pixels, ctype=ctype, sRGB=sRGB):
+            height, width, channels = pixels.shape
+            data = pixels.ctypes.data_as(ctypes.POINTER(ctype))
+            return create_texture(data, ctype, (width, height), channels, sRGB and ctype == ctypes.c_uint8)
+        upload_texture(name, version, upload, hash)
 
 GRADIENTS = {}
 
@@ -0,0 +1,98 @@
+import threading, queue
+
+from Malt.GL.GL import *
+from Malt.Utils import LOG
+
+# GPU uploads run in a worker thread with its own GL context, sharing objects with the main context.
+# Each upload is followed by a fence, and its result is published from the main thread once the fence
+# is signaled (See update), so resources are never visible to the renderer before they're ready.
+# Container objects (like VAOs) are not shared between contexts, so uploads should only create
+# buffers and textures.
+# Without a shared context, uploads run in the main thread when they're submitted.
+
+class Upload():
+
+    def __init__(self, kind, upload, publish):
+        self.kind = kind
+        self.upload = upload
+        self.publish = publish
+        self.result = None
+        self.error = None
+        self.sync = None
+        self.done = threading.Event()
+
+__CONTEXT = None
+__THREAD = None
+__QUEUE = queue.Queue()
+__PENDING = []
+
+def init(shared_context):
+    # shared_context shares objects with the main one (See Bridge.Context)
+    global __CONTEXT, __THREAD
+    __CONTEXT = shared_context
+    __THREAD = threading.Thread(target=run, daemon=True)
+    __THREAD.start()
+
+def run():
+    __CONTEXT.make_current()
+    while True:
+        upload = __QUEUE.get()
+        try:
+            upload.result = upload.upload()
+            upload.sync = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+            # Make sure the fence reaches the GPU, so the main context can wait on it
+            glFlush()
+        except Exception as e:
+            upload.error = e
+            import traceback
+            LOG.error(traceback.format_exc())
+        upload.done.set()
+        # Resources must be freed from the main thread
+        upload = None
+
+def submit(kind, upload, publish):
+    # upload runs in the upload thread, publish(result) in the main thread
+    upload = Upload(kind, upload, publish)
+    if __THREAD is None:
+        try:
+            upload.result = upload.upload()
+        except Exception as e:
+            upload.error = e
+            import traceback
+            LOG.error(traceback.format_exc())
+        upload.done.set()
+    else:
+        __QUEUE.put(upload)
+    __PENDING.append(upload)
+
+def is_ready(upload, wait):
+    if wait:
+        upload.done.wait()
+    elif upload.done.is_set() == False:
+        return False
+    if upload.sync:
+        timeout = 1000000000 if wait else 0 # Nanoseconds
+        state = glClientWaitSync(upload.sync, GL_SYNC_FLUSH_COMMANDS_BIT, timeout)
+        while wait and state == GL_TIMEOUT_EXPIRED:
+            state = glClientWaitSync(upload.sync, GL_SYNC_FLUSH_COMMANDS_BIT, timeout)
+        if state == GL_TIMEOUT_EXPIRED:
+            return False
+        glDeleteSync(upload.sync)
+        upload.sync = None
+    return True
+
+def update(wait=False, kinds=None):
+    # Publish the finished uploads, if wait is True it waits for the pending uploads of the given kinds (or all)
+    published = 0
+    for upload in list(__PENDING):
+        wait_upload = wait and (kinds is None or upload.kind in kinds)
+        if is_ready(upload, wait_upload) == False:
+            continue
+        __PENDING.remove(upload)
+        published += 1
+        try:
+            upload.publish(upload.result if upload.error is None else None)
+        except:
+            import traceback
+            LOG.error(traceback.format_exc())
+    return published
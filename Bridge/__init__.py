@@ -1,14 +1,19 @@
 def reload():
     import importlib
-    from . import Client_API, Server, Material, Mesh, Texture
-    for module in [ Client_API, Server, Material, Mesh, Texture ]:
+    from . import Client_API, Server, Material, Mesh, Texture, Status
+    for module in [ Client_API, Server, Material, Mesh, Texture, Status ]:
         importlib.reload(module)
 
 def start_server(pipeline_path, viewport_bit_depth, connection_addresses, 
-    shared_dic, lock, log_path, debug_mode, renderdoc_path, plugins_paths, docs_path):
+    status, lock, log_path, debug_mode, renderdoc_path, plugins_paths, docs_path, server_index=0):
+    # server_index is the index of the server in the Bridge server pool
+    from .ipc import SharedBuffer
+    SharedBuffer.server_index = server_index
+
     import logging
     log_level = logging.DEBUG if debug_mode else logging.INFO
-    logging.basicConfig(filename=log_path, level=log_level, format='Malt > %(message)s')
+    log_prefix = 'Malt' if server_index == 0 else 'Malt {}'.format(server_index)
+    logging.basicConfig(filename=log_path, level=log_level, format=log_prefix + ' > %(message)s')
     console_logger = logging.StreamHandler()
     console_logger.setLevel(logging.WARNING)
     logging.getLogger().addHandler(console_logger)
@@ -25,10 +30,14 @@ def start_server(pipeline_path, viewport_bit_depth, connection_addresses,
         import subprocess
         subprocess.call([renderdoc_path, 'inject', '--PID={}'.format(os.getpid())])
 
+    # Must be selected before importing OpenGL
+    from . import Context
+    gl_backend = Context.select_backend()
+
     from . import Server
     try:
         Server.main(pipeline_path, viewport_bit_depth, connection_addresses,
-            shared_dic, lock, log_path, debug_mode, plugins_paths, docs_path)
+            status, lock, log_path, debug_mode, plugins_paths, docs_path, gl_backend)
     except:
         import traceback
         logging.error(traceback.format_exc())
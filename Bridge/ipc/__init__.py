@@ -39,15 +39,30 @@ close_shared_memory.restype = None
 
 from Malt.Utils import IBuffer
 
+# Buffers can be shared with a pool of render server processes (See Client_API.Bridge).
+# Each server has its own release flag, cleared when the buffer is sent to it and set again when it drops its copy,
+# so the owner can't reuse the buffer until every server has released it.
+MAX_SERVERS = 16
+_RELEASED = b'\x01' * MAX_SERVERS
+
+def _release_flags(release_flag):
+    return (ctypes.c_bool*MAX_SERVERS).from_address(release_flag.data)
+
+def _is_released(release_flag):
+    return ctypes.string_at(release_flag.data, MAX_SERVERS) == _RELEASED
+
 class SharedBuffer(IBuffer):
 
     _GARBAGE = []
+    # Blender side, the index of the server the buffer is being sent to.
+    # Server side, the index of the server process.
+    server_index = 0
     
     @classmethod
     def GC(cls):
         from copy import copy
         for buffer, release_flag in copy(cls._GARBAGE):
-            if ctypes.c_bool.from_address(release_flag.data).value == True:
+            if _is_released(release_flag):
                 close_shared_memory(buffer, True)
                 close_shared_memory(release_flag, True)
                 cls._GARBAGE.remove((buffer, release_flag))
@@ -60,8 +75,8 @@ class SharedBuffer(IBuffer):
         self._buffer = C_SharedMemory()
         create_shared_memory(('MALT_SHARED_'+self.id).encode('ascii'), self.size_in_bytes(), ctypes.byref(self._buffer))
         self._release_flag = C_SharedMemory()
-        create_shared_memory(('MALT_FLAG_'+self.id).encode('ascii'), ctypes.sizeof(ctypes.c_bool), ctypes.byref(self._release_flag))
-        ctypes.c_bool.from_address(self._release_flag.data).value = True
+        create_shared_memory(('MALT_FLAG_'+self.id).encode('ascii'), ctypes.sizeof(ctypes.c_bool)*MAX_SERVERS, ctypes.byref(self._release_flag))
+        ctypes.memset(self._release_flag.data, 1, MAX_SERVERS)
         self._is_owner = True
     
     def ctype(self):
@@ -73,9 +88,12 @@ class SharedBuffer(IBuffer):
     def buffer(self):
         return (self._ctype*self._size).from_address(self._buffer.data)
     
+    def is_released(self):
+        return _is_released(self._release_flag)
+    
     def __getstate__(self):
         assert(self._is_owner)
-        ctypes.c_bool.from_address(self._release_flag.data).value = False
+        _release_flags(self._release_flag)[SharedBuffer.server_index] = False
         state = self.__dict__.copy()
         state['_buffer'] = None
         state['_release_flag'] = None
@@ -87,11 +105,12 @@ class SharedBuffer(IBuffer):
         self._buffer = C_SharedMemory()
         open_shared_memory(('MALT_SHARED_'+self.id).encode('ascii'), self.size_in_bytes(), ctypes.byref(self._buffer))
         self._release_flag = C_SharedMemory()
-        open_shared_memory(('MALT_FLAG_'+self.id).encode('ascii'), ctypes.sizeof(ctypes.c_bool), ctypes.byref(self._release_flag))
+        open_shared_memory(('MALT_FLAG_'+self.id).encode('ascii'), ctypes.sizeof(ctypes.c_bool)*MAX_SERVERS, ctypes.byref(self._release_flag))
 
     def __del__(self):
-        if self._is_owner == False or ctypes.c_bool.from_address(self._release_flag.data).value == True:
-            ctypes.c_bool.from_address(self._release_flag.data).value = True
+        if self._is_owner == False or self.is_released():
+            if self._is_owner == False:
+                _release_flags(self._release_flag)[SharedBuffer.server_index] = True
             close_shared_memory(self._buffer, self._is_owner)
             close_shared_memory(self._release_flag, self._is_owner)
         else:
@@ -99,5 +118,5 @@ class SharedBuffer(IBuffer):
             ctypes.memmove(ctypes.addressof(buffer_copy), ctypes.addressof(self._buffer), ctypes.sizeof(C_SharedMemory))
             flag_copy = C_SharedMemory()
             ctypes.memmove(ctypes.addressof(flag_copy), ctypes.addressof(self._release_flag), ctypes.sizeof(C_SharedMemory))
+            # Closed on the next GC call (See BufferPool.SharedBufferPool.trim)
             self._GARBAGE.append((buffer_copy, flag_copy))
-            self.GC()
@@ -0,0 +1,86 @@
+#include <stddef.h>
+#include <stdint.h>
+
+#ifdef _WIN32
+#define EXPORT __declspec( dllexport )
+#else
+#define EXPORT __attribute__ ((visibility ("default")))
+#endif
+
+enum { CODE = 0, COMMENT = 1, NEWLINE = 2 };
+
+// Splits the source into code, comment and newline segments.
+// Each segment is written as a (kind, start, end) triplet of byte offsets.
+// Returns the number of segments written.
+EXPORT size_t scan_segments(const char* source, size_t length, int32_t* segments, size_t max_segments)
+{
+    size_t count = 0;
+    size_t i = 0;
+    size_t code_start = 0;
+    int in_code = 0;
+
+    #define PUSH(kind, start, end) \
+        if (count < max_segments) { \
+            segments[count*3+0] = kind; \
+            segments[count*3+1] = (int32_t)(start); \
+            segments[count*3+2] = (int32_t)(end); \
+            count++; \
+        }
+    #define FLUSH_CODE() \
+        if (in_code) { PUSH(CODE, code_start, i); in_code = 0; }
+
+    while (i < length)
+    {
+        char c = source[i];
+        if (c == '\n')
+        {
+            FLUSH_CODE();
+            PUSH(NEWLINE, i, i+1);
+            i++;
+        }
+        else if (c == '/' && i + 1 < length && source[i+1] == '/')
+        {
+            FLUSH_CODE();
+            size_t start = i;
+            while (i < length && source[i] != '\n') i++;
+            PUSH(COMMENT, start, i);
+        }
+        else if (c == '/' && i + 1 < length && source[i+1] == '*')
+        {
+            FLUSH_CODE();
+            size_t start = i;
+            i += 2;
+            while (i < length && !(source[i] == '*' && i + 1 < length && source[i+1] == '/')) i++;
+            i = i < length ? i + 2 : length;
+            PUSH(COMMENT, start, i);
+        }
+        else if (c == '"')
+        {
+            FLUSH_CODE();
+            size_t start = i;
+            i++;
+            while (i < length && source[i] != '"' && source[i] != '\n')
+            {
+                if (source[i] == '\\' && i + 1 < length) i++;
+                i++;
+            }
+            if (i < length && source[i] == '"') i++;
+            PUSH(CODE, start, i);
+        }
+        else
+        {
+            if (!in_code)
+            {
+                in_code = 1;
+                code_start = i;
+            }
+            i++;
+        }
+    }
+    FLUSH_CODE();
+
+    #undef PUSH
+    #undef FLUSH_CODE
+
+    return count;
+}
@@ -0,0 +1,553 @@
+# In-process GLSL preprocessor.
+# Supports #include, #define/#undef (object and function-like macros), #if/#ifdef/#ifndef/#elif/#else/#endif,
+# keeps comments in place and emits #line directives on every file change.
+# Source scanning can be accelerated by the optional GLSLPreprocessor C library (see build.py).
+
+import os, re, ctypes, platform
+
+src_dir = os.path.abspath(os.path.dirname(__file__))
+
+library = 'libGLSLPreprocessor.so'
+if platform.system() == 'Windows': library = 'GLSLPreprocessor.dll'
+if platform.system() == 'Darwin': library = 'libGLSLPreprocessor.dylib'
+
+CGLSLPreprocessor = None
+try:
+    CGLSLPreprocessor = ctypes.CDLL(os.path.join(src_dir, library))
+    scan_segments = CGLSLPreprocessor['scan_segments']
+    scan_segments.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.POINTER(ctypes.c_int32), ctypes.c_size_t]
+    scan_segments.restype = ctypes.c_size_t
+except:
+    CGLSLPreprocessor = None
+
+USE_C_SCANNER = True
+
+CODE = 0
+COMMENT = 1
+NEWLINE = 2
+
+
+class PreprocessorError(Exception):
+    pass
+
+
+_SEGMENT_REGEX = re.compile(r'//[^\n]*|/\*.*?(?:\*/|\Z)|"(?:\\.|[^"\\\n])*"?|\n|(?:[^/"\n]|/(?![/*]))+', re.S)
+
+def _scan_segments_python(source):
+    segments = []
+    for match in _SEGMENT_REGEX.finditer(source):
+        text = match.group()
+        if text == '\n':
+            segments.append((NEWLINE, text))
+        elif text.startswith('//') or text.startswith('/*'):
+            segments.append((COMMENT, text))
+        else:
+            segments.append((CODE, text))
+    return segments
+
+def _scan_segments_c(source):
+    data = source.encode('utf-8')
+    max_segments = len(data) + 1
+    ranges = (ctypes.c_int32 * (max_segments * 3))()
+    count = scan_segments(data, len(data), ranges, max_segments)
+    segments = []
+    for i in range(count):
+        kind, start, end = ranges[i*3], ranges[i*3+1], ranges[i*3+2]
+        segments.append((kind, data[start:end].decode('utf-8')))
+    return segments
+
+def get_segments(source):
+    if CGLSLPreprocessor and USE_C_SCANNER:
+        return _scan_segments_c(source)
+    return _scan_segments_python(source)
+
+
+class Line():
+    # A logical source line, tokenized ahead of time so cached files can be processed without rescanning.
+
+    __slots__ = ('number', 'count', 'segments', 'code', 'is_directive', 'tokens', 'identifiers', 'text')
+
+    def __init__(self, number, count, segments):
+        self.number = number
+        self.count = count
+        self.segments = segments
+        self.code = ''.join(text if kind == CODE else ' ' for kind, text in segments)
+        self.is_directive = self.code.lstrip().startswith('#')
+        self.tokens = []
+        self.identifiers = set()
+        self.text = None
+        if self.is_directive == False:
+            for kind, text in segments:
+                if kind == CODE:
+                    self.tokens.extend(tokenize(text))
+                else:
+                    self.tokens.append(text)
+            self.identifiers = set(t for t in self.tokens if is_identifier(t))
+            self.text = ''.join(self.tokens).rstrip() + '\n'
+
+
+def split_lines(source):
+    # Returns a list of logical lines.
+    # Multi-line comments are split at line boundaries so each physical line keeps its own segments.
+    # Lines ending with a backslash are joined with the next one.
+    lines = []
+    segments = []
+    line_number = 1
+    line_count = 1
+    def add_segment(kind, text):
+        if text:
+            segments.append((kind, text))
+    for kind, text in get_segments(source):
+        if kind == NEWLINE:
+            if segments and segments[-1][0] == CODE and segments[-1][1].rstrip(' \t\r').endswith('\\'):
+                last = segments[-1][1].rstrip(' \t\r')
+                segments[-1] = (CODE, last[:-1])
+                line_count += 1
+                continue
+            lines.append(Line(line_number, line_count, segments))
+            line_number += line_count
+            line_count = 1
+            segments = []
+        elif kind == COMMENT and '\n' in text:
+            parts = text.split('\n')
+            add_segment(COMMENT, parts[0])
+            for part in parts[1:]:
+                lines.append(Line(line_number, line_count, segments))
+                line_number += line_count
+                line_count = 1
+                segments = []
+                add_segment(COMMENT, part)
+        else:
+            add_segment(kind, text)
+    if segments:
+        lines.append(Line(line_number, line_count, segments))
+    return lines
+
+
+_TOKEN_REGEX = re.compile(r'[A-Za-z_]\w*|\.?\d(?:[eEpP][+-]|[\w.])*|##|&&|\|\||[=!<>]=|<<|>>|\s+|"(?:\\.|[^"\\])*"|.', re.S)
+_DIRECTIVE_REGEX = re.compile(r'#\s*(\w*)(.*)', re.S)
+
+def tokenize(text):
+    return _TOKEN_REGEX.findall(text)
+
+def is_identifier(token):
+    return token[:1].isalpha() or token[:1] == '_'
+
+def is_space(token):
+    return token.isspace() or token.startswith('/*') or token.startswith('//')
+
+
+class Macro():
+
+    def __init__(self, name, parameters, body):
+        self.name = name
+        self.parameters = parameters
+        self.body = body
+        self.variadic = parameters is not None and len(parameters) > 0 and parameters[-1] == '...'
+        if self.variadic:
+            self.parameters = parameters[:-1] + ['__VA_ARGS__']
+
+    def is_function(self):
+        return self.parameters is not None
+
+
+def parse_define(text):
+    match = re.match(r'\s*([A-Za-z_]\w*)(\([^)]*\))?(.*)', text, re.S)
+    if match is None:
+        raise PreprocessorError(f'Invalid #define : {text}')
+    name, parameters, body = match.groups()
+    if parameters is not None:
+        parameters = [p.strip() for p in parameters[1:-1].split(',') if p.strip()]
+    body = tokenize(body.strip())
+    return Macro(name, parameters, body)
+
+
+class GLSLPreprocessor():
+
+    FILE_CACHE = {}
+
+    def __init__(self, include_directories=[], definitions=[]):
+        self.include_directories = [os.path.abspath(d) for d in include_directories]
+        self.macros = {}
+        for definition in definitions:
+            name, _, value = definition.partition('=')
+            self.macros[name] = Macro(name, None, tokenize(value or '1'))
+        self.include_depth = 0
+        self.output = []
+        self.included_files = []
+
+    @classmethod
+    def load_file(cls, path):
+        stat = os.stat(path)
+        cached = cls.FILE_CACHE.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = split_lines(f.read())
+        cls.FILE_CACHE[path] = (stat.st_mtime_ns, stat.st_size, lines)
+        return lines
+
+    def find_include(self, name, current_dir, is_quoted):
+        search_paths = []
+        if is_quoted and current_dir:
+            search_paths.append(current_dir)
+        search_paths += self.include_directories
+        if os.path.isabs(name):
+            search_paths = ['']
+        for search_path in search_paths:
+            path = os.path.normpath(os.path.join(search_path, name))
+            if os.path.isfile(path):
+                return path
+        raise PreprocessorError(f'Can\'t open include file "{name}"')
+
+    def emit_line_directive(self, line_number, path):
+        self.output.append(f'#line {line_number} "{path}"\n')
+
+    def process(self, source, source_name='__source__'):
+        self.process_lines(split_lines(source), source_name, None)
+        return ''.join(self.output)
+
+    def process_file(self, path):
+        self.included_files.append(path)
+        self.process_lines(self.load_file(path), path, os.path.dirname(path))
+
+    def process_lines(self, lines, path, current_dir):
+        line_path = path.replace('\\', '/')
+        self.emit_line_directive(1, line_path)
+        # Stack of (is_active, any_branch_taken, parent_is_active)
+        conditions = []
+        active = True
+        pending_blank_lines = 0
+
+        def flush_blank_lines(line_number):
+            nonlocal pending_blank_lines
+            if pending_blank_lines > 8:
+                self.emit_line_directive(line_number, line_path)
+            else:
+                self.output.append('\n' * pending_blank_lines)
+            pending_blank_lines = 0
+
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            line_number, line_count = line.number, line.count
+            i += 1
+            if line.is_directive:
+                stripped = line.code.strip()
+                directive, argument = _DIRECTIVE_REGEX.match(stripped).groups()
+                argument = argument.strip()
+                if directive in ('ifdef', 'ifndef', 'if'):
+                    parent_active = active
+                    if parent_active:
+                        if directive == 'if':
+                            result = self.evaluate(argument)
+                        else:
+                            result = (argument.split()[0] in self.macros) == (directive == 'ifdef')
+                    else:
+                        result = False
+                    conditions.append([result, result, parent_active])
+                    active = result
+                elif directive == 'elif':
+                    if not conditions:
+                        raise PreprocessorError(f'{path}:{line_number} #elif without #if')
+                    condition = conditions[-1]
+                    result = False
+                    if condition[2] and condition[1] == False:
+                        result = self.evaluate(argument)
+                    condition[0] = result
+                    condition[1] = condition[1] or result
+                    active = result
+                elif directive == 'else':
+                    if not conditions:
+                        raise PreprocessorError(f'{path}:{line_number} #else without #if')
+                    condition = conditions[-1]
+                    condition[0] = condition[2] and condition[1] == False
+                    condition[1] = True
+                    active = condition[0]
+                elif directive == 'endif':
+                    if not conditions:
+                        raise PreprocessorError(f'{path}:{line_number} #endif without #if')
+                    active = conditions.pop()[2]
+                elif active:
+                    if directive == 'define':
+                        macro = parse_define(argument)
+                        self.macros[macro.name] = macro
+                    elif directive == 'undef':
+                        self.macros.pop(argument.split()[0], None)
+                    elif directive == 'include':
+                        argument = self.expand_text(argument).strip()
+                        is_quoted = argument.startswith('"')
+                        include_path = self.find_include(argument[1:-1], current_dir, is_quoted)
+                        flush_blank_lines(line_number)
+                        if self.include_depth > 64:
+                            raise PreprocessorError(f'{path}:{line_number} #include nested too deeply')
+                        self.include_depth += 1
+                        self.process_file(include_path)
+                        self.include_depth -= 1
+                        self.emit_line_directive(line_number + line_count, line_path)
+                        continue
+                    elif directive == 'error':
+                        raise PreprocessorError(f'{path}:{line_number} #error {argument}')
+                    elif directive in ('line', 'pragma', 'version', 'extension'):
+                        # Not handled by the preprocessor, pass them through to the GLSL compiler
+                        flush_blank_lines(line_number)
+                        self.output.append(stripped + '\n')
+                        pending_blank_lines += line_count - 1
+                        continue
+                    elif directive != '':
+                        raise PreprocessorError(f'{path}:{line_number} Unknown directive #{directive}')
+                if active:
+                    comments = ' '.join(text for kind, text in line.segments if kind == COMMENT)
+                    if comments:
+                        flush_blank_lines(line_number)
+                        self.output.append(comments + '\n')
+                        pending_blank_lines += line_count - 1
+                        continue
+                pending_blank_lines += line_count
+                continue
+
+            if active == False:
+                pending_blank_lines += line_count
+                continue
+
+            flush_blank_lines(line_number)
+
+            # Fast path, most lines don't use any macro
+            if line.identifiers.isdisjoint(self.macros):
+                self.output.append(line.text)
+                pending_blank_lines += line_count - 1
+                continue
+
+            tokens = list(line.tokens)
+            extra_lines = 0
+            # Function-like macro invocations can span multiple lines
+            while self.has_unterminated_invocation(tokens) and i < len(lines):
+                next_line = lines[i]
+                if next_line.is_directive:
+                    break
+                i += 1
+                extra_lines += next_line.count
+                tokens.append('\n')
+                tokens.extend(next_line.tokens)
+
+            self.output.append(''.join(self.expand(tokens)).rstrip() + '\n')
+            if extra_lines:
+                self.emit_line_directive(line_number + line_count + extra_lines, line_path)
+            pending_blank_lines += line_count - 1
+
+        if conditions:
+            raise PreprocessorError(f'{path} Unterminated conditional directive')
+        self.output.append('\n' * min(pending_blank_lines, 8))
+
+    def has_unterminated_invocation(self, tokens):
+        if tokens.count('(') <= tokens.count(')'):
+            return False
+        depth = None
+        for i, token in enumerate(tokens):
+            if depth is None:
+                macro = self.macros.get(token)
+                if macro and macro.is_function():
+                    j = i + 1
+                    while j < len(tokens) and is_space(tokens[j]):
+                        j += 1
+                    if j < len(tokens) and tokens[j] == '(':
+                        depth = 0
+            elif token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth == 0:
+                    depth = None
+        return depth is not None and depth > 0
+
+    def expand_text(self, text):
+        return ''.join(self.expand(tokenize(text)))
+
+    def expand(self, tokens):
+        # Fast path, most lines don't use any macro
+        if not any(t in self.macros for t in tokens):
+            return tokens
+        # Each token carries the set of macros that can't be expanded inside it (hide set)
+        tokens = [(t, frozenset()) for t in tokens]
+        result = []
+        i = 0
+        while i < len(tokens):
+            token, hide_set = tokens[i]
+            macro = self.macros.get(token)
+            if macro is None or token in hide_set:
+                result.append(token)
+                i += 1
+                continue
+            if macro.is_function() == False:
+                replacement = [(t, hide_set | {token}) for t in macro.body]
+                tokens[i:i+1] = [(' ', hide_set)] + replacement + [(' ', hide_set)]
+                continue
+            j = i + 1
+            while j < len(tokens) and is_space(tokens[j][0]):
+                j += 1
+            if j >= len(tokens) or tokens[j][0] != '(':
+                result.append(token)
+                i += 1
+                continue
+            arguments, end = self.collect_arguments(tokens, j)
+            if arguments is None:
+                raise PreprocessorError(f'Unterminated macro invocation : {token}')
+            if len(macro.parameters) == 0 and len(arguments) == 1 and all(is_space(t) for t, h in arguments[0]):
+                arguments = []
+            if macro.variadic and len(arguments) > len(macro.parameters):
+                tail = arguments[len(macro.parameters)-1:]
+                merged = tail[0]
+                for argument in tail[1:]:
+                    merged = merged + [(',', frozenset())] + argument
+                arguments = arguments[:len(macro.parameters)-1] + [merged]
+            if len(arguments) != len(macro.parameters):
+                raise PreprocessorError(f'Wrong number of arguments for macro {token}')
+            replacement = self.substitute(macro, arguments, hide_set | {token})
+            tokens[i:end+1] = [(' ', hide_set)] + replacement + [(' ', hide_set)]
+        return result
+
+    def collect_arguments(self, tokens, start):
+        arguments = []
+        current = []
+        depth = 0
+        for i in range(start + 1, len(tokens)):
+            token = tokens[i][0]
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                if depth == 0:
+                    arguments.append(current)
+                    return arguments, i
+                depth -= 1
+            elif token == ',' and depth == 0:
+                arguments.append(current)
+                current = []
+                continue
+            current.append(tokens[i])
+        return None, None
+
+    def substitute(self, macro, arguments, hide_set):
+        parameters = { name : i for i, name in enumerate(macro.parameters) }
+        def strip(argument):
+            texts = [t for t, h in argument]
+            while texts and is_space(texts[0]): texts.pop(0)
+            while texts and is_space(texts[-1]): texts.pop()
+            return texts
+        expanded_cache = {}
+        def expanded(index):
+            if index not in expanded_cache:
+                expanded_cache[index] = self.expand(strip(arguments[index]))
+            return expanded_cache[index]
+
+        body = macro.body
+        result = []
+        i = 0
+        while i < len(body):
+            token = body[i]
+            if token == '#' and i + 1 < len(body):
+                j = i + 1
+                while j < len(body) and body[j].isspace(): j += 1
+                if j < len(body) and body[j] in parameters:
+                    text = ' '.join(''.join(strip(arguments[parameters[body[j]]])).split())
+                    text = text.replace('\\', '\\\\').replace('"', '\\"')
+                    result.append(f'"{text}"')
+                    i = j + 1
+                    continue
+            if token == '##':
+                while result and result[-1].isspace(): result.pop()
+                j = i + 1
+                while j < len(body) and body[j].isspace(): j += 1
+                if j < len(body):
+                    right = body[j]
+                    right_tokens = strip(arguments[parameters[right]]) if right in parameters else [right]
+                    if result and right_tokens:
+                        result[-1] = result[-1] + right_tokens[0]
+                        result.extend(right_tokens[1:])
+                    else:
+                        result.extend(right_tokens)
+                i = j + 1
+                continue
+            if token in parameters:
+                next_token = None
+                j = i + 1
+                while j < len(body) and body[j].isspace(): j += 1
+                if j < len(body): next_token = body[j]
+                if next_token == '##':
+                    result.extend(strip(arguments[parameters[token]]))
+                else:
+                    result.extend(expanded(parameters[token]))
+                i += 1
+                continue
+            result.append(token)
+            i += 1
+        return [(t, hide_set) for t in result]
+
+    def evaluate(self, expression):
+        tokens = tokenize(expression)
+        # Resolve defined() before macro expansion
+        resolved = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token == 'defined':
+                j = i + 1
+                while j < len(tokens) and tokens[j].isspace(): j += 1
+                parenthesis = j < len(tokens) and tokens[j] == '('
+                if parenthesis:
+                    j += 1
+                    while j < len(tokens) and tokens[j].isspace(): j += 1
+                name = tokens[j]
+                if parenthesis:
+                    j += 1
+                    while j < len(tokens) and tokens[j].isspace(): j += 1
+                resolved.append('1' if name in self.macros else '0')
+                i = j + 1
+                continue
+            resolved.append(token)
+            i += 1
+
+        python_expression = []
+        for token in self.expand(resolved):
+            if is_identifier(token):
+                python_expression.append('0')
+            elif token[:1].isdigit():
+                python_expression.append(token.rstrip('uUlL'))
+            elif token == '&&':
+                python_expression.append(' and ')
+            elif token == '||':
+                python_expression.append(' or ')
+            elif token == '!':
+                python_expression.append(' not ')
+            elif token == '/':
+                python_expression.append('//')
+            else:
+                python_expression.append(token)
+        try:
+            return bool(eval(''.join(python_expression), {'__builtins__': {}}))
+        except Exception as e:
+            raise PreprocessorError(f'Invalid #if expression : {expression}') from e
+
+
+def preprocess(source, include_directories=[], definitions=[], source_name='__source__'):
+    preprocessor = GLSLPreprocessor(include_directories, definitions)
+    result = preprocessor.process(source, source_name)
+    return result, preprocessor.included_files
+
+
+def normalize_preprocessed_source(source):
+    # Strips #line directives, comments and whitespace differences.
+    # Used to compare the results of different preprocessor backends.
+    result = []
+    for kind, text in _scan_segments_python(source):
+        if kind == CODE:
+            result.append(text)
+        else:
+            result.append('\n')
+    lines = []
+    for line in ''.join(result).splitlines():
+        if line.lstrip().startswith('#line'):
+            continue
+        tokens = [t for t in tokenize(line) if not t.isspace()]
+        if tokens:
+            lines.append(' '.join(tokens))
+    return '\n'.join(lines)
@@ -13,6 +13,7 @@ class Mesh():
         self.color_is_srgb = [False]*4
 
         self.index_count = len(index)
+        self.index_type = GL_UNSIGNED_INT
 
         self.VAO = None
         self.EBO = gl_buffer(GL_INT, 1)
@@ -85,7 +86,7 @@ class Mesh():
     def draw(self, bind=True):
         if bind:
             self.bind()
-        glDrawElements(GL_TRIANGLES, self.index_count, GL_UNSIGNED_INT, NULL)
+        glDrawElements(GL_TRIANGLES, self.index_count, self.index_type, NULL)
         if bind:
             glBindVertexArray(0)
     
@@ -120,6 +121,27 @@ class MeshCustomLoad(Mesh):
         self.color_is_srgb = [False]*4
 
         self.index_count = 0
+        self.index_type = GL_UNSIGNED_INT
 
         self.VAO = None
         self.EBO = None
+        # (VBO, location, (gl_type, normalized, components, stride, offset))
+        self.bindings = []
+    
+    # The VAO is created on first use, so the buffers can be loaded from a different (shared) context
+    # See Bridge/Upload.py
+    def load_VAO(self):
+        self.VAO = gl_buffer(GL_INT, 1)
+        glGenVertexArrays(1, self.VAO)
+        glBindVertexArray(self.VAO[0])
+        glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.EBO[0])
+        for VBO, location, (gl_type, normalized, components, stride, offset) in self.bindings:
+            glBindBuffer(GL_ARRAY_BUFFER, VBO[0])
+            glEnableVertexAttribArray(location)
+            glVertexAttribPointer(location, components, gl_type, normalized, stride, ctypes.c_void_p(offset))
+        glBindVertexArray(0)
+    
+    def bind(self):
+        if self.VAO is None:
+            self.load_VAO()
+        glBindVertexArray(self.VAO[0])
@@ -1,8 +1,12 @@
-import ctypes, os
+import ctypes, os, re
 
 from Malt.GL.GL import *
 from Malt.Utils import LOG
 
+# 'MCPP' runs the mcpp executable in a subprocess.
+# 'PYTHON' runs the in-process preprocessor from Malt.GL.GLSLPreprocessor.
+PREPROCESSOR_BACKEND = 'MCPP'
+
 
 class Shader():
 
@@ -142,25 +146,84 @@ class UBO():
         glBindBuffer(GL_UNIFORM_BUFFER, self.buffer[0])
         glBufferData(GL_UNIFORM_BUFFER, self.size, ctypes.pointer(structure), GL_STREAM_DRAW)
         glBindBuffer(GL_UNIFORM_BUFFER, 0)
+    
+    def load_sub_data(self, structure, offset):
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer[0])
+        glBufferSubData(GL_UNIFORM_BUFFER, offset, ctypes.sizeof(structure), ctypes.pointer(structure))
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
 
-    def bind(self, uniform_block):
+    def bind(self, uniform_block, offset=0):
+        # offset must be a multiple of GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT
         location = uniform_block['bind']
-        if self.location != location or self.BINDS[location] != self:
-            glBindBufferRange(GL_UNIFORM_BUFFER, location, self.buffer[0], 0, min(self.size, uniform_block['size']))
+        if self.location != location or self.BINDS[location] != (self, offset):
+            glBindBufferRange(GL_UNIFORM_BUFFER, location, self.buffer[0], offset, min(self.size - offset, uniform_block['size']))
             self.location = location
-            self.BINDS[location] = self
+            self.BINDS[location] = (self, offset)
     
     def __del__(self):
         glDeleteBuffers(1, self.buffer[0])
 
 
 def shader_preprocessor(shader_source, include_directories=[], definitions=[]):
-    import tempfile, subprocess, sys, platform
+    definitions = get_preprocessor_definitions(definitions)
+    return preprocess_source(shader_source, include_directories, definitions)
+
 
+def get_preprocessor_definitions(definitions=[]):
+    definitions = list(definitions)
     if hasGLExtension('GL_ARB_bindless_texture'):
         definitions.append('GL_ARB_bindless_texture')
-    
+    if indirect_draw_support():
+        definitions.append('INDIRECT_DRAW')
+    return definitions
+
+
+# Draw scene batches with glMultiDrawElementsIndirect when the driver supports it (See Pipeline.draw_scene_pass).
+# Must be set before compiling any shader, since it changes how instance data is declared (See Common.glsl).
+INDIRECT_DRAW = True
+
+__INDIRECT_DRAW_SUPPORT = None
+
+def indirect_draw_support():
+    global __INDIRECT_DRAW_SUPPORT
+    if __INDIRECT_DRAW_SUPPORT is None:
+        __INDIRECT_DRAW_SUPPORT = all(hasGLExtension(extension) for extension in (
+            'GL_ARB_multi_draw_indirect',
+            'GL_ARB_shader_draw_parameters',
+            'GL_ARB_shader_storage_buffer_object',
+        ))
+    return INDIRECT_DRAW and __INDIRECT_DRAW_SUPPORT
+
+
+# Doesn't require an OpenGL context, so it can run on worker processes.
+# The context dependent definitions must be already included. (See get_preprocessor_definitions)
+def preprocess_source(shader_source, include_directories=[], definitions=[]):
     shader_source = shader_source + '\n'
+
+    from Malt.GL.ShaderCache import get_preprocessor_cache
+    cache = get_preprocessor_cache()
+    if cache:
+        cache_key = cache.get_key(shader_source, include_directories, definitions)
+        result = cache.load(cache_key)
+        if result is not None:
+            return result
+
+    if PREPROCESSOR_BACKEND == 'PYTHON':
+        result, included_files = python_preprocessor(shader_source, include_directories, definitions)
+    else:
+        result, included_files = mcpp_preprocessor(shader_source, include_directories, definitions,
+            list_includes=cache is not None)
+
+    if cache:
+        cache.store(cache_key, result, included_files)
+    
+    return result
+
+
+def mcpp_preprocessor(shader_source, include_directories=[], definitions=[], list_includes=False):
+    # Returns the preprocessed source and the list of included files (None if list_includes is False)
+    import tempfile, subprocess, sys, platform
+
     tmp = tempfile.NamedTemporaryFile(delete=False)
     tmp.write(shader_source.encode('utf-8'))
     tmp.close()
@@ -169,33 +232,104 @@ def shader_preprocessor(shader_source, include_directories=[], definitions=[]):
     dependencies_path = os.path.join(os.path.dirname(__file__), '..', f'.Dependencies-{py_version}')
     mcpp = os.path.join(dependencies_path, f'mcpp-{platform.system()}')
 
-    command = f'"{mcpp}"'
-    command += ' -C' #keep comments
+    options = ''
     for directory in include_directories:
-        command += f' -I"{directory}"'
+        options += f' -I"{directory}"'
     for definition in definitions:
-        command += f' -D"{definition}"'
-    command += f' "{tmp.name}"'
+        options += f' -D"{definition}"'
+    options += f' "{tmp.name}"'
     
-    if platform.system() == 'Windows':
-        #run with utf8 code page to support non-ascii paths
-        command = f'CHCP 65001 > nul && {command}'
+    def run(arguments):
+        command = f'"{mcpp}" {arguments}'
+        if platform.system() == 'Windows':
+            #run with utf8 code page to support non-ascii paths
+            command = f'CHCP 65001 > nul && {command}'
+        return subprocess.run(command, shell=True, stdout = subprocess.PIPE, stderr=subprocess.PIPE)
     
     try:
-        result = subprocess.run(command, shell=True, stdout = subprocess.PIPE, stderr=subprocess.PIPE)
+        result = run('-C' + options) #keep comments
         if result.returncode != 0:
             raise Exception(result.stderr.decode('utf-8'))
     except:
         if platform.system() == 'Linux': #Linux seemingly removes exec permissions when unzipping (?)
             import stat
             os.chmod(mcpp, os.stat(mcpp).st_mode | stat.S_IEXEC)
-            result = subprocess.run(command, shell=True, stdout = subprocess.PIPE, stderr=subprocess.PIPE)
-    finally:
-        os.remove(tmp.name)
+            result = run('-C' + options)
+    try:
         if result.returncode != 0:
             raise Exception(result.stderr.decode('utf-8'))
-        else:
-            return result.stdout.decode('utf-8')
+        result = result.stdout.decode('utf-8')
+        included_files = None
+        if list_includes:
+            included_files = get_line_directive_files(result, [tmp.name])
+            # Files that don't output anything (like include guarded headers) don't get a #line directive
+            for path in scan_includes(shader_source, include_directories):
+                if path not in included_files:
+                    included_files.append(path)
+        return result, included_files
+    finally:
+        os.remove(tmp.name)
+
+
+def get_line_directive_files(preprocessed_source, ignore_paths=[]):
+    paths = []
+    ignore_paths = [os.path.normcase(os.path.normpath(path)) for path in ignore_paths]
+    for line in preprocessed_source.splitlines():
+        if line.startswith('#line') and '"' in line:
+            path = os.path.normpath(line[line.index('"')+1:line.rindex('"')])
+            if path not in paths and os.path.normcase(path) not in ignore_paths:
+                paths.append(path)
+    return paths
+
+
+__INCLUDE_REGEX = re.compile(r'^[ \t]*#[ \t]*include[ \t]*[<"]([^>"]+)[>"]', re.MULTILINE)
+__INCLUDES_CACHE = {} # path : (mtime, size, include names)
+
+def scan_includes(shader_source, include_directories=[]):
+    # Returns every file the source can reach through #include, without evaluating the preprocessor conditions.
+    # Much cheaper than running the preprocessor again, and a superset of the actually included files.
+    def get_includes(path):
+        stat = os.stat(path)
+        cached = __INCLUDES_CACHE.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            includes = __INCLUDE_REGEX.findall(f.read())
+        __INCLUDES_CACHE[path] = (stat.st_mtime_ns, stat.st_size, includes)
+        return includes
+
+    def find(name, current_dir):
+        # Same search order as the preprocessors, the current file folder first
+        search_paths = [current_dir] if current_dir else []
+        search_paths += include_directories
+        if os.path.isabs(name):
+            search_paths = ['']
+        for search_path in search_paths:
+            path = os.path.normpath(os.path.join(search_path, name))
+            if os.path.isfile(path):
+                return path
+        return None
+
+    paths = []
+    pending = [(name, None) for name in __INCLUDE_REGEX.findall(shader_source)]
+    while pending:
+        name, current_dir = pending.pop()
+        path = find(name, current_dir)
+        if path is None or path in paths:
+            continue
+        paths.append(path)
+        try:
+            pending += [(include, os.path.dirname(path)) for include in get_includes(path)]
+        except OSError:
+            pass
+    return paths
+
+
+def python_preprocessor(shader_source, include_directories=[], definitions=[]):
+    # Returns the preprocessed source and the list of included files
+    from Malt.GL.GLSLPreprocessor import preprocess
+    result, included_files = preprocess(shader_source, include_directories, definitions)
+    return result, included_files
 
 
 __LINE_DIRECTIVE_SUPPORT = None
@@ -261,6 +395,8 @@ def fix_line_directive_paths(source):
     return result
 
 
+LINE_DIRECTIVE_REGEX = re.compile(r'^#line.*$', re.M)
+
 def compile_gl_program(vertex, fragment):
     def finalize_source(source):
         bindless_setup = '''
@@ -271,11 +407,15 @@ def compile_gl_program(vertex, fragment):
             #extension GL_ARB_bindless_texture : enable
             #define OPTIONALLY_BINDLESS layout(bindless_sampler)
             '''
+        indirect_draw_setup = ''
+        if indirect_draw_support():
+            indirect_draw_setup = '#extension GL_ARB_shader_draw_parameters : enable'
         import textwrap
         source = textwrap.dedent(f'''
         #version 450 core
         #extension GL_ARB_shading_language_include : enable
         {bindless_setup}
+        {indirect_draw_setup}
         #line 1 "src"
         ''') + source
         return fix_line_directive_paths(source)
@@ -286,38 +426,30 @@ def compile_gl_program(vertex, fragment):
     status = gl_buffer(GL_INT,1)
     info_log = gl_buffer(GL_BYTE, 1024)
 
-    hash_src = vertex + fragment
-    ''.splitlines()
-    hash_src = ''.join([line for line in hash_src.splitlines(True) if line.startswith('#line') == False])
-    import hashlib, tempfile
-    shader_hash = hashlib.sha1(hash_src.encode()).hexdigest()
-    cache_folder = os.path.join(tempfile.gettempdir(), 'MALT_SHADERS_CACHE')
-    os.makedirs(cache_folder, exist_ok=True)
-    cache_path = os.path.join(cache_folder, shader_hash+'.bin')
-    format_path = os.path.join(cache_folder, shader_hash+'.fmt')
-    cache, format = None, None
-    if os.path.exists(cache_path) and os.path.exists(format_path):
-        from pathlib import Path
-        Path(cache_path).touch()
-        with open(cache_path, 'rb') as f:
-            bin = f.read()
-            cache = (GLubyte*len(bin)).from_buffer_copy(bin)
-        Path(format_path).touch()
-        with open(format_path, 'rb') as f:
-            format = GLuint.from_buffer_copy(f.read())
+    from Malt.GL.ShaderCache import get_program_cache
+    cache = get_program_cache()
+    cache_key = None
     
     program = glCreateProgram()
     error = ""
 
     if cache:
-        try:
-            glProgramBinary(program, format, cache, len(cache))
-            glGetProgramiv(program, GL_LINK_STATUS, status)
-            if status[0] != GL_FALSE:
-                return (program, error)
-        except:
+        # #line directives only affect error messages and differ between include paths
+        cache_key = cache.get_key(LINE_DIRECTIVE_REGEX.sub('', vertex), LINE_DIRECTIVE_REGEX.sub('', fragment))
+        cached = cache.load(cache_key)
+        if cached:
+            format, binary = cached
+            try:
+                binary = (GLubyte*len(binary)).from_buffer_copy(binary)
+                glProgramBinary(program, format, binary, len(binary))
+                glGetProgramiv(program, GL_LINK_STATUS, status)
+                if status[0] != GL_FALSE:
+                    return (program, error)
+            except:
+                pass
             #Program binary format can change on driver updates
-            LOG.error(f"Failed to load cached program binary: {shader_hash} ({format})")
+            LOG.error(f"Failed to load cached program binary: {cache_key} ({format})")
+            cache.invalidate(cache_key)
 
     def compile_shader (source, shader_type):
         shader = glCreateShader(shader_type)
@@ -346,16 +478,13 @@ def compile_gl_program(vertex, fragment):
     if status[0] == GL_FALSE:
         info_log = glGetProgramInfoLog(program)
         error += 'SHADER LINKER ERROR :\n' + buffer_to_string(info_log)
-    else:
+    elif cache:
         length = gl_buffer(GL_INT, 1)
         glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH, length)
         format = gl_buffer(GL_UNSIGNED_INT, 1)
         buffer = gl_buffer(GL_UNSIGNED_BYTE, length[0])
         glGetProgramBinary(program, length[0], NULL, format, buffer)
-        with open(cache_path, 'wb') as f:
-            f.write(buffer)
-        with open(format_path, 'wb') as f:
-            f.write(format)
+        cache.store(cache_key, format[0], bytes(buffer))
 
     return (program, error)
 
@@ -0,0 +1,416 @@
+import os, hashlib, json, threading
+
+from Malt.Utils import LOG
+
+PREPROCESSOR_CACHE_ENABLED = True
+PREPROCESSOR_CACHE_PATH = None # Defaults to the system temp folder
+PREPROCESSOR_CACHE_MAX_SIZE = 256 * 1024 * 1024
+
+
+def default_cache_folder(name):
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+class DiskCache():
+    # Content addressed key/value files with LRU eviction.
+    # The file modification time is used as the last use time.
+
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.folder, key)
+
+    def load(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def store(self, key, data):
+        path = self.get_path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            LOG.warning(f'Failed to write cache file: {path}')
+            return
+        with self.lock:
+            if self.size is None:
+                self.size = sum(size for path, size, last_use in self.get_entries())
+            else:
+                self.size += len(data)
+            if self.size > self.max_size:
+                self.evict(self.max_size * 0.75)
+
+    def get_entries(self):
+        entries = []
+        for e in os.scandir(self.folder):
+            if e.is_file() and e.name.endswith('.tmp') == False:
+                try:
+                    stat = e.stat()
+                    entries.append((e.path, stat.st_size, stat.st_mtime))
+                except OSError:
+                    pass
+        return entries
+
+    def evict(self, target_size):
+        entries = self.get_entries()
+        entries.sort(key=lambda e: e[2])
+        self.size = sum(size for path, size, last_use in entries)
+        for path, size, last_use in entries:
+            if self.size <= target_size:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.evict(0)
+
+
+class PreprocessorCache():
+    # Preprocessed sources are keyed by the source text, include directories and definitions.
+    # Each entry also stores the hash of every file reached through #include,
+    # so entries are discarded when any of their dependencies change.
+
+    def __init__(self, folder, max_size):
+        self.disk_cache = DiskCache(folder, max_size)
+        self.file_hashes = {}
+
+    def get_file_hash(self, path):
+        stat = os.stat(path)
+        cached = self.file_hashes.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        with open(path, 'rb') as f:
+            file_hash = hashlib.sha1(f.read()).hexdigest()
+        self.file_hashes[path] = (stat.st_mtime_ns, stat.st_size, file_hash)
+        return file_hash
+
+    def get_key(self, source, include_directories, definitions):
+        key = json.dumps([source, list(include_directories), list(definitions)])
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def load(self, key):
+        data = self.disk_cache.load(key)
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data)
+            for path, file_hash in entry['dependencies'].items():
+                if self.get_file_hash(path) != file_hash:
+                    return None
+            return entry['result']
+        except:
+            return None
+
+    def store(self, key, result, included_files):
+        # included_files must come from the preprocessor, not from the #line directives in the result,
+        # since files that don't output anything don't have one
+        dependencies = {}
+        for path in included_files:
+            if path in dependencies:
+                continue
+            try:
+                dependencies[path] = self.get_file_hash(path)
+            except OSError:
+                #Can't validate the entry later, so don't cache it
+                return
+        entry = {
+            'dependencies': dependencies,
+            'result': result,
+        }
+        self.disk_cache.store(key, json.dumps(entry).encode('utf-8'))
+
+
+__PREPROCESSOR_CACHE = None
+
+def get_preprocessor_cache():
+    if PREPROCESSOR_CACHE_ENABLED == False:
+        return None
+    global __PREPROCESSOR_CACHE
+    if __PREPROCESSOR_CACHE is None:
+        folder = PREPROCESSOR_CACHE_PATH or default_cache_folder('MALT_PREPROCESSOR_CACHE')
+        try:
+            __PREPROCESSOR_CACHE = PreprocessorCache(folder, PREPROCESSOR_CACHE_MAX_SIZE)
+        except OSError:
+            LOG.warning(f'Failed to setup the preprocessor cache at: {folder}')
+            return None
+    return __PREPROCESSOR_CACHE
+
+
+PROGRAM_CACHE_ENABLED = True
+PROGRAM_CACHE_PATH = None # Defaults to the system temp folder
+PROGRAM_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+# Min time between index writes, changes are batched in between (See ProgramCache.update)
+PROGRAM_CACHE_FLUSH_INTERVAL = 5.0
+
+
+class FileLock():
+    # Cross-process lock based on the atomic creation of a lock file.
+    # Lock files older than stale_time are considered abandoned by a crashed process.
+
+    def __init__(self, path, stale_time=30):
+        self.path = path
+        self.stale_time = stale_time
+        self.handle = None
+    
+    def __enter__(self):
+        import time
+        while True:
+            try:
+                self.handle = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(self.path).st_mtime > self.stale_time:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.005)
+    
+    def __exit__(self, *args):
+        os.close(self.handle)
+        self.handle = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ProgramCache():
+    # Program binaries are stored as <key>.bin files.
+    # The index.json file stores the driver vendor, renderer and version, the binary format, size and last use time
+    # of every entry, so the cache can be inspected and evicted (LRU) without touching the binaries.
+    # All the writes are atomic and the index is merged under a FileLock, so concurrent processes can share a cache.
+    # Index changes are kept in memory until the next flush.
+
+    def __init__(self, folder, max_size, driver, flush_interval=PROGRAM_CACHE_FLUSH_INTERVAL):
+        import time
+        self.folder = folder
+        self.max_size = max_size
+        self.driver = driver
+        self.flush_interval = flush_interval
+        self.last_flush = time.perf_counter()
+        self.index_path = os.path.join(folder, 'index.json')
+        self.lock_path = os.path.join(folder, 'index.lock')
+        self.index = {}
+        self.updates = {}
+        self.removed = set()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'rejected': 0,
+        }
+        self.lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+        self.index_version = self.get_index_version()
+        self.index = self.read_index()
+        self.remove_orphans()
+    
+    def get_key(self, *sources):
+        hash = hashlib.sha1(json.dumps(self.driver).encode('utf-8'))
+        for source in sources:
+            hash.update(source.encode('utf-8'))
+        return hash.hexdigest()
+    
+    def get_path(self, key):
+        return os.path.join(self.folder, key + '.bin')
+    
+    def get_index_version(self):
+        # Changes when any process writes the index file
+        try:
+            stat = os.stat(self.index_path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+    
+    def read_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def remove_orphans(self, min_age=60*60):
+        # Binaries without an index entry (from older versions or crashed processes)
+        import time
+        try:
+            with FileLock(self.lock_path):
+                index = self.read_index()
+                for e in os.scandir(self.folder):
+                    key, extension = os.path.splitext(e.name)
+                    if extension not in ('.bin', '.fmt', '.tmp') or key in index:
+                        continue
+                    try:
+                        if time.time() - e.stat().st_mtime > min_age:
+                            os.remove(e.path)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+    
+    def load(self, key):
+        # Returns a (format, binary) tuple
+        import time
+        with self.lock:
+            if key in self.removed:
+                self.stats['misses'] += 1
+                return None
+            entry = self.updates.get(key) or self.index.get(key)
+            if entry is None and os.path.exists(self.get_path(key)):
+                # Written by another process since the last flush.
+                # Misses are common on cold starts, so the index is only parsed again if it has changed.
+                index_version = self.get_index_version()
+                if index_version != self.index_version:
+                    self.index_version = index_version
+                    self.index = self.read_index()
+                    entry = self.index.get(key)
+            if entry is None or any(entry.get(k) != v for k, v in self.driver.items()):
+                self.stats['misses'] += 1
+                return None
+            try:
+                with open(self.get_path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                self.stats['misses'] += 1
+                return None
+            if len(data) != entry['size']:
+                self.stats['misses'] += 1
+                return None
+            entry = dict(entry)
+            entry['last_use'] = time.time()
+            self.updates[key] = entry
+            self.stats['hits'] += 1
+            return entry['format'], data
+    
+    def invalidate(self, key):
+        # For binaries rejected by the driver
+        with self.lock:
+            self.stats['rejected'] += 1
+            self.updates.pop(key, None)
+            self.removed.add(key)
+        self.update()
+    
+    def store(self, key, format, data):
+        import time
+        path = self.get_path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            LOG.warning(f'Failed to write cache file: {path}')
+            return
+        entry = dict(self.driver)
+        entry['format'] = format
+        entry['size'] = len(data)
+        entry['last_use'] = time.time()
+        with self.lock:
+            self.updates[key] = entry
+            self.removed.discard(key)
+            self.stats['stores'] += 1
+        self.update()
+    
+    def update(self):
+        # Flushes the local changes if flush_interval has passed since the last flush
+        import time
+        if time.perf_counter() - self.last_flush >= self.flush_interval:
+            self.flush()
+    
+    def flush(self):
+        # Merges the local changes into the index file and evicts the least recently used entries
+        import time
+        with self.lock:
+            self.last_flush = time.perf_counter()
+            if len(self.updates) == 0 and len(self.removed) == 0:
+                return
+            try:
+                with FileLock(self.lock_path):
+                    index = self.read_index()
+                    for key, entry in self.updates.items():
+                        if key in index:
+                            entry['last_use'] = max(entry['last_use'], index[key]['last_use'])
+                        index[key] = entry
+                    removed = set(self.removed)
+                    size = sum(entry['size'] for entry in index.values())
+                    if size > self.max_size:
+                        for key, entry in sorted(index.items(), key=lambda e: e[1]['last_use']):
+                            if size <= self.max_size:
+                                break
+                            removed.add(key)
+                            size -= entry['size']
+                            self.stats['evictions'] += 1
+                    for key in removed:
+                        index.pop(key, None)
+                        try:
+                            os.remove(self.get_path(key))
+                        except OSError:
+                            pass
+                    tmp_path = f'{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                    with open(tmp_path, 'w') as f:
+                        json.dump(index, f)
+                    os.replace(tmp_path, self.index_path)
+                    self.index_version = self.get_index_version()
+                    self.index = index
+                    self.updates = {}
+                    self.removed = set()
+            except OSError:
+                LOG.warning(f'Failed to update the program cache index: {self.index_path}')
+    
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self.index)
+            stats['size'] = sum(entry['size'] for entry in self.index.values())
+            return stats
+    
+    def clear(self):
+        with self.lock:
+            self.updates = {}
+            self.removed = set(self.read_index().keys())
+        self.flush()
+
+
+__PROGRAM_CACHE = None
+
+def get_program_cache():
+    # Requires an OpenGL context
+    if PROGRAM_CACHE_ENABLED == False:
+        return None
+    global __PROGRAM_CACHE
+    if __PROGRAM_CACHE is None:
+        from Malt.GL.GL import glGetString, GL_VENDOR, GL_RENDERER, GL_VERSION
+        driver = {
+            'vendor': glGetString(GL_VENDOR).decode(),
+            'renderer': glGetString(GL_RENDERER).decode(),
+            'version': glGetString(GL_VERSION).decode(),
+        }
+        folder = PROGRAM_CACHE_PATH or default_cache_folder('MALT_SHADERS_CACHE')
+        try:
+            __PROGRAM_CACHE = ProgramCache(folder, PROGRAM_CACHE_MAX_SIZE, driver)
+            import atexit
+            atexit.register(__PROGRAM_CACHE.flush)
+        except OSError:
+            LOG.warning(f'Failed to setup the program cache at: {folder}')
+            return None
+    return __PROGRAM_CACHE
@@ -15,6 +15,8 @@ class SceneFilter(PipelineNode):
         self.last_scene = None
         self.matches = None
         self.non_matches = None
+        self.matches_instances = None
+        self.non_matches_instances = None
     
     @classmethod
     def reflect_inputs(cls):
@@ -50,8 +52,12 @@ class SceneFilter(PipelineNode):
                     self.matches.objects.append(obj)
                 else:
                     self.non_matches.objects.append(obj)
-            self.matches.batches = self.pipeline.build_scene_batches(self.matches.objects)
-            self.non_matches.batches = self.pipeline.build_scene_batches(self.non_matches.objects)
+            if self.matches_instances is None:
+                from Malt.Pipeline import SceneInstances
+                self.matches_instances = SceneInstances()
+                self.non_matches_instances = SceneInstances()
+            self.matches.batches = self.pipeline.build_scene_batches(self.matches.objects, self.matches_instances)
+            self.non_matches.batches = self.pipeline.build_scene_batches(self.non_matches.objects, self.non_matches_instances)
             
         outputs['Matches'] = self.matches
         outputs['Non Matches'] = self.non_matches
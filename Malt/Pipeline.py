@@ -1,17 +1,59 @@
-import math, os, ctypes
+import math, os, ctypes, weakref, array
 from os import path
 
 from Malt.Utils import LOG
 
 from Malt.GL.GL import *
 from Malt.GL.Mesh import Mesh, MeshCustomLoad
-from Malt.GL.Shader import Shader, UBO, shader_preprocessor
+from Malt.GL.Shader import Shader, UBO, shader_preprocessor, indirect_draw_support
 
 from Malt.Render import Common
 from Malt.PipelineParameters import *
 
 SHADER_DIR = path.join(path.dirname(__file__), 'Shaders')
 
+# Vertex attribute formats supported by Pipeline.load_mesh
+VERTEX_FORMATS = {
+    # name : (type, normalized)
+    'FLOAT' : (GL_FLOAT, GL_FALSE),
+    'HALF_FLOAT' : (GL_HALF_FLOAT, GL_FALSE),
+    'SNORM16' : (GL_SHORT, GL_TRUE),
+    'UNORM8' : (GL_UNSIGNED_BYTE, GL_TRUE),
+}
+
+__UNIFORM_BUFFER_OFFSET_ALIGNMENT = None
+def get_uniform_buffer_offset_alignment():
+    global __UNIFORM_BUFFER_OFFSET_ALIGNMENT
+    if __UNIFORM_BUFFER_OFFSET_ALIGNMENT is None:
+        __UNIFORM_BUFFER_OFFSET_ALIGNMENT = glGetInteger(GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT)
+    return __UNIFORM_BUFFER_OFFSET_ALIGNMENT
+
+class SceneInstances():
+    # Instance data (model matrices and ids) of all the batches of a scene
+
+    def __init__(self):
+        self.models = UBO()
+        self.ids = UBO()
+        self.commands = None
+        # Incremented on each load, so stale Object.batch_locations can be detected
+        self.generation = 0
+    
+    def load(self, models, ids, commands=None):
+        # models is a bytearray, ids and commands are arrays of uints
+        self.generation += 1
+        self.models.load_data((ctypes.c_byte * len(models)).from_buffer(models))
+        self.ids.load_data((ctypes.c_uint * len(ids)).from_buffer(ids))
+        if commands is not None:
+            if self.commands is None:
+                self.commands = UBO()
+            self.commands.load_data((ctypes.c_uint * len(commands)).from_buffer(commands))
+    
+    def bind_indirect(self):
+        # Buffer objects are not tied to the target used to load them
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, self.models.buffer[0])
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, self.ids.buffer[0])
+        glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.commands.buffer[0])
+
 class Pipeline():
 
     SHADER_INCLUDE_PATHS = []
@@ -144,24 +186,45 @@ class Pipeline():
     def compile_material_from_source(self, material_type, source, include_paths=[]):
         return self.graphs[material_type].compile_material(source, include_paths)
     
+    def get_material_source(self, shader_path, search_paths=[]):
+        file_dir = path.dirname(shader_path)
+        source = '#include "{}"'.format(path.basename(shader_path))
+        material_type = shader_path.split('.')[-2]
+        for graph in self.graphs.values():
+            if shader_path.endswith(graph.file_extension):
+                material_type = graph.name
+        return material_type, source, [file_dir] + search_paths
+    
     def compile_material(self, shader_path, search_paths=[]):
         try:
-            file_dir = path.dirname(shader_path)
-            source = '#include "{}"'.format(path.basename(shader_path))
-            material_type = shader_path.split('.')[-2]
-            for graph in self.graphs.values():
-                if shader_path.endswith(graph.file_extension):
-                    material_type = graph.name
-            return self.compile_material_from_source(material_type, source, [file_dir] + search_paths)
+            material_type, source, include_paths = self.get_material_source(shader_path, search_paths)
+            return self.compile_material_from_source(material_type, source, include_paths)
         except Exception as e:
             import traceback
             traceback.print_exc()
             return str(e)
     
-    def load_mesh(self, position, indices, normal, tangent=None, uvs=[], colors=[]):  
+    # Split version of compile_material, so preprocessing can run outside of the OpenGL thread.
+    def get_material_preprocess_params(self, shader_path, search_paths=[]):
+        material_type, source, include_paths = self.get_material_source(shader_path, search_paths)
+        return material_type, self.graphs[material_type].get_preprocess_params(source, include_paths)
+    
+    def compile_material_from_preprocessed(self, material_type, preprocessed):
+        try:
+            return self.graphs[material_type].compile_material_from_preprocessed(preprocessed)
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return str(e)
+    
+    def load_mesh(self, position, indices, normal, tangent=None, uvs=[], colors=[], layout={}, vertices=None):
         # Each parameter implements the Malt.Utils.IBuffer interface
         # Indices is an array of index buffers corresponding to each of the materials a mesh has
         # VBOs are shared for all the materials
+        # Layout can override the format of each attribute (See VERTEX_FORMATS) as
+        # { attribute_name : (format, components, stride, offset) },
+        # the attribute names are position, normal, tangent, uv0-3 and color0-3
+        # If vertices is passed, it's an interleaved buffer that contains all the attributes in layout
           
         def load_VBO(data):
             VBO = gl_buffer(GL_INT, 1)
@@ -170,70 +233,81 @@ class Pipeline():
             glBufferData(GL_ARRAY_BUFFER, data.size_in_bytes(), data.buffer(), GL_STATIC_DRAW)
             glBindBuffer(GL_ARRAY_BUFFER, 0)
             return VBO
-
-        position_vbo = load_VBO(position)
-        normal_vbo = load_VBO(normal)
-        tangent_vbo = load_VBO(tangent) if tangent else None
-        uv_vbos = [load_VBO(e) for e in uvs]
-        color_vbos = [load_VBO(e) if e else None for e in colors]
+        
+        max_uv = 4
+        max_vertex_colors = 4
+        uv0_index = 3
+        color0_index = uv0_index + max_uv
+        
+        if len(uvs) > max_uv:
+            LOG.warning('UV count exceeds max supported UVs ({})'.format(max_uv))
+            uvs = uvs[:max_uv]
+        if len(colors) > max_vertex_colors:
+            LOG.warning('Vertex Color Layer count exceeds max supported layers ({})'.format(max_vertex_colors))
+            colors = colors[:max_vertex_colors]
+
+        # (name, data, location, default layout)
+        attributes = [
+            ('position', position, 0, ('FLOAT', 3, 0, 0)),
+            ('normal', normal, 1, ('FLOAT', 3, 0, 0)),
+            ('tangent', tangent, 2, ('FLOAT', 4, 0, 0)),
+        ]
+        if vertices is None and position.size_in_bytes() != normal.size_in_bytes():
+            attributes[1] = ('normal', normal, 1, ('SNORM16', 3, 0, 0))
+        for i, uv in enumerate(uvs):
+            attributes.append(('uv'+str(i), uv, uv0_index + i, ('FLOAT', 2, 0, 0)))
+        for i, color in enumerate(colors):
+            default = None
+            if color:
+                default = ('UNORM8', 4, 0, 0) if color.ctype() == ctypes.c_uint8 else ('FLOAT', 4, 0, 0)
+            attributes.append(('color'+str(i), color, color0_index + i, default))
+
+        vertices_vbo = load_VBO(vertices) if vertices else None
+        
+        # (VBO, location, layout)
+        bindings = []
+        vbos = {}
+        for name, data, location, default in attributes:
+            if vertices_vbo:
+                if name in layout:
+                    vbos[name] = vertices_vbo
+                    bindings.append((vertices_vbo, location, layout[name]))
+            elif data:
+                vbos[name] = load_VBO(data)
+                bindings.append((vbos[name], location, layout.get(name, default)))
+        
+        color_is_srgb = [False]*4
+        for vbo, location, (format, components, stride, offset) in bindings:
+            if location >= color0_index and format == 'UNORM8':
+                color_is_srgb[location - color0_index] = True
 
         results = []
 
         for i, index in enumerate(indices):
             result = MeshCustomLoad()
             
-            result.VAO = gl_buffer(GL_INT, 1)
-            glGenVertexArrays(1, result.VAO)
-            glBindVertexArray(result.VAO[0])
-            
-            result.EBO = gl_buffer(GL_INT, 1)
-            glGenBuffers(1, result.EBO)
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, result.EBO[0])
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, index.size_in_bytes(), index.buffer(), GL_STATIC_DRAW)
+            # The VAO is created on first bind (See MeshCustomLoad.load_VAO)
+            result.EBO = load_VBO(index)
             
             result.index_count = len(index)
+            if index.ctype() == ctypes.c_uint16:
+                result.index_type = GL_UNSIGNED_SHORT
 
-            result.position = position_vbo
-            result.normal = normal_vbo
-            result.tangent = tangent_vbo
-            result.uvs = uv_vbos
-            result.colors = color_vbos
-
-            def bind_VBO(VBO, index, element_size, gl_type=GL_FLOAT, gl_normalize=GL_FALSE):
-                glBindBuffer(GL_ARRAY_BUFFER, VBO[0])
-                glEnableVertexAttribArray(index)
-                glVertexAttribPointer(index, element_size, gl_type, gl_normalize, 0, None)
-            
-            bind_VBO(result.position, 0, 3)
-            if position.size_in_bytes() == normal.size_in_bytes():
-                bind_VBO(result.normal, 1, 3)
+            if vertices_vbo:
+                # Interleaved attributes share the same VBO, only delete it once
+                result.position = vertices_vbo
             else:
-                bind_VBO(result.normal, 1, 3, GL_SHORT, GL_TRUE)
-            
-            if tangent:
-                bind_VBO(result.tangent, 2, 4)
-            
-            max_uv = 4
-            max_vertex_colors = 4
-            uv0_index = 3
-            color0_index = uv0_index + max_uv
-            for i, uv in enumerate(result.uvs):
-                if i >= max_uv:
-                    LOG.warning('{} : UV count exceeds max supported UVs ({})'.format(name, max_uv))
-                    break
-                bind_VBO(uv, uv0_index + i, 2)
-            for i, color in enumerate(result.colors):
-                if i >= max_vertex_colors:
-                    LOG.warning('{} : Vertex Color Layer count exceeds max supported layers ({})'.format(name, max_uv))
-                    break
-                if color:
-                    if colors[i]._ctype == ctypes.c_uint8:
-                        bind_VBO(color, color0_index + i, 4, GL_UNSIGNED_BYTE, GL_TRUE)
-                        result.color_is_srgb[i] = True
-                    if colors[i]._ctype == ctypes.c_float:
-                        bind_VBO(color, color0_index + i, 4, GL_FLOAT)
-
-            glBindVertexArray(0)
+                result.position = vbos.get('position')
+                result.normal = vbos.get('normal')
+                result.tangent = vbos.get('tangent')
+                result.uvs = [vbos['uv'+str(i)] for i in range(len(uvs))]
+                result.colors = [vbos.get('color'+str(i)) for i in range(len(colors))]
+            result.color_is_srgb = list(color_is_srgb)
+
+            for vbo, location, (format, components, stride, offset) in bindings:
+                gl_type, gl_normalize = VERTEX_FORMATS[format]
+                result.bindings.append((vbo, location, (gl_type, gl_normalize, components, stride, offset)))
+
             results.append(result)
 
         return results
@@ -264,7 +338,10 @@ class Pipeline():
         self.copy_shader.textures['IN_DEPTH'] = depth_source
         self.draw_screen_pass(self.copy_shader, target)
     
-    def build_scene_batches(self, objects):
+    def build_scene_batches(self, objects, instances=None):
+        # Per instance data is stored in a single pair of UBOs, and each batch binds its own range.
+        # With indirect drawing, the same buffers are bound as SSBOs and each batch is a DrawElementsIndirectCommand.
+        # Passing the SceneInstances of a previous call reuses its buffers, invalidating the previous batches.
         result = {}
         for obj in objects:
             if obj.material not in result:
@@ -283,47 +360,93 @@ class Pipeline():
         
         # Assume at least 64kb of UBO storage (d3d11 requirement) and max element size of mat4
         max_instances = 1000
-        models = (max_instances * (ctypes.c_float * 16))()
-        ids = (max_instances * ctypes.c_uint)()
-
+        alignment = get_uniform_buffer_offset_alignment()
+        matrix_size = ctypes.sizeof(ctypes.c_float * 16)
+        
+        if instances is None:
+            instances = SceneInstances()
+        instances_ref = weakref.ref(instances)
+        generation = instances.generation + 1
+
+        # Gather the data of all batches and upload it at once
+        models = bytearray()
+        ids = array.array('I')
+        indirect = indirect_draw_support()
+        commands = array.array('I') if indirect else None
+        
         for material, meshes in result.items():
             for mesh, scale_groups in meshes.items():
                 for scale_group, objs in scale_groups.items():
                     batches = []
                     scale_groups[scale_group] = batches
                     
-                    i = 0
-                    batch_length = len(objs)
-                    
-                    while i < batch_length:
-                        instance_i = i % max_instances
-                        models[instance_i] = objs[i].matrix
-                        ids[instance_i] = objs[i].parameters['ID']
-
-                        i+=1
-                        instances_count = instance_i + 1
-
-                        if i == batch_length or instances_count == max_instances:
-                            local_models = ((ctypes.c_float * 16) * instances_count).from_address(ctypes.addressof(models))
-                            # IDs are stored as uvec4, so we make sure the buffer count is a multiple of 4,
-                            # since some drivers will only bind a full uvec4 (see issue #319)
-                            id_buffer_count = math.ceil(instances_count/4)*4
-                            local_ids = (ctypes.c_uint * id_buffer_count).from_address(ctypes.addressof(ids))
-
-                            models_UBO = UBO()
-                            ids_UBO = UBO()
-
-                            models_UBO.load_data(local_models)
-                            ids_UBO.load_data(local_ids)
-
+                    for batch_start in range(0, len(objs), max_instances):
+                        batch_objects = objs[batch_start:batch_start + max_instances]
+                        instances_count = len(batch_objects)
+                        
+                        if indirect == False:
+                            models.extend(bytes(-len(models) % alignment))
+                        models_offset = len(models)
+                        for instance_index, obj in enumerate(batch_objects):
+                            models += obj.matrix
+                            obj.batch_locations.append((instances_ref, generation, models_offset + instance_index * matrix_size))
+                        
+                        if indirect:
+                            base_instance = len(ids)
+                            ids.extend(obj.parameters['ID'] for obj in batch_objects)
+                            indirect_offset = len(commands) * commands.itemsize
+                            # count, instanceCount, firstIndex, baseVertex, baseInstance
+                            commands.extend((mesh.mesh.index_count, instances_count, 0, 0, base_instance))
                             batches.append({
                                 'instances_count': instances_count,
-                                'BATCH_MODELS':models_UBO,
-                                'BATCH_IDS':ids_UBO,
+                                'INSTANCES': instances,
+                                'INDIRECT_OFFSET': indirect_offset,
                             })
-            
+                            continue
+                        
+                        ids.extend(bytes(-len(ids) * ids.itemsize % alignment // ids.itemsize))
+                        ids_offset = len(ids) * ids.itemsize
+                        ids.extend(obj.parameters['ID'] for obj in batch_objects)
+                        # IDs are stored as uvec4, so we make sure the buffer count is a multiple of 4,
+                        # since some drivers will only bind a full uvec4 (see issue #319)
+                        ids.extend(bytes(-instances_count % 4))
+
+                        batches.append({
+                            'instances_count': instances_count,
+                            'BATCH_MODELS': instances.models,
+                            'BATCH_MODELS_OFFSET': models_offset,
+                            'BATCH_IDS': instances.ids,
+                            'BATCH_IDS_OFFSET': ids_offset,
+                        })
+        
+        instances.load(models, ids, commands)
+        
         return result
     
+    def get_draw_list(self, scene, key, build_function):
+        # Caches the result of build_function(scene.batches) until the scene batches change.
+        # Scene copies share the cache, so it must be cleared when material parameters change.
+        draw_lists = getattr(scene, 'draw_lists', None)
+        if draw_lists is None:
+            return build_function(scene.batches)
+        key = (id(scene.batches), key)
+        entry = draw_lists.get(key)
+        if entry is None or entry[0] is not scene.batches:
+            entry = (scene.batches, build_function(scene.batches))
+            draw_lists[key] = entry
+        return entry[1]
+    
+    def update_scene_batches(self, objects):
+        # Patch the batches matrices in place after a transform-only scene update
+        for obj in objects:
+            locations = []
+            for instances_ref, generation, offset in obj.batch_locations:
+                instances = instances_ref()
+                if instances and instances.generation == generation:
+                    instances.models.load_sub_data(obj.matrix, offset)
+                    locations.append((instances_ref, generation, offset))
+            obj.batch_locations = locations
+    
     def draw_scene_pass(self, render_target, scene_batches, pass_name=None, default_shader=None, shader_resources={}, depth_test_function=GL_LEQUAL):
         glDisable(GL_BLEND)
         glEnable(GL_DEPTH_TEST)
@@ -334,6 +457,8 @@ class Pipeline():
         render_target.bind()
 
         _double_sided = None
+        indirect = indirect_draw_support()
+        _instances = None
 
         for material in scene_batches.keys():
             shader = default_shader
@@ -387,10 +512,23 @@ class Pipeline():
                             if 'MIRROR_SCALE' in shader.uniforms:
                                 shader.uniforms['MIRROR_SCALE'].bind(True)
                 
+                    if indirect:
+                        instances = batches[0]['INSTANCES']
+                        if instances is not _instances:
+                            _instances = instances
+                            instances.bind_indirect()
+                        # The batches of a scale group are contiguous in the command buffer
+                        glMultiDrawElementsIndirect(GL_TRIANGLES, mesh.mesh.index_type,
+                            ctypes.c_void_p(batches[0]['INDIRECT_OFFSET']), len(batches), 0)
+                        continue
+                
                     for batch in batches:
-                        batch['BATCH_MODELS'].bind(shader.uniform_blocks['BATCH_MODELS'])
-                        batch['BATCH_IDS'].bind(shader.uniform_blocks['BATCH_IDS'])
-                        glDrawElementsInstanced(GL_TRIANGLES, mesh.mesh.index_count, GL_UNSIGNED_INT, NULL, batch['instances_count'])
+                        batch['BATCH_MODELS'].bind(shader.uniform_blocks['BATCH_MODELS'], batch['BATCH_MODELS_OFFSET'])
+                        batch['BATCH_IDS'].bind(shader.uniform_blocks['BATCH_IDS'], batch['BATCH_IDS_OFFSET'])
+                        glDrawElementsInstanced(GL_TRIANGLES, mesh.mesh.index_count, mesh.mesh.index_type, NULL, batch['instances_count'])
+        
+        if _instances:
+            glBindBuffer(GL_DRAW_INDIRECT_BUFFER, 0)
 
 
     def render(self, resolution, scene, is_final_render, is_new_frame):
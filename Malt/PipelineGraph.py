@@ -159,21 +159,33 @@ class GLSLPipelineGraph(PipelineGraph):
         code += '\n\n'
         return code
     
-    def compile_material(self, source, include_paths=[]):
-        def preprocess(params):
-            return self.preprocess_shader_from_source(*params)
-        
+    def get_preprocess_params(self, source, include_paths=[]):
+        # Returns the (source, include_paths, definitions) of every shader stage,
+        # ready to be passed to Malt.GL.Shader.preprocess_source.
+        from Malt.GL.Shader import get_preprocessor_definitions
         params = []
         for shader in self.shaders:
-            params.append((source, include_paths, [shader, 'VERTEX_SHADER']))
-            params.append((source, include_paths, [shader, 'PIXEL_SHADER']))
-        preprocessed = self.pool.map(preprocess, params)
-
+            for stage in ['VERTEX_SHADER', 'PIXEL_SHADER']:
+                definitions = get_preprocessor_definitions([self.get_material_define(), shader, stage])
+                params.append((source, self.include_paths + include_paths, definitions))
+        return params
+    
+    def compile_material_from_preprocessed(self, preprocessed):
         from Malt.GL.Shader import Shader
+        preprocessed = list(preprocessed)
         shaders = {}
         for shader in self.shaders:
             shaders[shader] = Shader(preprocessed.pop(0), preprocessed.pop(0))
         return shaders
+    
+    def compile_material(self, source, include_paths=[]):
+        from Malt.GL.Shader import preprocess_source
+        def preprocess(params):
+            return preprocess_source(*params)
+        
+        params = self.get_preprocess_params(source, include_paths)
+        preprocessed = self.pool.map(preprocess, params)
+        return self.compile_material_from_preprocessed(preprocessed)
 
 class PythonGraphIO(PipelineGraphIO):
 
@@ -262,15 +262,17 @@ class NPR_Pipeline(Pipeline):
         return w, h
     
     def get_scene_batches(self, scene):
-        opaque_batches = {}
-        transparent_batches = {}
-        for material, meshes in scene.batches.items():
-            if material and material.shader:
-                if material.shader['PRE_PASS'].uniforms['Settings.Transparency'].value[0] == True:
-                    transparent_batches[material] = meshes
-                    continue
-            opaque_batches[material] = meshes
-        return opaque_batches, transparent_batches
+        def split_batches(batches):
+            opaque_batches = {}
+            transparent_batches = {}
+            for material, meshes in batches.items():
+                if material and material.shader:
+                    if material.shader['PRE_PASS'].uniforms['Settings.Transparency'].value[0] == True:
+                        transparent_batches[material] = meshes
+                        continue
+                opaque_batches[material] = meshes
+            return opaque_batches, transparent_batches
+        return self.get_draw_list(scene, 'TRANSPARENCY', split_batches)
 
     def do_render(self, resolution, scene, is_final_render, is_new_frame):
         #SETUP SAMPLING
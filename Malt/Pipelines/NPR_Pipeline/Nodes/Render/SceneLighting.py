@@ -95,23 +95,29 @@ class SceneLighting(PipelineNode):
         shader_resources['COMMON_UNIFORMS'] = self.common_buffer
         shader_resources['SCENE_LIGHTS'] = self.lights_buffer
 
+        def get_light_group_batches(light_group, is_transparent):
+            def build_batches(batches):
+                result = {}
+                for material, meshes in (transparent_batches if is_transparent else opaque_batches).items():
+                    if material and light_group in material.parameters['Light Groups.Shadow']:
+                        result[material] = meshes
+                return result
+            return self.pipeline.get_draw_list(scene, ('SHADOW_PASS', light_group, is_transparent), build_batches)
+
         def render_shadowmaps(lights, fbos_opaque, fbos_transparent):
             for light_index, light_matrices_pair in enumerate(lights.items()):
                 light, matrices = light_matrices_pair
+                light_group = light.parameters['Light Group']
+                opaque_light_batches = get_light_group_batches(light_group, False)
+                transparent_light_batches = get_light_group_batches(light_group, True)
                 for matrix_index, camera_projection_pair in enumerate(matrices): 
                     camera, projection = camera_projection_pair
                     i = light_index * len(matrices) + matrix_index
                     self.common_buffer.load(scene, fbos_opaque[i].resolution, (0,0), self.pipeline.sample_count, camera, projection)
-                    def get_light_group_batches(batches):
-                        result = {}
-                        for material, meshes in batches.items():
-                            if material and light.parameters['Light Group'] in material.parameters['Light Groups.Shadow']:
-                                result[material] = meshes
-                        return result
                     #TODO: Callback
-                    self.pipeline.draw_scene_pass(fbos_opaque[i], get_light_group_batches(opaque_batches), 
+                    self.pipeline.draw_scene_pass(fbos_opaque[i], opaque_light_batches, 
                         'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources)
-                    self.pipeline.draw_scene_pass(fbos_transparent[i], get_light_group_batches(transparent_batches), 
+                    self.pipeline.draw_scene_pass(fbos_transparent[i], transparent_light_batches, 
                         'SHADOW_PASS', self.pipeline.default_shader['SHADOW_PASS'], shader_resources)
         
         render_shadowmaps(self.lights_buffer.spots,
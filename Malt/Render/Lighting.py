@@ -1,6 +1,7 @@
 import math
 import ctypes
 
+import numpy as np
 import pyrr
 
 from Malt.GL.GL import *
@@ -164,16 +165,16 @@ class LightsBuffer():
     ):
         #TODO: Automatic distribution exponent basedd on FOV
 
-        spot_count=0
-        sun_count=0
-        point_count=0
-
         from collections import OrderedDict
 
         self.spots = OrderedDict()
         self.suns = OrderedDict()
         self.points = OrderedDict()
 
+        spots = []
+        suns = []
+        points = []
+
         for i, light in enumerate(scene.lights):
             self.data.lights[i].color = light.color
             self.data.lights[i].type = light.type
@@ -184,75 +185,152 @@ class LightsBuffer():
             self.data.lights[i].spot_blend = light.spot_blend
 
             if light.type == LIGHT_SPOT:
-                self.data.lights[i].type_index = spot_count
-
-                projection_matrix = make_projection_matrix(light.spot_angle,1,0.01,light.radius,
-                    sample_offset,(spot_resolution, spot_resolution))
-                spot_matrix = projection_matrix * pyrr.Matrix44(light.matrix)
-                
-                self.data.spot_matrices[spot_count] = flatten_matrix(spot_matrix)
-
-                self.spots[light] = [(light.matrix, flatten_matrix(projection_matrix))]
-
-                spot_count+=1
-            
+                self.data.lights[i].type_index = len(spots)
+                spots.append(light)
             if light.type == LIGHT_SUN:
-                self.data.lights[i].type_index = sun_count
-
-                sun_matrix = pyrr.Matrix44(light.matrix)
-                projection_matrix = [*scene.camera.projection_matrix]
-                projection_matrix = pyrr.Matrix44(projection_matrix)
-                view_matrix = projection_matrix * pyrr.Matrix44(scene.camera.camera_matrix)
-
-                max_distance = cascades_max_distance
-                if light.sun_max_distance != 0:
-                    max_distance = light.sun_max_distance
-                
-                cascades_matrices = get_sun_cascades(sun_matrix, projection_matrix, view_matrix, cascades_count, cascades_distribution_scalar, max_distance, sample_offset, sun_resolution)
-
-                self.suns[light] = []
-                for i, cascade in enumerate(cascades_matrices):
-                    matrix = pyrr.Matrix44(cascade[1])*pyrr.Matrix44(cascade[0])
-                    self.data.sun_matrices[sun_count * cascades_count + i] = flatten_matrix(matrix)
-                    self.suns[light].append(cascade)
-
-                sun_count+=1
-            
+                self.data.lights[i].type_index = len(suns)
+                suns.append(light)
             if light.type == LIGHT_POINT:
-                self.data.lights[i].type_index = point_count
-
-                cube_map_axes = [
-                    (( 1, 0, 0),( 0,-1, 0)),
-                    ((-1, 0, 0),( 0,-1, 0)),
-                    (( 0, 1, 0),( 0, 0, 1)),
-                    (( 0,-1, 0),( 0, 0,-1)),
-                    (( 0, 0, 1),( 0,-1, 0)),
-                    (( 0, 0,-1),( 0,-1, 0))
-                ]
-                matrices = []
-                position = pyrr.Vector3(light.position)
-                offset_matrix = pyrr.Matrix44.from_translation(position)
-                rotation_matrix = pyrr.Matrix44.from_eulers((sample_offset[0], sample_offset[1], 0.0))
-                for axes in cube_map_axes:
-                    front = pyrr.Matrix33.from_matrix44(rotation_matrix) * pyrr.Vector3(axes[0])
-                    up = pyrr.Matrix33.from_matrix44(rotation_matrix) * pyrr.Vector3(axes[1])
-                    matrices.append(pyrr.Matrix44.look_at(position, position + front, up))
-                self.data.point_matrices[point_count] = flatten_matrix((offset_matrix * rotation_matrix).inverse)
-
-                projection_matrix = make_projection_matrix(math.pi / 2.0, 1.0, 0.01, light.radius, 
-                    (0,0), (point_resolution, point_resolution))
-
-                self.points[light] = []
-                for i in range(6):
-                    self.points[light].append((flatten_matrix(matrices[i]), flatten_matrix(projection_matrix)))
-                
-                point_count+=1
+                self.data.lights[i].type_index = len(points)
+                points.append(light)
+        
+        # The matrices of each light type are computed at once as stacked arrays (in pyrr row-major layout),
+        # and written directly into self.data
+        if len(spots):
+            self.load_spots(spots, spot_resolution, sample_offset)
+        if len(suns):
+            self.load_suns(scene, suns, sun_resolution, cascades_count, cascades_distribution_scalar,
+                cascades_max_distance, sample_offset)
+        if len(points):
+            self.load_points(points, point_resolution, sample_offset)
             
         self.data.lights_count = len(scene.lights)
         self.data.cascades_count = cascades_count
         
         self.UBO.load_data(self.data)
     
+    def load_spots(self, spots, spot_resolution, sample_offset):
+        light_matrices = np.array([light.matrix for light in spots], dtype=np.float64).reshape(-1,4,4)
+        projection_matrices = make_projection_matrices(np.array([light.spot_angle for light in spots]), 1, 0.01,
+            np.array([light.radius for light in spots]), sample_offset, (spot_resolution, spot_resolution))
+        
+        spot_matrices = np.ctypeslib.as_array(self.data.spot_matrices)
+        spot_matrices[:len(spots)] = (light_matrices @ projection_matrices).reshape(-1,16)
+
+        for i, light in enumerate(spots):
+            self.spots[light] = [(light.matrix, flatten_matrix(projection_matrices[i]))]
+    
+    def load_suns(self, scene, suns, sun_resolution, cascades_count, cascades_distribution_scalar,
+        cascades_max_distance, sample_offset):
+        # Cascades are fitted to the whole frame, so they match between the tiles of tiled renders
+        projection_matrix = getattr(scene.camera, 'frame_projection_matrix', None) or scene.camera.projection_matrix
+        projection_matrix = pyrr.Matrix44([*projection_matrix])
+        view_matrix = projection_matrix * pyrr.Matrix44(scene.camera.camera_matrix)
+        world_from_view_matrix = np.linalg.inv(view_matrix)
+
+        sun_matrices = np.ctypeslib.as_array(self.data.sun_matrices)
+        
+        # Lights with the same max distance share the same cascade splits
+        groups = {}
+        for sun_index, light in enumerate(suns):
+            max_distance = cascades_max_distance
+            if light.sun_max_distance != 0:
+                max_distance = light.sun_max_distance
+            groups.setdefault(max_distance, []).append(sun_index)
+            self.suns[light] = []
+        
+        for max_distance, sun_indices in groups.items():
+            splits = get_sun_cascades_splits(projection_matrix, cascades_count, cascades_distribution_scalar, max_distance)
+            # (cascades, 8, 4)
+            corners = np.array([[(x, y, z, 1) for x in (-1, 1) for y in (-1, 1) for z in (near, far)]
+                for near, far in splits], dtype=np.float64)
+            corners = corners @ world_from_view_matrix
+            corners /= corners[..., 3:]
+
+            # (lights, 4, 4)
+            sun_from_world = np.array([suns[i].matrix for i in sun_indices], dtype=np.float64).reshape(-1,4,4)
+            world_from_light_space = np.linalg.inv(sun_from_world)
+            
+            # (lights, cascades, 8, 4)
+            light_corners = np.einsum('cki,lij->lckj', corners, sun_from_world)
+            aabb_min = light_corners[..., :3].min(axis=2)
+            aabb_max = light_corners[..., :3].max(axis=2)
+            size = aabb_max - aabb_min
+            
+            def to_world(v):
+                v = np.concatenate((v, np.ones(v.shape[:-1] + (1,))), axis=-1)
+                return np.einsum('lci,lij->lcj', v, world_from_light_space)
+            center = ((to_world(aabb_min) + to_world(aabb_max)) / 2.0)[..., :3]
+
+            translate = np.zeros(center.shape[:-1] + (4,4))
+            translate[..., [0,1,2,3], [0,1,2,3]] = 1
+            translate[..., 3, :3] = center
+            # (lights, cascades, 4, 4)
+            cameras = np.linalg.inv(world_from_light_space[:, None] @ translate)
+
+            scale = 1.0 / (size / 2.0)
+            screens = np.zeros(center.shape[:-1] + (4,4))
+            screens[..., 0, 0] = scale[..., 0]
+            screens[..., 1, 1] = scale[..., 1]
+            screens[..., 2, 2] = -scale[..., 2]
+            screens[..., 3, 0] = sample_offset[0] / sun_resolution
+            screens[..., 3, 1] = sample_offset[1] / sun_resolution
+            screens[..., 3, 3] = 1
+
+            matrices = (cameras @ screens).reshape(len(sun_indices), cascades_count, 16)
+            for i, sun_index in enumerate(sun_indices):
+                sun_matrices[sun_index * cascades_count : (sun_index + 1) * cascades_count] = matrices[i]
+                light = suns[sun_index]
+                for cascade_index in range(cascades_count):
+                    self.suns[light].append((flatten_matrix(cameras[i, cascade_index]),
+                        screens[i, cascade_index].reshape(16).tolist()))
+    
+    def load_points(self, points, point_resolution, sample_offset):
+        cube_map_axes = np.array([
+            (( 1, 0, 0),( 0,-1, 0)),
+            ((-1, 0, 0),( 0,-1, 0)),
+            (( 0, 1, 0),( 0, 0, 1)),
+            (( 0,-1, 0),( 0, 0,-1)),
+            (( 0, 0, 1),( 0,-1, 0)),
+            (( 0, 0,-1),( 0,-1, 0))
+        ], dtype=np.float64)
+        rotation_matrix = np.array(pyrr.Matrix44.from_eulers((sample_offset[0], sample_offset[1], 0.0)), dtype=np.float64)
+        
+        # The look at rotation is the same for all the lights, only the translation changes
+        # (6, 3)
+        front = cube_map_axes[:, 0] @ rotation_matrix[:3, :3]
+        up = cube_map_axes[:, 1] @ rotation_matrix[:3, :3]
+        front /= np.linalg.norm(front, axis=-1, keepdims=True)
+        side = np.cross(front, up)
+        side /= np.linalg.norm(side, axis=-1, keepdims=True)
+        up = np.cross(side, front)
+        up /= np.linalg.norm(up, axis=-1, keepdims=True)
+
+        # (lights, 3)
+        positions = np.array([light.position for light in points], dtype=np.float64)
+        # (lights, 6, 4, 4)
+        look_at = np.zeros((len(points), 6, 4, 4))
+        look_at[:, :, :3, 0] = side
+        look_at[:, :, :3, 1] = up
+        look_at[:, :, :3, 2] = -front
+        look_at[:, :, 3, 0] = -(positions @ side.T)
+        look_at[:, :, 3, 1] = -(positions @ up.T)
+        look_at[:, :, 3, 2] = positions @ front.T
+        look_at[:, :, 3, 3] = 1
+
+        offset_matrices = np.zeros((len(points), 4, 4))
+        offset_matrices[:, [0,1,2,3], [0,1,2,3]] = 1
+        offset_matrices[:, 3, :3] = positions
+        point_matrices = np.ctypeslib.as_array(self.data.point_matrices)
+        point_matrices[:len(points)] = np.linalg.inv(rotation_matrix @ offset_matrices).reshape(-1,16)
+
+        projection_matrices = make_projection_matrices(math.pi / 2.0, 1.0, 0.01, 
+            np.array([light.radius for light in points]), (0,0), (point_resolution, point_resolution))
+
+        for i, light in enumerate(points):
+            projection_matrix = flatten_matrix(projection_matrices[i])
+            self.points[light] = [(flatten_matrix(look_at[i, face]), projection_matrix) for face in range(6)]
+    
     def bind(self, block):
         self.UBO.bind(block)
     
@@ -279,8 +357,32 @@ def make_projection_matrix(fov, aspect_ratio, near, far, sample_offset, resoluti
     return pyrr.Matrix44(matrix)
 
 
+# Same as make_projection_matrix, for arrays of fovs and/or far planes. Returns a (N,4,4) array.
+def make_projection_matrices(fov, aspect_ratio, near, far, sample_offset, resolution):
+    x_scale = 1.0 / np.tan(np.asarray(fov) / 2.0)
+    y_scale = x_scale * aspect_ratio
+    matrices = np.zeros((len(far), 4, 4))
+    matrices[:, 0, 0] = x_scale
+    matrices[:, 1, 1] = y_scale
+    matrices[:, 2, 2] = (-(far + near)) / (far - near)
+    matrices[:, 2, 3] = -1
+    matrices[:, 3, 2] = (-2.0 * far * near) / (far - near)
+    # See bake_sample_offset (perspective)
+    matrices[:, 2, 0] += sample_offset[0] / resolution[0]
+    matrices[:, 2, 1] += sample_offset[1] / resolution[1]
+    return matrices
+
+
 def get_sun_cascades(sun_from_world_matrix, projection_matrix, view_from_world_matrix, cascades_count, cascades_distribution_scalar, cascades_max_distance, sample_offset, resolution):
     cascades = []
+    for near, far in get_sun_cascades_splits(projection_matrix, cascades_count, cascades_distribution_scalar, cascades_max_distance):
+        cascades.append(sun_shadowmap_matrix(sun_from_world_matrix, view_from_world_matrix, near, far, sample_offset, resolution))
+    return cascades
+
+
+# Returns the (near, far) clip space depths of each cascade
+def get_sun_cascades_splits(projection_matrix, cascades_count, cascades_distribution_scalar, cascades_max_distance):
+    result = []
     splits = []
 
     n,f = 0,0    
@@ -316,9 +418,9 @@ def get_sun_cascades(sun_from_world_matrix, projection_matrix, view_from_world_m
             near = lerp(near, splits[i-1], 0.01)
         if i+1 < len(splits):
             far = lerp(far, splits[i+1], 0.01)
-        cascades.append(sun_shadowmap_matrix(sun_from_world_matrix, view_from_world_matrix, near, far, sample_offset, resolution))
+        result.append((near, far))
     
-    return cascades
+    return result
 
 
 def frustum_corners(view_from_world_matrix, near, far):
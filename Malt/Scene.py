@@ -4,6 +4,8 @@ class Camera():
         self.camera_matrix = camera_matrix
         self.projection_matrix = projection_matrix
         self.parameters = parameters
+        # Set for tiled renders, projection_matrix only covers the tile (See Bridge.Server.get_tile_camera)
+        self.frame_projection_matrix = None
 
 class Material():
 
@@ -26,6 +28,8 @@ class Object():
         self.parameters = parameters
         self.mirror_scale = mirror_scale
         self.tags = tags
+        # (weakref to SceneInstances, generation, byte offset), filled by Pipeline.build_scene_batches
+        self.batch_locations = []
 
 class Light():
 
@@ -53,6 +57,8 @@ class Scene():
         self.time = 0
 
         self.batches = None
+        # Lists derived from batches, reused across samples and passes (See Pipeline.get_draw_list)
+        self.draw_lists = {}
         self.shader_resources = {}
 
 class ShaderResource():
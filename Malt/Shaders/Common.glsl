@@ -49,6 +49,18 @@ layout(std140) uniform BATCH_IDS
 };
 #define BATCH_ID(index) BATCH_ID[(index)/4][(index)%4]
 
+#if defined(INDIRECT_DRAW) && defined(VERTEX_SHADER)
+// Instance data of the whole scene, indexed by gl_BaseInstanceARB + gl_InstanceID
+layout(std430, binding = 0) readonly buffer INSTANCE_MODELS
+{
+    mat4 INSTANCE_MODEL[];
+};
+layout(std430, binding = 1) readonly buffer INSTANCE_IDS
+{
+    uint INSTANCE_ID[];
+};
+#endif
+
 vertex_out vec3 IO_POSITION;
 vertex_out vec3 IO_NORMAL;
 vertex_out vec3 IO_TANGENT;
@@ -95,8 +107,13 @@ void VERTEX_SETUP_OUTPUT()
 
 void DEFAULT_VERTEX_SHADER()
 {
+#ifdef INDIRECT_DRAW
+    MODEL = INSTANCE_MODEL[gl_BaseInstanceARB + gl_InstanceID];
+    ID = uvec4(INSTANCE_ID[gl_BaseInstanceARB + gl_InstanceID],0,0,0);
+#else
     MODEL = BATCH_MODEL[gl_InstanceID];
     ID = uvec4(BATCH_ID(gl_InstanceID),0,0,0);
+#endif
 
     POSITION = transform_point(MODEL, in_position);
     NORMAL = transform_normal(MODEL, in_normal);
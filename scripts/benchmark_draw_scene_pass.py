@@ -0,0 +1,107 @@
+# Compares the Pipeline.draw_scene_pass submission paths (per batch glDrawElementsInstanced vs glMultiDrawElementsIndirect).
+# Counts the draw calls issued from Python and measures the CPU time per pass.
+# Requires the Malt dependencies to be installed (see install_dependencies.py) and an OpenGL 4.5 capable GPU.
+
+import os, sys, time, ctypes, argparse
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--objects', type=int, default=20000)
+parser.add_argument('--meshes', type=int, default=50)
+parser.add_argument('--passes', type=int, default=100)
+args = parser.parse_args()
+
+import glfw
+
+glfw.init()
+glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 4)
+glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 5)
+glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+glfw.window_hint(glfw.VISIBLE, False)
+window = glfw.create_window(256, 256, 'Malt Benchmark', None, None)
+glfw.make_context_current(window)
+
+from Malt.GL.GL import *
+from Malt.GL import Shader
+from Malt.GL.Mesh import Mesh
+from Malt import Scene, Pipeline
+from Malt.Pipelines.MiniPipeline.MiniPipeline import MiniPipeline
+
+DRAW_CALLS = 0
+
+def count_draw_calls(function):
+    def wrapper(*args, **kwargs):
+        global DRAW_CALLS
+        DRAW_CALLS += 1
+        return function(*args, **kwargs)
+    return wrapper
+
+Pipeline.glDrawElementsInstanced = count_draw_calls(Pipeline.glDrawElementsInstanced)
+Pipeline.glMultiDrawElementsIndirect = count_draw_calls(Pipeline.glMultiDrawElementsIndirect)
+
+positions = [
+    -1,-1,-1,  1,-1,-1,  1,1,-1,  -1,1,-1,
+    -1,-1, 1,  1,-1, 1,  1,1, 1,  -1,1, 1,
+]
+indices = [
+    0,2,1, 0,3,2, 4,5,6, 4,6,7,
+    0,1,5, 0,5,4, 2,3,7, 2,7,6,
+    1,2,6, 1,6,5, 3,0,4, 3,4,7,
+]
+mesh_parameters = {
+    'double_sided': False,
+    'precomputed_tangents': False,
+}
+meshes = [Scene.Mesh(Mesh(positions, indices), mesh_parameters) for i in range(args.meshes)]
+
+scene = Scene.Scene()
+scene.camera = Scene.Camera([1,0,0,0, 0,1,0,0, 0,0,1,0, 0,0,-10,1], [1,0,0,0, 0,1,0,0, 0,0,-1,-1, 0,0,-0.2,0])
+for i in range(args.objects):
+    scale = -0.01 if i % 7 == 0 else 0.01
+    matrix = (ctypes.c_float * 16)(scale,0,0,0, 0,0.01,0,0, 0,0,0.01,0, (i%100)/50-1,(i//100%100)/50-1,0,1)
+    scene.objects.append(Scene.Object(matrix, meshes[i % len(meshes)], None, {'ID': i}, scale < 0))
+
+resolution = (256, 256)
+
+modes = [False]
+if Shader.indirect_draw_support():
+    modes.append(True)
+else:
+    print('glMultiDrawElementsIndirect is not supported, only the fallback path is measured')
+
+for indirect in modes:
+    Shader.INDIRECT_DRAW = indirect
+    MiniPipeline.DEFAULT_SHADER = None
+    pipeline = MiniPipeline()
+    pipeline.setup_render_targets(resolution)
+    pipeline.common_buffer.load(scene, resolution)
+    shader_resources = { 'COMMON_UNIFORMS' : pipeline.common_buffer }
+    shader = pipeline.default_shader['MAIN_PASS']
+    if shader.error:
+        print(shader.error)
+
+    build_start = time.perf_counter()
+    scene.batches = pipeline.build_scene_batches(scene.objects)
+    build_time = time.perf_counter() - build_start
+
+    # Warm up
+    pipeline.draw_scene_pass(pipeline.fbo_main, scene.batches, 'MAIN_PASS', shader, shader_resources)
+    glFinish()
+
+    DRAW_CALLS = 0
+    cpu_time = 0
+    for i in range(args.passes):
+        start = time.perf_counter()
+        pipeline.draw_scene_pass(pipeline.fbo_main, scene.batches, 'MAIN_PASS', shader, shader_resources)
+        cpu_time += time.perf_counter() - start
+        # Keep the GPU work out of the next measurement
+        glFinish()
+
+    print('{} path'.format('Indirect' if indirect else 'Batch'))
+    print('    Build scene batches : {:.3f} ms'.format(build_time * 1000))
+    print('    Draw calls per pass : {}'.format(DRAW_CALLS // args.passes))
+    print('    CPU time per pass : {:.3f} ms'.format(cpu_time * 1000 / args.passes))
+
+glfw.terminate()
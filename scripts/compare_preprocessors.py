@@ -0,0 +1,65 @@
+# Compares the mcpp and the in-process preprocessor backends over the shipped shader libraries.
+# Outputs are normalized (no #line directives, comments or whitespace differences) before comparison.
+# Requires the Malt dependencies to be installed (see install_dependencies.py).
+
+import os, sys, time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, '..'))
+
+from Malt.GL import Shader
+from Malt.GL.GLSLPreprocessor import normalize_preprocessed_source
+
+malt_folder = os.path.join(current_dir, '..', 'Malt')
+
+INCLUDE_PATHS = [
+    os.path.join(malt_folder, 'Shaders'),
+    os.path.join(malt_folder, 'Pipelines', 'NPR_Pipeline', 'Shaders'),
+]
+
+DEFINITIONS = [
+    [],
+    ['VERTEX_SHADER'],
+    ['PIXEL_SHADER'],
+    ['PIXEL_SHADER', 'MAIN_PASS'],
+    ['PIXEL_SHADER', 'PRE_PASS'],
+    ['VERTEX_SHADER', 'PIXEL_SHADER', 'REFLECTION'],
+]
+
+paths = []
+for include_path in INCLUDE_PATHS:
+    for root, dirs, files in os.walk(include_path):
+        for file in files:
+            if file.endswith('.glsl'):
+                paths.append(os.path.join(root, file))
+
+mcpp_time = 0
+python_time = 0
+failures = 0
+
+for path in sorted(paths):
+    source = f'#include "{path}"\n'
+    for definitions in DEFINITIONS:
+        try:
+            start = time.perf_counter()
+            mcpp_result, _ = Shader.mcpp_preprocessor(source, INCLUDE_PATHS, definitions)
+            mcpp_time += time.perf_counter() - start
+        except:
+            # Not every file is meant to be preprocessed on its own
+            continue
+        try:
+            start = time.perf_counter()
+            python_result, _ = Shader.python_preprocessor(source, INCLUDE_PATHS, definitions)
+            python_time += time.perf_counter() - start
+        except Exception as e:
+            print(f'FAILED : {path} {definitions}\n{e}')
+            failures += 1
+            continue
+        if normalize_preprocessed_source(mcpp_result) != normalize_preprocessed_source(python_result):
+            print(f'MISMATCH : {path} {definitions}')
+            failures += 1
+
+print(f'{len(paths)} files, {failures} failures')
+print(f'MCPP : {mcpp_time:.3f}s PYTHON : {python_time:.3f}s')
+
+sys.exit(1 if failures else 0)
@@ -0,0 +1,142 @@
+import ctypes, multiprocessing, os, queue, tempfile, time, unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+PIPELINE_PATH = os.path.join(ROOT, 'Malt', 'Pipelines', 'MiniPipeline', 'MiniPipeline.py')
+RESOLUTION = (100, 60)
+
+def get_scene_file():
+    # A triangle in front of the camera, covering part of the frame
+    import pyrr
+    from Bridge.SceneFile import SceneWriter, MemoryBuffer
+    from Bridge.Proxys import MeshProxy
+    from Malt.Scene import Scene, Camera, Object
+
+    def buffer(ctype, values):
+        return MemoryBuffer(ctype, len(values), (ctype*len(values))(*values))
+
+    writer = SceneWriter(PIPELINE_PATH)
+    writer.add_mesh('triangle', {
+        'positions': buffer(ctypes.c_float, [-3,-2,-5, 2.5,-1,-5, 0,2.2,-5]),
+        'indices': [buffer(ctypes.c_uint32, [0,1,2])],
+        'normals': buffer(ctypes.c_float, [0,0,1]*3),
+        'tangents': None,
+        'uvs': [],
+        'colors': [],
+    })
+    scene = Scene()
+    scene.world_parameters = {'Background Color': (0.25,0.5,1.0,1.0)}
+    identity = pyrr.matrix44.create_identity().flatten().tolist()
+    projection = pyrr.matrix44.create_perspective_projection(60, RESOLUTION[0]/RESOLUTION[1], 0.1, 100)
+    scene.camera = Camera(identity, projection.flatten().tolist())
+    mesh = MeshProxy('triangle', 0)
+    mesh.parameters = {'double_sided': True, 'precomputed_tangents': False}
+    scene.proxys = {('mesh', 'triangle', 0): mesh}
+    scene.objects = [Object(identity, mesh, None, {'ID': 1})]
+    writer.add_frame(1, RESOLUTION, scene)
+    return {
+        'messages': writer.messages,
+        'frames': writer.frames,
+        'materials': writer.materials,
+    }
+
+def read_image(path):
+    import numpy as np
+    if path.endswith('.npy'):
+        return np.load(path)
+    import OpenImageIO as oiio
+    input = oiio.ImageInput.open(path)
+    pixels = input.read_image(0, 0, 0, input.spec().nchannels, oiio.FLOAT)
+    input.close()
+    return pixels
+
+def render(result_queue, output_folder):
+    from Bridge import Context
+    try:
+        context = Context.create_context(Context.select_backend())
+    except Exception as e:
+        result_queue.put(('SKIP', 'No OpenGL context : {}'.format(e)))
+        return
+    try:
+        # Requires the compiled Bridge libraries (See scripts/setup_blender_addon.py)
+        from Bridge import BatchRender, Server
+    except OSError as e:
+        context.terminate()
+        result_queue.put(('SKIP', str(e)))
+        return
+    try:
+        import numpy as np
+        from Malt.Pipelines.MiniPipeline.MiniPipeline import MiniPipeline
+
+        class DepthPipeline(MiniPipeline):
+            # MiniPipeline doesn't output DEPTH
+
+            def do_render(self, resolution, scene, is_final_render, is_new_frame):
+                result = super().do_render(resolution, scene, is_final_render, is_new_frame)
+                result['DEPTH'] = self.t_depth
+                return result
+
+        pipeline = DepthPipeline([])
+        scene_file = get_scene_file()
+        BatchRender.load_resources(pipeline, scene_file)
+        viewport = Server.Viewport(pipeline, True, 32)
+        results = {}
+        for tile_size in (0, 32):
+            buffers = BatchRender.render_frame(viewport, scene_file['frames'][1], ['COLOR', 'DEPTH'], tile_size, 4)
+            template = os.path.join(output_folder, str(tile_size), '####.exr')
+            paths = BatchRender.write_frame(template, 1, buffers, RESOLUTION)
+            for name, path in paths.items():
+                image = read_image(path)
+                w, h = RESOLUTION
+                pixels = np.ctypeslib.as_array(buffers[name].buffer()).reshape(h, w, -1)[::-1]
+                results[(tile_size, name)] = {
+                    'shape': image.shape,
+                    'matches': bool(np.array_equal(image.reshape(pixels.shape), pixels)),
+                    'values': len(np.unique(pixels)),
+                    'rows': int(np.count_nonzero(np.any(pixels != pixels[0,0], axis=(1,2)))),
+                }
+        result_queue.put(('OK', results))
+    finally:
+        context.terminate()
+
+class TestBatchRender(unittest.TestCase):
+
+    def test_output_images(self):
+        output_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(output_folder.cleanup)
+        mp = multiprocessing.get_context('spawn')
+        result_queue = mp.Queue()
+        process = mp.Process(target=render, args=(result_queue, output_folder.name))
+        process.start()
+        try:
+            timeout = time.perf_counter() + 120
+            while True:
+                try:
+                    status, results = result_queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if process.is_alive() == False:
+                        self.fail('The render process exited with code {}'.format(process.exitcode))
+                    if time.perf_counter() > timeout:
+                        self.fail('Timeout')
+        finally:
+            process.join(10)
+            if process.is_alive():
+                process.kill()
+        if status == 'SKIP':
+            self.skipTest(results)
+
+        w, h = RESOLUTION
+        for tile_size in (0, 32):
+            color = results[(tile_size, 'COLOR')]
+            depth = results[(tile_size, 'DEPTH')]
+            self.assertEqual(color['shape'], (h, w, 4))
+            self.assertTrue(color['matches'])
+            self.assertIn(depth['shape'], ((h, w), (h, w, 1)))
+            self.assertTrue(depth['matches'])
+            # The triangle spans most of the rows, not only the top quarter of the image
+            self.assertGreater(depth['values'], 1)
+            self.assertGreater(depth['rows'], h // 2)
+        self.assertEqual(results[(0, 'DEPTH')], results[(32, 'DEPTH')])
+
+if __name__ == '__main__':
+    unittest.main()
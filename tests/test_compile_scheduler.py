@@ -0,0 +1,68 @@
+import multiprocessing, queue, time, unittest
+
+SOURCE = '''
+#define VALUE 1
+int value = VALUE;
+'''
+
+class PreprocessOnlyPipeline():
+    # Implements the Pipeline methods used by CompileScheduler, without OpenGL
+
+    def get_material_preprocess_params(self, path, search_paths=[]):
+        return 'Mesh', [(SOURCE, [], [])]
+
+    def compile_material_from_preprocessed(self, material_type, preprocessed):
+        if isinstance(preprocessed, str):
+            return preprocessed
+        return {}
+
+def compile_material(result_queue):
+    from Malt.GL import Shader, ShaderCache
+    Shader.PREPROCESSOR_BACKEND = 'PYTHON'
+    ShaderCache.PREPROCESSOR_CACHE_ENABLED = False
+    import Bridge.Material
+    from Bridge.Material import CompileScheduler
+    # Spawning a worker per CPU makes the process exit slow
+    Bridge.Material.COMPILE_PROCESSES = 2
+    scheduler = CompileScheduler(PreprocessOnlyPipeline())
+    try:
+        scheduler.add('test.mesh.glsl')
+        materials = []
+        timeout = time.perf_counter() + 60
+        while scheduler.is_empty() == False and time.perf_counter() < timeout:
+            materials += scheduler.poll()
+            time.sleep(0.01)
+        result_queue.put([material.compiler_error for material in materials])
+    finally:
+        scheduler.shutdown()
+
+class TestCompileScheduler(unittest.TestCase):
+
+    def run_in_process(self, daemon):
+        context = multiprocessing.get_context('spawn')
+        result_queue = context.Queue()
+        process = context.Process(target=compile_material, args=(result_queue,), daemon=daemon)
+        process.start()
+        try:
+            timeout = time.perf_counter() + 120
+            while time.perf_counter() < timeout:
+                try:
+                    return result_queue.get(timeout=0.1)
+                except queue.Empty:
+                    if process.is_alive() == False:
+                        self.fail('The compile process exited with code {}'.format(process.exitcode))
+            self.fail('Timeout')
+        finally:
+            process.join(10)
+            if process.is_alive():
+                process.kill()
+
+    def test_compile(self):
+        self.assertEqual(self.run_in_process(daemon=False), [''])
+
+    def test_compile_in_daemon_process(self):
+        # The render server runs as a daemonic process, which can't start a process pool
+        self.assertEqual(self.run_in_process(daemon=True), [''])
+
+if __name__ == '__main__':
+    unittest.main()
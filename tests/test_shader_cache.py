@@ -0,0 +1,191 @@
+import json, multiprocessing, os, tempfile, time, unittest
+
+from Malt.GL.ShaderCache import DiskCache, PreprocessorCache, ProgramCache
+
+DRIVER = {
+    'vendor': 'Test Vendor',
+    'renderer': 'Test Renderer',
+    'version': '4.5',
+}
+
+def store_programs(folder, prefix, count):
+    cache = ProgramCache(folder, 1024*1024, DRIVER, flush_interval=0)
+    for i in range(count):
+        cache.store('{}{}'.format(prefix, i), 1, b'program')
+    cache.flush()
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def test_store_load(self):
+        cache = DiskCache(self.folder.name, 1024)
+        self.assertIsNone(cache.load('a'))
+        cache.store('a', b'data')
+        self.assertEqual(cache.load('a'), b'data')
+
+    def test_evict_least_recently_used(self):
+        cache = DiskCache(self.folder.name, 350)
+        for i, key in enumerate(('a', 'b', 'c')):
+            cache.store(key, b'x' * 100)
+            os.utime(cache.get_path(key), (i, i))
+        cache.load('a')
+        cache.store('d', b'x' * 100)
+        self.assertIsNone(cache.load('b'))
+        self.assertIsNone(cache.load('c'))
+        self.assertEqual(cache.load('a'), b'x' * 100)
+        self.assertEqual(cache.load('d'), b'x' * 100)
+
+class TestPreprocessorCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.cache = PreprocessorCache(os.path.join(self.folder.name, 'cache'), 1024*1024)
+        self.include_path = os.path.join(self.folder.name, 'include.glsl')
+        with open(self.include_path, 'w') as f:
+            f.write('int a;\n')
+
+    def test_store_load(self):
+        key = self.cache.get_key('source', [], [])
+        self.assertNotEqual(key, self.cache.get_key('source', [], ['DEFINITION']))
+        self.assertIsNone(self.cache.load(key))
+        self.cache.store(key, 'result', [])
+        self.assertEqual(self.cache.load(key), 'result')
+
+    def test_dependency_changed(self):
+        key = self.cache.get_key('#include "include.glsl"', [self.folder.name], [])
+        self.cache.store(key, 'result', [self.include_path])
+        self.assertEqual(self.cache.load(key), 'result')
+        with open(self.include_path, 'w') as f:
+            f.write('int b;\n')
+        self.assertIsNone(self.cache.load(key))
+
+    def check_include_without_output(self, backend):
+        # Headers that only define macros don't have #line directives in the output
+        from Malt.GL import Shader, ShaderCache
+        self.addCleanup(setattr, Shader, 'PREPROCESSOR_BACKEND', Shader.PREPROCESSOR_BACKEND)
+        self.addCleanup(setattr, ShaderCache, 'get_preprocessor_cache', ShaderCache.get_preprocessor_cache)
+        Shader.PREPROCESSOR_BACKEND = backend
+        ShaderCache.get_preprocessor_cache = lambda: self.cache
+        with open(self.include_path, 'w') as f:
+            f.write('#ifndef INCLUDE_GLSL\n#define INCLUDE_GLSL\n#define VALUE 1\n#endif\n')
+        source = '#include "include.glsl"\nint value = VALUE;\n'
+        self.assertIn('1', Shader.preprocess_source(source, [self.folder.name]))
+        with open(self.include_path, 'w') as f:
+            f.write('#ifndef INCLUDE_GLSL\n#define INCLUDE_GLSL\n#define VALUE 22\n#endif\n')
+        self.assertIn('22', Shader.preprocess_source(source, [self.folder.name]))
+
+    def test_include_without_output_python(self):
+        self.check_include_without_output('PYTHON')
+
+    def test_include_without_output_mcpp(self):
+        import platform, sys
+        mcpp = os.path.join(os.path.dirname(__file__), '..', 'Malt', '.Dependencies-{}{}'.format(*sys.version_info[:2]),
+            'mcpp-{}'.format(platform.system()))
+        if os.path.exists(mcpp) == False:
+            self.skipTest('mcpp is not installed')
+        self.check_include_without_output('MCPP')
+
+class TestProgramCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def read_index(self):
+        with open(os.path.join(self.folder.name, 'index.json')) as f:
+            return json.load(f)
+
+    def test_store_load(self):
+        cache = ProgramCache(self.folder.name, 1024, DRIVER)
+        self.assertIsNone(cache.load('a'))
+        cache.store('a', 1, b'program')
+        self.assertEqual(cache.load('a'), (1, b'program'))
+        cache.flush()
+        cache = ProgramCache(self.folder.name, 1024, DRIVER)
+        self.assertEqual(cache.load('a'), (1, b'program'))
+        other_driver = dict(DRIVER, version='4.6')
+        self.assertIsNone(ProgramCache(self.folder.name, 1024, other_driver).load('a'))
+
+    def test_stores_are_batched(self):
+        cache = ProgramCache(self.folder.name, 1024, DRIVER, flush_interval=60)
+        for key in ('a', 'b', 'c'):
+            cache.store(key, 1, b'program')
+        self.assertFalse(os.path.exists(os.path.join(self.folder.name, 'index.json')))
+        cache.flush()
+        self.assertEqual(set(self.read_index().keys()), {'a', 'b', 'c'})
+
+    def test_invalidate(self):
+        cache = ProgramCache(self.folder.name, 1024, DRIVER, flush_interval=60)
+        cache.store('a', 1, b'program')
+        cache.flush()
+        cache.invalidate('a')
+        self.assertIsNone(cache.load('a'))
+        cache.flush()
+        self.assertNotIn('a', self.read_index())
+        self.assertFalse(os.path.exists(cache.get_path('a')))
+
+    def test_evict_least_recently_used(self):
+        cache = ProgramCache(self.folder.name, 250, DRIVER)
+        for key in ('a', 'b'):
+            cache.store(key, 1, b'x' * 100)
+            time.sleep(0.01)
+        cache.load('a')
+        time.sleep(0.01)
+        cache.store('c', 1, b'x' * 100)
+        cache.flush()
+        self.assertEqual(set(self.read_index().keys()), {'a', 'c'})
+        self.assertFalse(os.path.exists(cache.get_path('b')))
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def count_index_reads(self, cache):
+        reads = []
+        read_index = cache.read_index
+        def counted_read_index():
+            reads.append(True)
+            return read_index()
+        cache.read_index = counted_read_index
+        return reads
+
+    def test_misses_dont_read_the_index(self):
+        ProgramCache(self.folder.name, 1024, DRIVER).store('a', 1, b'program')
+        cache = ProgramCache(self.folder.name, 1024, DRIVER)
+        reads = self.count_index_reads(cache)
+        for i in range(100):
+            self.assertIsNone(cache.load('missing{}'.format(i)))
+        self.assertEqual(len(reads), 0)
+
+    def test_load_from_other_process(self):
+        cache = ProgramCache(self.folder.name, 1024, DRIVER)
+        reads = self.count_index_reads(cache)
+        other = ProgramCache(self.folder.name, 1024, DRIVER, flush_interval=60)
+        other.store('a', 1, b'program')
+        other.store('b', 1, b'program')
+        # Not in the index until the other process flushes
+        self.assertIsNone(cache.load('a'))
+        other.flush()
+        self.assertEqual(cache.load('a'), (1, b'program'))
+        self.assertEqual(cache.load('b'), (1, b'program'))
+        self.assertEqual(len(reads), 1)
+
+    def test_concurrent_flushes(self):
+        # Every process flushes after each store, the index must keep the entries from all of them
+        context = multiprocessing.get_context('spawn')
+        processes = [context.Process(target=store_programs, args=(self.folder.name, 'p{}_'.format(i), 20))
+            for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(60)
+            self.assertEqual(process.exitcode, 0)
+        expected = set('p{}_{}'.format(i, j) for i in range(4) for j in range(20))
+        self.assertEqual(set(self.read_index().keys()), expected)
+        cache = ProgramCache(self.folder.name, 1024*1024, DRIVER)
+        for key in expected:
+            self.assertEqual(cache.load(key), (1, b'program'))
+
+if __name__ == '__main__':
+    unittest.main()